@@ -0,0 +1,362 @@
+"""Routines to accumulate spike counts and firing rate statistics during simulation."""
+import math
+import numpy as np
+
+from dentate.utils import get_module_logger, RunningStats
+from neuron import h
+
+# This logger will inherit its settings from the root logger, created in dentate.env
+logger = get_module_logger(__name__)
+
+
+class SpikeAccumulatorEvent(object):
+    """
+    Folds the spikes recorded in env.t_vec and env.id_vec into per-gid
+    spike counts, a binned histogram of the spikes of each population,
+    and per-population running statistics of the population firing
+    rate, at regular intervals during the simulation. Spike times are
+    binned relative to the start of their trial after equilibration,
+    as in spikedata.get_env_spike_arrays.
+
+    The memory used by the accumulator does not grow with the number
+    of spikes: per-gid counts are kept as totals per trial, and only
+    the population histograms are binned with bin_size. If
+    gid_bin_size is not None, per-gid counts are also binned with this
+    (typically coarse) bin size; this takes memory proportional to the
+    number of local cells times the number of bins.
+
+    If clear_data is True, the spike vectors are cleared after each
+    update, so that the memory used for spike recording stays bounded
+    in long simulations; this cannot be combined with spike output.
+
+    Functions in the callbacks list are called with the accumulator
+    as argument after each update.
+    """
+
+    def __init__(self, env, bin_size, dt_update=100.0, clear_data=False, include_artificial=False, gid_bin_size=None):
+        self.env = env
+        self.pc = env.pc
+        self.bin_size = float(bin_size)
+        self.gid_bin_size = float(gid_bin_size) if gid_bin_size is not None else None
+        self.dt_update = float(dt_update)
+        self.clear_data = clear_data
+        self.callbacks = []
+
+        equilibration_duration = float(env.stimulus_config.get('Equilibration Duration', 0.))
+        self.equilibration_duration = equilibration_duration
+        self.trial_duration = env.tstop + equilibration_duration
+        self.n_trials = env.n_trials
+        self.tstop = self.trial_duration * float(env.n_trials)
+        self.n_bins = int(math.ceil(env.tstop / self.bin_size))
+        self.n_gid_bins = int(math.ceil(env.tstop / self.gid_bin_size)) if self.gid_bin_size is not None else 0
+
+        typelst = sorted(env.celltypes.keys())
+        binvect = np.asarray([env.celltypes[k]['start'] for k in typelst ])
+        sort_idx = np.argsort(binvect, axis=0)
+        self.pop_names = [typelst[i] for i in sort_idx]
+        self.pop_bins = binvect[sort_idx][1:]
+
+        self.gids = {}
+        self.spike_totals = {}
+        self.pop_spike_counts = {}
+        self.spike_counts = {}
+        self.rate_stats = {}
+        self.interval_counts = {}
+        for pop_name in self.pop_names:
+            pop_gids = set(env.cells[pop_name].keys())
+            if not include_artificial:
+                pop_gids -= set(env.artificial_cells[pop_name].keys())
+            self.gids[pop_name] = np.asarray(sorted(pop_gids), dtype=np.uint32)
+            self.spike_totals[pop_name] = np.zeros((len(pop_gids), self.n_trials), dtype=np.uint32)
+            self.pop_spike_counts[pop_name] = np.zeros((self.n_trials, self.n_bins), dtype=np.uint32)
+            if self.gid_bin_size is not None:
+                self.spike_counts[pop_name] = np.zeros((len(pop_gids), self.n_trials, self.n_gid_bins), dtype=np.uint32)
+            self.rate_stats[pop_name] = RunningStats()
+            self.interval_counts[pop_name] = 0
+
+        self.offset = 0
+        self.t_last = 0.
+        self.last_interval = 0.
+        self.fih_accumulate = h.FInitializeHandler(1, self.start)
+
+    def start(self):
+        """
+        Clears the accumulated counts and statistics and schedules the
+        first update; called by finitialize.
+        """
+        for pop_name in self.pop_names:
+            self.spike_totals[pop_name].fill(0)
+            self.pop_spike_counts[pop_name].fill(0)
+            if pop_name in self.spike_counts:
+                self.spike_counts[pop_name].fill(0)
+            self.rate_stats[pop_name].clear()
+            self.interval_counts[pop_name] = 0
+        self.offset = int(self.env.t_vec.size())
+        self.t_last = h.t
+        self.last_interval = 0.
+        if (h.t + self.dt_update) < self.tstop:
+            h.cvode.event(h.t + self.dt_update, self.update)
+
+    def update(self):
+        self.fold()
+        for callback in self.callbacks:
+            callback(self)
+        if (h.t + self.dt_update) < self.tstop:
+            h.cvode.event(h.t + self.dt_update, self.update)
+
+    def sync_offset(self):
+        """
+        Marks all spikes currently in the spike vectors as folded;
+        called after the spike vectors have been written or cleared
+        by io_utils.spikeout.
+        """
+        self.offset = int(self.env.t_vec.size())
+
+    def fold(self):
+        """
+        Adds the spikes recorded since the previous update to the
+        accumulated counts and updates the running rate statistics.
+        """
+        env = self.env
+        n_spikes = int(env.t_vec.size())
+        if n_spikes < self.offset:
+            self.offset = 0
+        t_vec = np.asarray(env.t_vec.as_numpy()[self.offset:], dtype=np.float32)
+        id_vec = np.asarray(env.id_vec.as_numpy()[self.offset:], dtype=np.uint32)
+
+        if len(env.spike_onset_delay) > 0:
+            delay_gids, delay_index = np.unique(id_vec, return_inverse=True)
+            onset_delays = np.asarray([env.spike_onset_delay.get(gid, 0.) for gid in delay_gids], dtype=np.float32)
+            t_vec = t_vec - onset_delays[delay_index]
+        trial_index = np.floor_divide(t_vec, self.trial_duration).astype(np.int64)
+        trial_t = t_vec - trial_index * self.trial_duration - self.equilibration_duration
+        bin_index = np.floor_divide(trial_t, self.bin_size).astype(np.int64)
+        in_trial = (trial_index >= 0) & (trial_index < self.n_trials) & (trial_t >= 0.)
+        in_range = in_trial & (bin_index < self.n_bins)
+        pop_index = np.digitize(id_vec, self.pop_bins)
+
+        interval = max(h.t - self.t_last, 0.)
+        for i, pop_name in enumerate(self.pop_names):
+            pop_gids = self.gids[pop_name]
+            if len(pop_gids) == 0:
+                continue
+            sinds = np.flatnonzero(pop_index == i)
+            gid_index = np.minimum(np.searchsorted(pop_gids, id_vec[sinds]), len(pop_gids) - 1)
+            is_local = pop_gids[gid_index] == id_vec[sinds]
+            self.interval_counts[pop_name] = int(np.count_nonzero(is_local))
+
+            counted = is_local & in_trial[sinds]
+            totals = self.spike_totals[pop_name]
+            totals += np.bincount(gid_index[counted] * self.n_trials + trial_index[sinds][counted],
+                                  minlength=totals.size).reshape(totals.shape).astype(totals.dtype)
+
+            binned = is_local & in_range[sinds]
+            pop_counts = self.pop_spike_counts[pop_name]
+            pop_counts += np.bincount(trial_index[sinds][binned] * self.n_bins + bin_index[sinds][binned],
+                                      minlength=pop_counts.size).reshape(pop_counts.shape).astype(pop_counts.dtype)
+
+            if self.gid_bin_size is not None:
+                gid_bin_index = np.floor_divide(trial_t[sinds], self.gid_bin_size).astype(np.int64)
+                gid_binned = counted & (gid_bin_index < self.n_gid_bins)
+                flat_index = ((gid_index[gid_binned] * self.n_trials + trial_index[sinds][gid_binned]) * self.n_gid_bins +
+                              gid_bin_index[gid_binned])
+                flat_index, flat_counts = np.unique(flat_index, return_counts=True)
+                counts = self.spike_counts[pop_name].reshape((-1,))
+                counts[flat_index] += flat_counts.astype(counts.dtype)
+
+            if interval > 0.:
+                self.rate_stats[pop_name].update(self.interval_counts[pop_name] /
+                                                 (len(pop_gids) * interval / 1000.))
+
+        self.t_last = h.t
+        self.last_interval = interval
+        if self.clear_data:
+            env.t_vec.resize(0)
+            env.id_vec.resize(0)
+            env.spike_output_offset = 0
+            self.offset = 0
+        else:
+            self.offset = n_spikes
+
+    def mean_rates(self, pop_name, trial=None):
+        """
+        Returns the local gids of the given population and their mean
+        firing rates (Hz) over the given trial, or averaged over trials
+        if trial is None.
+
+        :param pop_name: str
+        :param trial: int or None
+        :return: tuple of array of gids, array of rates
+        """
+        totals = self.spike_totals[pop_name]
+        if trial is None:
+            totals = np.mean(totals, axis=1)
+        else:
+            totals = totals[:, trial]
+        return self.gids[pop_name], totals / (self.env.tstop / 1000.)
+
+    def population_rate(self, pop_name, trial=None):
+        """
+        Returns the binned mean firing rate (Hz) of the local cells of
+        the given population, for the given trial, or averaged over
+        trials if trial is None.
+
+        :param pop_name: str
+        :param trial: int or None
+        :return: array of shape (number of bins,)
+        """
+        counts = self.pop_spike_counts[pop_name]
+        if trial is None:
+            counts = np.mean(counts, axis=0)
+        else:
+            counts = counts[trial, :]
+        n_gids = max(len(self.gids[pop_name]), 1)
+        return counts * (1000. / (self.bin_size * n_gids))
+
+    def rates(self, pop_name, trial=None):
+        """
+        Returns the local gids of the given population and their
+        binned firing rates (Hz) with bin size gid_bin_size, for the
+        given trial, or averaged over trials if trial is None.
+
+        :param pop_name: str
+        :param trial: int or None
+        :return: tuple of array of gids, array of shape (number of gids, number of bins)
+        """
+        if self.gid_bin_size is None:
+            raise RuntimeError('SpikeAccumulatorEvent.rates: per-gid binning requires gid_bin_size')
+        counts = self.spike_counts[pop_name]
+        if trial is None:
+            counts = np.mean(counts, axis=1)
+        else:
+            counts = counts[:, trial, :]
+        return self.gids[pop_name], counts * (1000. / self.gid_bin_size)
+
+    def time_bins(self):
+        """
+        Returns the start times of the population count bins, relative to the start of each trial.
+        """
+        return np.arange(self.n_bins) * self.bin_size
+
+    def gid_time_bins(self):
+        """
+        Returns the start times of the per-gid count bins, relative to the start of each trial.
+        """
+        return np.arange(self.n_gid_bins) * self.gid_bin_size
+
+
+class ActivityWatchdog(object):
+    """
+    Checks the firing rates of the given populations after each update
+    of a :class:'SpikeAccumulatorEvent', and stops the simulation
+    early if activity is outside of the given bounds:
+
+      - runaway activity: the population rate in the last update
+        interval exceeds the maximum rate;
+      - silence: the mean population rate since the start of checking
+        is below the minimum rate.
+
+    Population rates are reduced across all ranks, so that all ranks
+    stop at the same time. The simulation is stopped by setting
+    h.stoprun; callers of psolve must check the triggered attribute.
+
+    :param accumulator: :class:'SpikeAccumulatorEvent'
+    :param rate_bounds: dict { pop_name: (min rate or None, max rate or None) } (Hz)
+    :param t_start: simulation time (ms) at which checking starts
+    """
+
+    def __init__(self, accumulator, rate_bounds, t_start=0.):
+        self.accumulator = accumulator
+        self.pc = accumulator.pc
+        self.pop_names = sorted(rate_bounds.keys())
+        self.rate_bounds = rate_bounds
+        self.t_start = float(t_start)
+        self.triggered = False
+        self.reason = None
+        self.t_checked = 0.
+        self.cumulative_counts = np.zeros(len(self.pop_names))
+        accumulator.callbacks.append(self.check)
+        self.fih_watchdog = h.FInitializeHandler(1, self.reset)
+
+    def reset(self):
+        self.triggered = False
+        self.reason = None
+        self.t_checked = 0.
+        self.cumulative_counts.fill(0.)
+        h.stoprun = 0
+
+    def check(self, accumulator):
+        if self.triggered or h.t <= self.t_start or accumulator.last_interval <= 0.:
+            return
+        interval = min(accumulator.last_interval, h.t - self.t_start)
+        n_pops = len(self.pop_names)
+        local_counts = h.Vector(2 * n_pops)
+        for i, pop_name in enumerate(self.pop_names):
+            local_counts.x[i] = accumulator.interval_counts.get(pop_name, 0)
+            local_counts.x[n_pops + i] = len(accumulator.gids.get(pop_name, ()))
+        self.pc.allreduce(local_counts, 1)
+        counts = np.asarray(local_counts.as_numpy())
+        interval_counts = counts[:n_pops]
+        n_cells = counts[n_pops:]
+        self.cumulative_counts += interval_counts
+        self.t_checked += interval
+
+        rank = int(self.pc.id())
+        for i, pop_name in enumerate(self.pop_names):
+            if n_cells[i] == 0:
+                continue
+            min_rate, max_rate = self.rate_bounds[pop_name]
+            interval_rate = interval_counts[i] / (n_cells[i] * interval / 1000.)
+            mean_rate = self.cumulative_counts[i] / (n_cells[i] * self.t_checked / 1000.)
+            if max_rate is not None and interval_rate > max_rate:
+                self.reason = f'population {pop_name} rate {interval_rate:.02f} Hz exceeds maximum {max_rate:.02f} Hz'
+            elif min_rate is not None and mean_rate < min_rate:
+                self.reason = f'population {pop_name} mean rate {mean_rate:.02f} Hz below minimum {min_rate:.02f} Hz'
+            if self.reason is not None:
+                self.triggered = True
+                if rank == 0:
+                    logger.info(f'*** activity watchdog stopping simulation at t={h.t:.02f} ms: {self.reason}')
+                h.stoprun = 1
+                break
+
+
+def make_activity_watchdog(env, bin_size=None):
+    """
+    Creates the :class:'ActivityWatchdog' specified by the
+    activity_watchdog configuration of env, and the
+    :class:'SpikeAccumulatorEvent' that it monitors if env does not
+    have one. The configuration is a dictionary of the form:
+
+      interval: time between checks (ms); default is the spike accumulator interval or 100 ms;
+        if env already has a spike accumulator, the checks are done at its update interval,
+        and a different interval is an error
+      start: simulation time at which checking starts (ms); default is the equilibration duration
+      populations: { pop_name: { min rate: Hz, max rate: Hz } }
+
+    :param env: :class:'Env'
+    :param bin_size: bin size (ms) of a newly created accumulator; default is the stimulus temporal resolution
+    :return: :class:'ActivityWatchdog'
+    """
+    config = env.activity_watchdog_config
+    if env.spike_accumulator is not None:
+        interval = config.get('interval', None)
+        if (interval is not None) and (float(interval) != env.spike_accumulator.dt_update):
+            raise RuntimeError(f'make_activity_watchdog: interval {interval} ms does not match the update interval '
+                               f'{env.spike_accumulator.dt_update} ms of the existing spike accumulator')
+    else:
+        interval = config.get('interval', env.spike_accumulator_interval)
+        if bin_size is None:
+            bin_size = env.stimulus_config['Temporal Resolution']
+        env.spike_accumulator = SpikeAccumulatorEvent(env, bin_size,
+                                                      dt_update=100.0 if interval is None else float(interval),
+                                                      gid_bin_size=env.spike_accumulator_bin_size)
+    rate_bounds = {}
+    for pop_name, bounds in config['populations'].items():
+        if pop_name not in env.celltypes:
+            raise RuntimeError(f'make_activity_watchdog: unknown population {pop_name}')
+        min_rate = bounds.get('min rate', None)
+        max_rate = bounds.get('max rate', None)
+        rate_bounds[pop_name] = (None if min_rate is None else float(min_rate),
+                                 None if max_rate is None else float(max_rate))
+    t_start = config.get('start', float(env.stimulus_config.get('Equilibration Duration', 0.)))
+    return ActivityWatchdog(env.spike_accumulator, rate_bounds, t_start=t_start)
@@ -1,9 +1,10 @@
 """Classes and procedures related to neuronal connectivity generation. """
 
-import gc, math, time, pprint
+import gc, itertools, math, time, pprint
 from collections import defaultdict
+from functools import partial
 import numpy as np
-from scipy.stats import norm
+from dentate.geometry import SomaDistanceArrays
 from dentate.utils import get_module_logger, list_find_all, random_choice_w_replacement, random_clustered_shuffle, range, str, zip, viewitems
 from neuroh5.io import NeuroH5CellAttrGen, append_graph
 
@@ -12,6 +13,26 @@ from neuroh5.io import NeuroH5CellAttrGen, append_graph
 logger = get_module_logger(__name__)
 
 
+def uv_gaussian_kernel(distance_u, distance_v, offset_u, offset_v, scale_u, scale_v):
+    """
+    Separable Gaussian connection profile along the U and V axes,
+    evaluated elementwise over arrays of distances of any shape. This
+    is the product of two normal probability densities of the offset
+    absolute U and V distances, computed in a single array expression.
+
+    :param distance_u: array of U distances
+    :param distance_v: array of V distances
+    :param offset_u: offset of the profile along U
+    :param offset_v: offset of the profile along V
+    :param scale_u: standard deviation of the profile along U
+    :param scale_v: standard deviation of the profile along V
+    :return: array of float with the broadcast shape of distance_u and distance_v
+    """
+    z_u = (np.abs(distance_u) - offset_u) / scale_u
+    z_v = (np.abs(distance_v) - offset_v) / scale_v
+    return np.exp(-0.5 * (z_u * z_u + z_v * z_v)) / (2. * np.pi * scale_u * scale_v)
+
+
 class ConnectionProb(object):
     """An object of this class will instantiate functions that describe
     the connection probabilities for each presynaptic population. These
@@ -25,7 +46,8 @@ class ConnectionProb(object):
         Warning: This method does not produce an absolute probability. It must be normalized so that the total area
         (volume) under the distribution is 1 before sampling.
         :param destination_population: post-synaptic population name
-        :param soma_distances: a dictionary that contains per-population dicts of u, v distances of cell somas
+        :param soma_distances: a dictionary that contains per-population dicts of u, v distances of cell somas,
+                               or per-population :class:'SomaDistanceArrays'
         :param extent: dict: {source: 'width': (tuple of float), 'offset': (tuple of float)}
         """
         self.destination_population = destination_population
@@ -35,9 +57,13 @@ class ConnectionProb(object):
         self.width = defaultdict(dict)
         self.offset = defaultdict(dict)
         self.scale_factor = defaultdict(dict)
+        self.source_index = {}
 
         for source_population, layer_extents in viewitems(extents):
 
+            if (source_population in soma_coords) and (source_population in soma_distances):
+                self.source_index[source_population] = self.build_source_index(source_population)
+
             for layer, extents in viewitems(layer_extents):
 
                 extent_width = extents['width']
@@ -61,13 +87,11 @@ class ConnectionProb(object):
                                                              'v': float(extent_offset[1])}
 
                 self.p_dist[source_population][layer] = \
-                    (lambda source_population, layer: \
-                         np.vectorize(lambda distance_u, distance_v: \
-                                          (norm.pdf(np.abs(distance_u) - self.offset[source_population][layer]['u'], \
-                                                    scale=self.scale_factor[source_population][layer]['u']) * \
-                                           norm.pdf(np.abs(distance_v) - self.offset[source_population][layer]['v'], \
-                                                    scale=self.scale_factor[source_population][layer]['v'])), \
-                                      otypes=[float]))(source_population, layer)
+                    partial(uv_gaussian_kernel,
+                            offset_u=self.offset[source_population][layer]['u'],
+                            offset_v=self.offset[source_population][layer]['v'],
+                            scale_u=self.scale_factor[source_population][layer]['u'],
+                            scale_v=self.scale_factor[source_population][layer]['v'])
 
                 logger.info(f"population {source_population}: layer: {layer}: \n"
                             f"u width: {self.width[source_population][layer]['u']}\n"
@@ -75,62 +99,135 @@ class ConnectionProb(object):
                             f"u scale_factor: {self.scale_factor[source_population][layer]['u']}\n"
                             f"v scale_factor: {self.scale_factor[source_population][layer]['v']}\n")
 
-    def filter_by_distance(self, destination_gid, source_population, source_layer):
+    def build_source_index(self, source_population):
         """
-        Given the id of a target neuron, returns the distances along u and v
-        and the gids of source neurons whose axons potentially contact the target neuron.
+        Builds a sorted index over the U distances of the somas of the
+        given source population, so that candidate sources for a
+        destination can be obtained by range queries rather than by a
+        scan over all source gids.
 
-        :param destination_gid: int
         :param source_population: string
-        :return: tuple of array of int
+        :return: dict with fields gid, u, v, distance_u, distance_v (arrays in source dictionary order)
+                 and u_order, sorted_distance_u (sort permutation and sorted U distances)
         """
-        destination_coords = self.soma_coords[self.destination_population][destination_gid]
         source_coords = self.soma_coords[source_population]
 
-        destination_distances = self.soma_distances[self.destination_population][destination_gid]
+        source_gids = np.fromiter(source_coords.keys(), dtype=np.uint32, count=len(source_coords))
+        source_u = np.fromiter((coords[0] for coords in source_coords.values()),
+                               dtype=np.float64, count=len(source_coords))
+        source_v = np.fromiter((coords[1] for coords in source_coords.values()),
+                               dtype=np.float64, count=len(source_coords))
+        source_distance_u, source_distance_v = self.get_distances(source_population, source_gids)
+        u_order = np.argsort(source_distance_u, kind='stable')
 
-        source_distances = self.soma_distances[source_population]
+        return {'gid': source_gids, 'u': source_u, 'v': source_v,
+                'distance_u': source_distance_u, 'distance_v': source_distance_v,
+                'u_order': u_order, 'sorted_distance_u': source_distance_u[u_order]}
 
-        destination_u, destination_v, destination_l = destination_coords
-        destination_distance_u, destination_distance_v = destination_distances
+    def get_distances(self, population, gids):
+        """
+        Returns arrays of the U and V soma distances of the given gids
+        of the given population.
 
-        distance_u_lst = []
-        distance_v_lst = []
-        source_u_lst = []
-        source_v_lst = []
-        source_gid_lst = []
+        :param population: string
+        :param gids: array of int
+        :return: tuple of array of float
+        """
+        distances = self.soma_distances[population]
+        if isinstance(distances, SomaDistanceArrays):
+            return distances.lookup(gids)
+        distance_u = np.fromiter((distances[gid][0] for gid in gids), dtype=np.float64, count=len(gids))
+        distance_v = np.fromiter((distances[gid][1] for gid in gids), dtype=np.float64, count=len(gids))
+        return distance_u, distance_v
+
+    def get_source_index(self, source_population):
+        """
+        Returns the sorted source index of the given population,
+        building it on first use.
+        """
+        source_index = self.source_index.get(source_population, None)
+        if source_index is None:
+            source_index = self.build_source_index(source_population)
+            self.source_index[source_population] = source_index
+        return source_index
 
+    def get_layer_key(self, destination_gid, source_population, source_layer):
+        """
+        Returns the key of the extent configuration that applies to
+        the given source layer, falling back to the 'default' layer
+        configuration if there is no layer-specific configuration.
+        """
         if source_layer in self.width[source_population]:
             layer_key = source_layer
         elif 'default' in self.width[source_population]:
             layer_key = 'default'
         else:
             raise RuntimeError(f'connection_generator.get_prob: gid {destination_gid}: missing configuration for {source_population} layer {source_layer}')
+        return layer_key
 
+    def get_max_distances(self, source_population, layer_key):
+        """
+        Returns the maximum U and V distances of source somas from a
+        destination soma for the given source layer configuration.
+        """
         source_width = self.width[source_population][layer_key]
         source_offset = self.offset[source_population][layer_key]
 
         max_distance_u = source_width['u'] + source_offset['u']
         max_distance_v = source_width['v'] + source_offset['v']
 
-        for (source_gid, coords) in viewitems(source_coords):
+        return max_distance_u, max_distance_v
+
+    def filter_by_distance(self, destination_gid, source_population, source_layer):
+        """
+        Given the id of a target neuron, returns the distances along u and v
+        and the gids of source neurons whose axons potentially contact the target neuron.
+
+        :param destination_gid: int
+        :param source_population: string
+        :return: tuple of array of int
+        """
+        destination_coords = self.soma_coords[self.destination_population][destination_gid]
+        destination_distances = self.soma_distances[self.destination_population][destination_gid]
+
+        destination_u, destination_v, destination_l = destination_coords
+        destination_distance_u, destination_distance_v = destination_distances
 
-            source_u, source_v, source_l = coords
+        layer_key = self.get_layer_key(destination_gid, source_population, source_layer)
+        max_distance_u, max_distance_v = self.get_max_distances(source_population, layer_key)
 
-            source_distance_u, source_distance_v = source_distances[source_gid]
+        source_index = self.get_source_index(source_population)
 
-            distance_u = abs(destination_distance_u - source_distance_u)
-            distance_v = abs(destination_distance_v - source_distance_v)
+        ## Range query on the sorted U distances; the window bounds
+        ## are inclusive and the exact distance criterion is applied
+        ## below, so that the candidate set is identical to a full scan.
+        sorted_distance_u = source_index['sorted_distance_u']
+        start = np.searchsorted(sorted_distance_u, destination_distance_u - max_distance_u, side='left')
+        end = np.searchsorted(sorted_distance_u, destination_distance_u + max_distance_u, side='right')
+        ## Candidates are returned in source dictionary order
+        candidate_inds = np.sort(source_index['u_order'][start:end])
 
-            if ((max_distance_u - distance_u) > 0.0) and ((max_distance_v - distance_v) > 0.0):
-                source_u_lst.append(source_u)
-                source_v_lst.append(source_v)
-                distance_u_lst.append(distance_u)
-                distance_v_lst.append(distance_v)
-                source_gid_lst.append(source_gid)
+        distance_u = np.abs(destination_distance_u - source_index['distance_u'][candidate_inds])
+        distance_v = np.abs(destination_distance_v - source_index['distance_v'][candidate_inds])
+        in_range = np.logical_and((max_distance_u - distance_u) > 0.0, (max_distance_v - distance_v) > 0.0)
+        candidate_inds = candidate_inds[in_range]
 
-        return destination_u, destination_v, np.asarray(source_u_lst), np.asarray(source_v_lst), np.asarray(
-            distance_u_lst), np.asarray(distance_v_lst), np.asarray(source_gid_lst, dtype=np.uint32)
+        return destination_u, destination_v, \
+               source_index['u'][candidate_inds], source_index['v'][candidate_inds], \
+               distance_u[in_range], distance_v[in_range], \
+               source_index['gid'][candidate_inds]
+
+    def normalize_prob(self, p):
+        """
+        Normalizes an array of connection probabilities so that it sums to 1.
+        """
+        psum = np.sum(p)
+        assert ((p >= 0.).all() and (p <= 1.).all())
+        if psum > 0.:
+            pn = p / psum
+        else:
+            pn = p
+        return pn
 
     def get_prob(self, destination_gid, source, source_layers):
         """
@@ -147,22 +244,85 @@ class ConnectionProb(object):
         for layer in source_layers:
             destination_u, destination_v, source_u, source_v, distance_u, distance_v, source_gid = \
                 self.filter_by_distance(destination_gid, source, layer)
-            if layer in self.p_dist[source]:
-                layer_key = layer
-            elif 'default' in self.p_dist[source]:
-                layer_key = 'default'
-            else:
-                raise RuntimeError(f'connection_generator.get_prob: gid {destination_gid}: missing configuration for {source} layer {layer}')
+            layer_key = self.get_layer_key(destination_gid, source, layer)
             p = self.p_dist[source][layer_key](distance_u, distance_v)
-            psum = np.sum(p)
-            assert ((p >= 0.).all() and (p <= 1.).all())
-            if psum > 0.:
-                pn = p / p.sum()
-            else:
-                pn = p
+            pn = self.normalize_prob(p)
             prob_dict[layer] = (pn.ravel(), source_gid.ravel(), distance_u.ravel(), distance_v.ravel())
         return prob_dict
 
+    def get_prob_batch(self, destination_gids, source, source_layers, max_matrix_size=2**22):
+        """
+        Batched version of get_prob: evaluates the connection
+        probabilities of a block of destination neurons at once. For
+        each source layer, the destinations are sorted by U distance
+        and split into sub-batches of consecutive destinations; the
+        candidate sources of each sub-batch are obtained with a single
+        range query on the source index, and the connection kernel is
+        evaluated over the (destinations x candidates) distance matrix
+        in one array expression. Sub-batches are grown while this
+        matrix has at most max_matrix_size elements, so that spatially
+        scattered destinations do not result in a matrix that spans
+        most of the source population; a destination whose own
+        candidate window exceeds the limit is evaluated on its own.
+
+        :param destination_gids: list of int
+        :param source: string
+        :param source_layers: list of source layers
+        :param max_matrix_size: maximum number of elements of the distance matrix of a sub-batch
+        :return: dict mapping each destination gid to the result of get_prob for that gid
+
+        """
+        result_dict = {destination_gid: {} for destination_gid in destination_gids}
+        if len(destination_gids) == 0:
+            return result_dict
+
+        destination_distance_u, destination_distance_v = \
+            self.get_distances(self.destination_population, destination_gids)
+        destination_order = np.argsort(destination_distance_u, kind='stable')
+
+        source_index = self.get_source_index(source)
+        sorted_distance_u = source_index['sorted_distance_u']
+
+        for layer in source_layers:
+            layer_key = self.get_layer_key(destination_gids[0], source, layer)
+            max_distance_u, max_distance_v = self.get_max_distances(source, layer_key)
+
+            ## Candidate windows of the individual destinations, in U order
+            starts = np.searchsorted(sorted_distance_u, destination_distance_u[destination_order] - max_distance_u,
+                                     side='left')
+            ends = np.searchsorted(sorted_distance_u, destination_distance_u[destination_order] + max_distance_u,
+                                   side='right')
+
+            batch_start = 0
+            n_destinations = len(destination_order)
+            while batch_start < n_destinations:
+                batch_end = batch_start + 1
+                while (batch_end < n_destinations) and \
+                      ((batch_end + 1 - batch_start) * (ends[batch_end] - starts[batch_start]) <= max_matrix_size):
+                    batch_end += 1
+                batch_inds = destination_order[batch_start:batch_end]
+                start = starts[batch_start]
+                end = np.max(ends[batch_start:batch_end])
+                batch_start = batch_end
+
+                candidate_inds = np.sort(source_index['u_order'][start:end])
+
+                distance_u = np.abs(destination_distance_u[batch_inds, np.newaxis] -
+                                    source_index['distance_u'][candidate_inds][np.newaxis, :])
+                distance_v = np.abs(destination_distance_v[batch_inds, np.newaxis] -
+                                    source_index['distance_v'][candidate_inds][np.newaxis, :])
+                in_range = np.logical_and((max_distance_u - distance_u) > 0.0, (max_distance_v - distance_v) > 0.0)
+                p = self.p_dist[source][layer_key](distance_u, distance_v)
+
+                for i, destination_ind in enumerate(batch_inds):
+                    destination_gid = destination_gids[destination_ind]
+                    in_range_i = in_range[i]
+                    pn = self.normalize_prob(p[i, in_range_i])
+                    result_dict[destination_gid][layer] = (pn, source_index['gid'][candidate_inds[in_range_i]],
+                                                           distance_u[i, in_range_i], distance_v[i, in_range_i])
+
+        return result_dict
+
 
 def choose_synapse_projection(ranstream_syn, syn_layer, swc_type, syn_type, population_dict, projection_synapse_dict,
                               log=False):
@@ -372,7 +532,7 @@ def generate_uv_distance_connections(comm, population_dict, connection_config, c
                                      synapse_seed, connectivity_seed, cluster_seed,
                                      synapse_namespace, connectivity_namespace, connectivity_path,
                                      io_size, chunk_size, value_chunk_size, cache_size, write_size=1,
-                                     dry_run=False, debug=False):
+                                     batch_size=1, dry_run=False, debug=False):
     """
     Generates connectivity based on U, V distance-weighted probabilities.
 
@@ -390,6 +550,7 @@ def generate_uv_distance_connections(comm, population_dict, connection_config, c
     :param value_chunk_size: HDF5 chunk size for connectivity file (value datasets)
     :param cache_size: how many cells to read ahead
     :param write_size: how many cells to write out at the same time
+    :param batch_size: how many destination cells to evaluate connection probabilities for at the same time
     """
 
     rank = comm.rank
@@ -430,74 +591,92 @@ def generate_uv_distance_connections(comm, population_dict, connection_config, c
     gid_count = 0
     connection_dict = defaultdict(lambda: {})
     projection_dict = {}
-    for destination_gid, synapse_dict in NeuroH5CellAttrGen(forest_path, \
-                                                            destination_population, \
-                                                            namespace=synapse_namespace, \
-                                                            comm=comm, io_size=io_size, \
-                                                            cache_size=cache_size):
-        if destination_gid is None:
-            logger.info(f'Rank {rank} destination gid is None')
-        else:
-            logger.info(f'Rank {rank} received attributes for destination: {destination_population}, gid: {destination_gid}')
-
-            ranstream_con.seed(destination_gid + connectivity_seed)
-            ranstream_syn.seed(destination_gid + synapse_seed)
-            last_gid_time = time.time()
-
-            projection_prob_dict = {}
+    attr_iter = iter(NeuroH5CellAttrGen(forest_path, \
+                                        destination_population, \
+                                        namespace=synapse_namespace, \
+                                        comm=comm, io_size=io_size, \
+                                        cache_size=cache_size))
+    done = False
+    while not done:
+        block = list(itertools.islice(attr_iter, batch_size))
+        if len(block) == 0:
+            break
+        block_prob_dict = {}
+        if batch_size > 1:
+            block_gids = [destination_gid for destination_gid, _ in block if destination_gid is not None]
             for source_population in source_populations:
                 source_layers = projection_config[source_population].layers
-                projection_prob_dict[source_population] = \
-                    connection_prob.get_prob(destination_gid, source_population, source_layers)
-
-
-                for layer, (probs, source_gids, distances_u, distances_v) in \
-                        viewitems(projection_prob_dict[source_population]):
-                    if len(distances_u) > 0:
-                        max_u_distance = np.max(distances_u)
-                        min_u_distance = np.min(distances_u)
-                        if rank == 0:
-                            logger.info(f'Rank {rank} has {len(source_gids)} possible sources from population {source_population} '
-                                        f'for destination: {destination_population}, layer {layer}, gid: {destination_gid}; '
-                                        f'max U distance: {max_u_distance:.2f} min U distance: {min_u_distance:.2f}')
-                    else:
-                        logger.warning(f'Rank {rank} has {len(source_gids)} possible sources from population {source_population} '
-                                       f'for destination: {destination_population}, layer {layer}, gid: {destination_gid}')
-
-            count = generate_synaptic_connections(rank,
-                                                  destination_gid,
-                                                  ranstream_syn,
-                                                  ranstream_con,
-                                                  cluster_seed + destination_gid,
-                                                  destination_gid,
-                                                  synapse_dict,
-                                                  population_dict,
-                                                  projection_synapse_dict,
-                                                  projection_prob_dict,
-                                                  connection_dict)
-            total_count += count
-
-            logger.info(f'Rank {rank} took {time.time() - last_gid_time:.2f} s to compute {count} edges for destination: {destination_population}, gid: {destination_gid}')
-
-        if (write_size > 0) and (gid_count % write_size == 0):
-            if len(connection_dict) > 0:
-                projection_dict = {destination_population: connection_dict}
+                block_prob_dict[source_population] = \
+                    connection_prob.get_prob_batch(block_gids, source_population, source_layers)
+        for destination_gid, synapse_dict in block:
+            if destination_gid is None:
+                logger.info(f'Rank {rank} destination gid is None')
             else:
-                projection_dict = {}
-            if not dry_run:
-                last_time = time.time()
-                append_graph(connectivity_path, projection_dict, io_size=io_size, comm=comm, chunk_size=value_chunk_size)
-                if rank == 0:
-                    if connection_dict:
-                        logger.info(f'Appending connectivity for {len(connection_dict)} projections took {time.time() - last_time:.2f} s')
-            projection_dict.clear()
-            connection_dict.clear()
-            gc.collect()
-
-        gid_count += 1
-        it_count += 1
-        if debug and (it_count >= 20):
-            break
+                logger.info(f'Rank {rank} received attributes for destination: {destination_population}, gid: {destination_gid}')
+
+                ranstream_con.seed(destination_gid + connectivity_seed)
+                ranstream_syn.seed(destination_gid + synapse_seed)
+                last_gid_time = time.time()
+
+                projection_prob_dict = {}
+                for source_population in source_populations:
+                    source_layers = projection_config[source_population].layers
+                    if batch_size > 1:
+                        projection_prob_dict[source_population] = \
+                            block_prob_dict[source_population][destination_gid]
+                    else:
+                        projection_prob_dict[source_population] = \
+                            connection_prob.get_prob(destination_gid, source_population, source_layers)
+
+
+                    for layer, (probs, source_gids, distances_u, distances_v) in \
+                            viewitems(projection_prob_dict[source_population]):
+                        if len(distances_u) > 0:
+                            max_u_distance = np.max(distances_u)
+                            min_u_distance = np.min(distances_u)
+                            if rank == 0:
+                                logger.info(f'Rank {rank} has {len(source_gids)} possible sources from population {source_population} '
+                                            f'for destination: {destination_population}, layer {layer}, gid: {destination_gid}; '
+                                            f'max U distance: {max_u_distance:.2f} min U distance: {min_u_distance:.2f}')
+                        else:
+                            logger.warning(f'Rank {rank} has {len(source_gids)} possible sources from population {source_population} '
+                                           f'for destination: {destination_population}, layer {layer}, gid: {destination_gid}')
+
+                count = generate_synaptic_connections(rank,
+                                                      destination_gid,
+                                                      ranstream_syn,
+                                                      ranstream_con,
+                                                      cluster_seed + destination_gid,
+                                                      destination_gid,
+                                                      synapse_dict,
+                                                      population_dict,
+                                                      projection_synapse_dict,
+                                                      projection_prob_dict,
+                                                      connection_dict)
+                total_count += count
+
+                logger.info(f'Rank {rank} took {time.time() - last_gid_time:.2f} s to compute {count} edges for destination: {destination_population}, gid: {destination_gid}')
+
+            if (write_size > 0) and (gid_count % write_size == 0):
+                if len(connection_dict) > 0:
+                    projection_dict = {destination_population: connection_dict}
+                else:
+                    projection_dict = {}
+                if not dry_run:
+                    last_time = time.time()
+                    append_graph(connectivity_path, projection_dict, io_size=io_size, comm=comm, chunk_size=value_chunk_size)
+                    if rank == 0:
+                        if connection_dict:
+                            logger.info(f'Appending connectivity for {len(connection_dict)} projections took {time.time() - last_time:.2f} s')
+                projection_dict.clear()
+                connection_dict.clear()
+                gc.collect()
+
+            gid_count += 1
+            it_count += 1
+            if debug and (it_count >= 20):
+                done = True
+                break
 
 
     gc.collect()
@@ -63,8 +63,11 @@ class Env(object):
                  results_write_time=0, dt=None, ldbal=False, lptbal=False, 
                  cell_selection_path=None, microcircuit_inputs=False,
                  spike_input_path=None, spike_input_namespace=None, spike_input_attr=None,
-                 cleanup=True, cache_queries=False, profile_memory=False, use_coreneuron=False,
-                 transfer_debug=False, verbose=False, **kwargs):
+                 cleanup=True, cache_queries=False, filter_cache_size=10000, columnar_synapses=False, rate_map_cache_dir=None, spike_index_cache_dir=None,
+                 spike_accumulator_interval=None, spike_accumulator_clear_data=False, spike_accumulator_bin_size=None,
+                 activity_watchdog=None,
+                 profile_memory=False,
+                 use_coreneuron=False, transfer_debug=False, verbose=False, **kwargs):
         """
         :param comm: :class:'MPI.COMM_WORLD'
         :param config: str or dict; model configuration file name or dictionary
@@ -91,6 +94,14 @@ class Env(object):
         :param cleanup: bool; clean up auxiliary cell and synapse structures after network init
         :param profile: bool; profile memory usage
         :param cache_queries: bool; whether to use a cache to speed up queries to filter_synapses
+        :param filter_cache_size: int; maximum number of cached filter_synapses query results
+        :param columnar_synapses: bool; whether to store synapse attributes in per-cell columnar arrays
+        :param rate_map_cache_dir: str; path to directory for caching rate maps computed from input selectivity features
+        :param spike_index_cache_dir: str; path to directory for caching input spike trains grouped by gid
+        :param spike_accumulator_interval: float; if not None, interval (ms) at which recorded spikes are accumulated into binned counts during simulation
+        :param spike_accumulator_clear_data: bool; whether to clear the spike vectors after each accumulator update
+        :param spike_accumulator_bin_size: float; if not None, bin size (ms) of the per-gid spike counts of the accumulator; otherwise only per-gid totals are kept
+        :param activity_watchdog: dict or str (path to YAML file); configuration of the activity watchdog that stops simulations with out-of-bounds population firing rates (see activity.make_activity_watchdog)
         :param verbose: bool; print verbose diagnostic messages while constructing the network
         """
         self.kwargs = kwargs
@@ -213,6 +224,28 @@ class Env(object):
             
         # cache queries to filter_synapses
         self.cache_queries = cache_queries
+        self.filter_cache_size = filter_cache_size
+
+        # store synapse attributes in per-cell columnar arrays
+        self.columnar_synapses = columnar_synapses
+
+        # directory for cached rate maps of input cells
+        self.rate_map_cache_dir = rate_map_cache_dir
+
+        # directory for cached input spike trains grouped by gid
+        self.spike_index_cache_dir = spike_index_cache_dir
+
+        # interval in ms of simulation time for in-simulation spike accumulation
+        self.spike_accumulator_interval = float(spike_accumulator_interval) \
+            if spike_accumulator_interval is not None else None
+        self.spike_accumulator_clear_data = spike_accumulator_clear_data
+        self.spike_accumulator_bin_size = float(spike_accumulator_bin_size) \
+            if spike_accumulator_bin_size is not None else None
+
+        # configuration of the activity watchdog for early termination of simulations
+        if isinstance(activity_watchdog, str):
+            activity_watchdog = read_from_yaml(activity_watchdog)
+        self.activity_watchdog_config = activity_watchdog
 
         self.config_prefix = config_prefix
         self.model_config = {}
@@ -397,15 +430,23 @@ class Env(object):
         self.LFP_config = {}
         if 'Recording' in self.model_config:
             for label, config in viewitems(self.model_config['Recording']['LFP']):
-                self.LFP_config[label] = {'position': tuple(config['position']),
-                                          'maxEDist': config['maxEDist'],
+                self.LFP_config[label] = {'maxEDist': config['maxEDist'],
                                           'fraction': config['fraction'],
                                           'rho': config['rho'],
-                                          'dt': config['dt']}
+                                          'dt': config['dt'],
+                                          'vectorized': config.get('vectorized', False),
+                                          'buffered': config.get('buffered', False)}
+                if 'positions' in config:
+                    ## multi-electrode array
+                    self.LFP_config[label]['positions'] = [tuple(pos) for pos in config['positions']]
+                else:
+                    self.LFP_config[label]['position'] = tuple(config['position'])
 
 
         self.t_vec = None
         self.id_vec = None
+        # number of recorded spikes already written by io_utils.spikeout
+        self.spike_output_offset = 0
         self.t_rec = None
         self.recs_dict = {}  # Intracellular samples on this host
         self.recs_count = 0
@@ -420,6 +461,8 @@ class Env(object):
         self.connectgjstime = 0
 
         self.simtime = None
+        self.spike_accumulator = None
+        self.activity_watchdog = None
         self.lfp = {}
 
         self.edge_count = defaultdict(dict)
@@ -589,7 +632,9 @@ class Env(object):
         syn_mech_names = connection_config['Synapse Mechanisms']
         syn_param_rules = connection_config['Synapse Parameter Rules']
 
-        self.synapse_attributes = SynapseAttributes(self, syn_mech_names, syn_param_rules)
+        self.synapse_attributes = SynapseAttributes(self, syn_mech_names, syn_param_rules,
+                                                    columnar=self.columnar_synapses,
+                                                    filter_cache_size=self.filter_cache_size)
 
         extent_config = connection_config['Axon Extent']
         self.connection_extents = {}
@@ -868,6 +913,7 @@ class Env(object):
             self.t_vec.resize(0)
         if self.id_vec is not None:
             self.id_vec.resize(0)
+        self.spike_output_offset = 0
         if self.t_rec is not None:
             self.t_rec.resize(0)
         self.recs_dict = {}
@@ -5,9 +5,9 @@ from collections import defaultdict
 
 import numpy as np
 from scipy.spatial import cKDTree
-from scipy.spatial.distance import euclidean
 
 from dentate import cells
+from dentate.geometry import SomaDistanceArrays
 from dentate.neuron_utils import h, load_cell_template
 from dentate.utils import get_module_logger, viewitems
 from neuroh5.io import append_graph, read_tree_selection
@@ -25,28 +25,79 @@ logger = get_module_logger(__name__)
 ## Basal_weights       = [25;75;125;175]*linear_coeff(1) + linear_coeff(2);
 
 
-def filter_by_distance(gids_a, coords_a, gids_b, coords_b, bounds, params):
-    coords_tree_a = cKDTree(coords_a)
+def gj_candidates(gids_a, coords_a, gids_b, coords_b, bounds, params, rank=0, size=1):
+    """
+    Finds the pairs of cells from populations A and B whose somas are
+    within the maximum distance given by bounds, and computes their
+    coupling probabilities with the polynomial given by params.
+
+    Only the cells of population A with gid % size == rank are
+    queried, against a KD-tree of the soma coordinates of population
+    B. Candidates are returned in order of gid_a, and for each gid_a in
+    order of the rows of coords_b.
+
+    :return: tuple of arrays (gid_a, gid_b, distance, probability)
+    """
+    gids_a = np.asarray(gids_a)
+    gids_b = np.asarray(gids_b)
+    coords_a = np.asarray(coords_a, dtype=np.float64).reshape((len(gids_a), -1))
+    coords_b = np.asarray(coords_b, dtype=np.float64).reshape((len(gids_b), -1))
+
+    local_idxs = np.flatnonzero((gids_a % size) == rank)
+    if (len(local_idxs) == 0) or (len(gids_b) == 0):
+        return (np.zeros((0,), dtype=np.uint32), np.zeros((0,), dtype=np.uint32),
+                np.zeros((0,), dtype=np.float32), np.zeros((0,), dtype=np.float32))
+
     coords_tree_b = cKDTree(coords_b)
+    nns = coords_tree_b.query_ball_point(coords_a[local_idxs], bounds[1], return_sorted=True)
+    nn_counts = np.fromiter((len(nn) for nn in nns), dtype=np.int64, count=len(nns))
+    nn_idxs_a = np.repeat(local_idxs, nn_counts)
+    nn_idxs_b = np.fromiter((i for nn in nns for i in nn), dtype=np.int64, count=int(np.sum(nn_counts)))
+
+    nn_diffs = coords_a[nn_idxs_a] - coords_b[nn_idxs_b]
+    nn_dists = np.sqrt(np.add.reduce(nn_diffs * nn_diffs, axis=1))
+    nz = nn_dists > 0.0
+    nn_dists = nn_dists[nz]
+    nn_probs = np.polyval(params, nn_dists)
+
+    return (np.asarray(gids_a[nn_idxs_a[nz]], dtype=np.uint32),
+            np.asarray(gids_b[nn_idxs_b[nz]], dtype=np.uint32),
+            np.asarray(nn_dists, dtype=np.float32),
+            np.asarray(nn_probs, dtype=np.float32))
+
 
-    res = coords_tree_a.query_ball_tree(coords_tree_b, bounds[1])
+def filter_by_distance(gids_a, coords_a, gids_b, coords_b, bounds, params, rank=0, size=1):
+    """
+    Finds the pairs of cells from populations A and B whose somas are
+    within the maximum distance given by bounds, and computes their
+    coupling probabilities with the polynomial given by params (see
+    gj_candidates). If size > 1, only the cells of population A with
+    gid % size == rank are considered.
+
+    coords_a and coords_b may be arrays of soma coordinates, or
+    :class:'SomaDistanceArrays' instances, in which case the U and V
+    soma distances are used as coordinates and the corresponding gid
+    arguments may be None.
+
+    :return: dict { gid_a: (array of gid_b, array of distances, array of probabilities) }
+    """
+    if isinstance(coords_a, SomaDistanceArrays):
+        if gids_a is None:
+            gids_a = coords_a.gids
+        coords_a = coords_a.coords()
+    if isinstance(coords_b, SomaDistanceArrays):
+        if gids_b is None:
+            gids_b = coords_b.gids
+        coords_b = coords_b.coords()
+
+    nn_gids_a, nn_gids_b, nn_dists, nn_probs = \
+        gj_candidates(gids_a, coords_a, gids_b, coords_b, bounds, params, rank=rank, size=size)
 
     res_dict = {}
-    for i, nns in enumerate(res):
-        gid_a = gids_a[i]
-        nngids = []
-        nndists = []
-        nnprobs = []
-        for nn in nns:
-            nndist = euclidean(coords_a[i], coords_b[nn])
-            if nndist > 0.0:
-                nndists.append(nndist)
-                nnprobs.append(np.polyval(params, nndist))
-                nngids.append(gids_b[nn])
-        if len(nngids) > 0:
-            res_dict[gid_a] = (np.asarray(nngids, dtype=np.uint32), \
-                               np.asarray(nndists, dtype=np.float32), \
-                               np.asarray(nnprobs, dtype=np.float32))
+    gids, starts = np.unique(nn_gids_a, return_index=True)
+    ends = np.append(starts[1:], len(nn_gids_a))
+    for gid_a, start, end in zip(gids, starts, ends):
+        res_dict[gid_a] = (nn_gids_b[start:end], nn_dists[start:end], nn_probs[start:end])
 
     return res_dict
 
@@ -61,7 +112,7 @@ def distance_to_root(root, sec, loc):
 
     distance += loc * sec.L
 
-    while h.SectionRef(sec=sec).has_parent == 1:
+    while h.SectionRef(sec=sec).has_parent() == 1:
         sec = h.SectionRef(sec=sec).parent
         distance += sec.L
     distance -= 0.5 * sec.L
@@ -69,11 +120,123 @@ def distance_to_root(root, sec, loc):
     return distance
 
 
+class NeurotreeMorphology(object):
+    """
+    Section lengths and topology of a cell, computed with NumPy from
+    its neurotree dictionary, following the section construction of
+    the neuroh5 cell templates: section s consists of the points
+    section_topology['nodes'][s], has the SWC type of its last point,
+    and is attached to the parent section given by the src entry of
+    the topology arrays. Provides the parts of the hoc cell interface
+    needed to choose gap junction locations (apicalidx, basalidx and
+    distance_to_root) without instantiating NEURON sections.
+    """
+
+    def __init__(self, neurotree_dict, gid=None):
+        self.gid = gid
+        secnodes = neurotree_dict['section_topology']['nodes']
+        n_sections = len(secnodes)
+        swc_type = np.asarray(neurotree_dict['swc_type'])
+        ## Point coordinates are stored by NEURON in single precision
+        pts = np.column_stack((np.asarray(neurotree_dict['x'], dtype=np.float32),
+                               np.asarray(neurotree_dict['y'], dtype=np.float32),
+                               np.asarray(neurotree_dict['z'], dtype=np.float32))).astype(np.float64)
+
+        self.L = np.zeros((n_sections,), dtype=np.float64)
+        section_swc_types = np.zeros((n_sections,), dtype=swc_type.dtype)
+        for sec in range(n_sections):
+            nodes = np.asarray(secnodes[sec])
+            sec_pts = pts[nodes]
+            if len(nodes) > 1:
+                self.L[sec] = np.sum(np.sqrt(np.sum(np.diff(sec_pts, axis=0) ** 2, axis=1)))
+            section_swc_types[sec] = swc_type[nodes[-1]]
+
+        self.parent = np.full((n_sections,), -1, dtype=np.int64)
+        vsrc = np.asarray(neurotree_dict['section_topology']['src'], dtype=np.int64)
+        vdst = np.asarray(neurotree_dict['section_topology']['dst'], dtype=np.int64)
+        self.parent[vdst] = vsrc
+
+        self.apicalidx = np.flatnonzero(section_swc_types == 4)
+        self.basalidx = np.flatnonzero(section_swc_types == 3)
+
+    def distance_to_root(self, secidx, loc):
+        """
+        Returns the distance from the given section location to the
+        middle of the root section, as computed by distance_to_root
+        for the corresponding hoc cell.
+        """
+        distance = loc * self.L[secidx]
+        sec = secidx
+        while self.parent[sec] >= 0:
+            sec = self.parent[sec]
+            distance += self.L[sec]
+        distance -= 0.5 * self.L[sec]
+        return distance
+
+
+def check_neurotree_morphology(template_class, gid, tree_dict):
+    """
+    Instantiates a hoc cell of the given template from a neurotree
+    dictionary and compares its section layout with the corresponding
+    :class:'NeurotreeMorphology': the number of sections, the apical
+    and basal section indices, and the distance of the middle of each
+    section to the root. Returns a list of descriptions of the
+    differences, which is empty if the layouts agree.
+    """
+    morph = NeurotreeMorphology(tree_dict, gid=gid)
+    cell = cells.make_neurotree_hoc_cell(template_class, neurotree_dict=tree_dict, gid=gid)
+    sections = list(cell.sections)
+    mismatches = []
+    if len(sections) != len(morph.L):
+        mismatches.append(f'{len(sections)} template sections, {len(morph.L)} neurotree sections')
+    if not np.array_equal(np.asarray(cell.apicalidx.to_python(), dtype=np.int64), morph.apicalidx):
+        mismatches.append('apical section indices differ')
+    if not np.array_equal(np.asarray(cell.basalidx.to_python(), dtype=np.int64), morph.basalidx):
+        mismatches.append('basal section indices differ')
+    if len(mismatches) == 0:
+        hoc_distances = np.asarray([distance_to_root(cell.soma, sec, 0.5) for sec in sections])
+        morph_distances = np.asarray([morph.distance_to_root(secidx, 0.5) for secidx in range(len(sections))])
+        if not np.allclose(hoc_distances, morph_distances, rtol=1e-5, atol=1e-3):
+            mismatches.append('section distances to root differ')
+    return mismatches
+
+
+class LazyCellDict(dict):
+    """
+    Dictionary of cells that are constructed on first access, from the
+    neurotree dictionaries of the given gids.
+    """
+
+    def __init__(self, make_cell):
+        super().__init__()
+        self.make_cell = make_cell
+        self.tree_dicts = {}
+
+    def __missing__(self, gid):
+        cell = self.make_cell(gid, self.tree_dicts.pop(gid))
+        self[gid] = cell
+        return cell
+
+
 def choose_gj_locations(ranstream_gj, cell_a, cell_b):
-    apical_sections_a = cell_a.apicalidx.to_python()
-    basal_sections_a = cell_a.basalidx.to_python()
-    apical_sections_b = cell_b.apicalidx.to_python()
-    basal_sections_b = cell_b.basalidx.to_python()
+    """
+    Randomly chooses the sections and positions of a gap junction
+    between the given cells, which may be hoc cells or
+    :class:'NeurotreeMorphology' instances, and returns them together
+    with the distances of the locations to the root of each cell.
+    """
+    if isinstance(cell_a, NeurotreeMorphology):
+        apical_sections_a = cell_a.apicalidx
+        basal_sections_a = cell_a.basalidx
+    else:
+        apical_sections_a = cell_a.apicalidx.to_python()
+        basal_sections_a = cell_a.basalidx.to_python()
+    if isinstance(cell_b, NeurotreeMorphology):
+        apical_sections_b = cell_b.apicalidx
+        basal_sections_b = cell_b.basalidx
+    else:
+        apical_sections_b = cell_b.apicalidx.to_python()
+        basal_sections_b = cell_b.basalidx.to_python()
 
     if ((len(apical_sections_a) > 0) and
             (len(basal_sections_a) > 0) and
@@ -98,14 +261,17 @@ def choose_gj_locations(ranstream_gj, cell_a, cell_b):
     else:
         raise ValueError('Cells with incompatible section types')
 
-    section_a = list(cell_a.sections)[sectionidx_a]
-    section_b = list(cell_b.sections)[sectionidx_b]
-
     position_a = max(ranstream_gj.random_sample(), 0.01)
     position_b = max(ranstream_gj.random_sample(), 0.01)
 
-    distance_a = distance_to_root(cell_a.soma, section_a, position_a)
-    distance_b = distance_to_root(cell_b.soma, section_b, position_b)
+    if isinstance(cell_a, NeurotreeMorphology):
+        distance_a = cell_a.distance_to_root(sectionidx_a, position_a)
+    else:
+        distance_a = distance_to_root(cell_a.soma, list(cell_a.sections)[sectionidx_a], position_a)
+    if isinstance(cell_b, NeurotreeMorphology):
+        distance_b = cell_b.distance_to_root(sectionidx_b, position_b)
+    else:
+        distance_b = distance_to_root(cell_b.soma, list(cell_b.sections)[sectionidx_b], position_b)
 
     return sectionidx_a, position_a, distance_a, sectionidx_b, position_b, distance_b
 
@@ -169,7 +335,7 @@ def generate_gap_junctions(connection_prob, coupling_coeffs, coupling_params, ra
 def generate_gj_connections(env, forest_path, soma_coords_dict,
                             gj_config_dict, gj_seed, connectivity_namespace, connectivity_path,
                             io_size, chunk_size, value_chunk_size, cache_size,
-                            dry_run=False):
+                            dry_run=False, hoc_cells=True):
     """Generates gap junction connectivity based on Euclidean-distance-weighted probabilities.
     :param gj_config: connection configuration object (instance of env.GapjunctionConfig)
     :param gj_seed: random seed for determining gap junction connectivity
@@ -179,6 +345,10 @@ def generate_gj_connections(env, forest_path, soma_coords_dict,
     :param chunk_size: HDF5 chunk size for connectivity file (pointer and index datasets)
     :param value_chunk_size: HDF5 chunk size for connectivity file (value datasets)
     :param cache_size: how many cells to read ahead
+    :param hoc_cells: if True, gap junction locations are chosen on instantiated hoc cells rather than on
+                      morphologies computed directly from the neurotree dictionaries (see NeurotreeMorphology);
+                      in the latter case, the section layout of one cell of each population is checked
+                      against its hoc template (see check_neurotree_morphology)
     """
 
     comm = env.comm
@@ -223,68 +393,63 @@ def generate_gj_connections(env, forest_path, soma_coords_dict,
         load_cell_template(env, population_b, bcast_template=True)
         template_class_a = getattr(h, template_name_a)
         template_class_b = getattr(h, template_name_b)
-
-        clst_a = []
-        gid_a = []
-        for (gid, coords) in viewitems(soma_coords_dict[population_a]):
-            clst_a.append(np.asarray(coords))
-            gid_a.append(gid)
-        gid_a = np.asarray(gid_a)
-
-        sortidx_a = np.argsort(gid_a)
-        coords_a = np.asarray([clst_a[i] for i in sortidx_a])
-
-        clst_b = []
-        gid_b = []
-        for (gid, coords) in viewitems(soma_coords_dict[population_b]):
-            clst_b.append(np.asarray(coords))
-            gid_b.append(gid)
-        gid_b = np.asarray(gid_b)
-
-        sortidx_b = np.argsort(gid_b)
-        coords_b = np.asarray([clst_b[i] for i in sortidx_b])
-
-        gj_prob_dict = filter_by_distance(gid_a[sortidx_a], coords_a,
-                                          gid_b[sortidx_b], coords_b,
-                                          connection_bounds,
-                                          connection_params)
-
-        gj_probs = []
-        gj_distances = []
-        gids_a = []
-        gids_b = []
-        for gid, v in viewitems(gj_prob_dict):
-            if gid % size == rank:
-                (nngids, nndists, nnprobs) = v
-                gids_a.append(np.full(nngids.shape, gid, np.int32))
-                gids_b.append(nngids)
-                gj_probs.append(nnprobs)
-                gj_distances.append(nndists)
-
-        gids_a = np.concatenate(gids_a)
-        gids_b = np.concatenate(gids_b)
-        gj_probs = np.concatenate(gj_probs)
+        if hoc_cells:
+            make_cell_a = lambda gid, tree_dict: \
+                cells.make_neurotree_hoc_cell(template_class_a, neurotree_dict=tree_dict, gid=gid)
+            make_cell_b = lambda gid, tree_dict: \
+                cells.make_neurotree_hoc_cell(template_class_b, neurotree_dict=tree_dict, gid=gid)
+        else:
+            make_cell_a = lambda gid, tree_dict: NeurotreeMorphology(tree_dict, gid=gid)
+            make_cell_b = make_cell_a
+
+        gid_a = np.fromiter(soma_coords_dict[population_a].keys(), dtype=np.uint32)
+        coords_a = np.asarray(list(soma_coords_dict[population_a].values()), dtype=np.float64).reshape((len(gid_a), -1))
+        sortidx_a = np.argsort(gid_a, kind='stable')
+
+        gid_b = np.fromiter(soma_coords_dict[population_b].keys(), dtype=np.uint32)
+        coords_b = np.asarray(list(soma_coords_dict[population_b].values()), dtype=np.float64).reshape((len(gid_b), -1))
+        sortidx_b = np.argsort(gid_b, kind='stable')
+
+        ## Each rank queries only the candidates of its own gids in population A
+        gids_a, gids_b, gj_distances, gj_probs = gj_candidates(gid_a[sortidx_a], coords_a[sortidx_a],
+                                                               gid_b[sortidx_b], coords_b[sortidx_b],
+                                                               connection_bounds, connection_params,
+                                                               rank=rank, size=size)
         gj_probs = gj_probs / gj_probs.sum()
-        gj_distances = np.concatenate(gj_distances)
-        gids_a = np.asarray(gids_a, dtype=np.uint32)
-        gids_b = np.asarray(gids_b, dtype=np.uint32)
 
-        cell_dict_a = {}
+        ## Cells are constructed when first chosen for a gap junction
+        cell_dict_a = LazyCellDict(make_cell_a)
         selection_a = set(gids_a)
         if rank == 0:
             logger.info(f"Reading tree selection of population {pp[0]} ({len(selection_a)} cells)...")
         (tree_iter_a, _) = read_tree_selection(forest_path, population_a, list(selection_a))
         for (gid, tree_dict) in tree_iter_a:
-            cell_dict_a[gid] = cells.make_neurotree_hoc_cell(template_class_a, neurotree_dict=tree_dict, gid=gid)
+            cell_dict_a.tree_dicts[gid] = tree_dict
 
-        cell_dict_b = {}
+        cell_dict_b = LazyCellDict(make_cell_b)
         selection_b = set(gids_b)
         if rank == 0:
             logger.info(f"Reading tree selection of population {pp[1]} ({len(selection_b)} cells)...")
 
         (tree_iter_b, _) = read_tree_selection(forest_path, population_b, list(selection_b))
         for (gid, tree_dict) in tree_iter_b:
-            cell_dict_b[gid] = cells.make_neurotree_hoc_cell(template_class_b, neurotree_dict=tree_dict, gid=gid)
+            cell_dict_b.tree_dicts[gid] = tree_dict
+
+        if not hoc_cells:
+            ## The NumPy morphologies follow the section layout of the
+            ## neuroh5 templates; other templates may order or classify
+            ## sections differently.
+            for population, template_class, tree_dicts in [(population_a, template_class_a, cell_dict_a.tree_dicts),
+                                                           (population_b, template_class_b, cell_dict_b.tree_dicts)]:
+                mismatches = []
+                if len(tree_dicts) > 0:
+                    check_gid = min(tree_dicts.keys())
+                    mismatches = check_neurotree_morphology(template_class, check_gid, tree_dicts[check_gid])
+                all_mismatches = [m for rank_mismatches in comm.allgather(mismatches) for m in rank_mismatches]
+                if len(all_mismatches) > 0:
+                    raise RuntimeError(f'generate_gj_connections: section layout of population {population} '
+                                       f'differs from template {env.celltypes[population]["template"]}: '
+                                       f'{"; ".join(sorted(set(all_mismatches)))}; use hoc_cells=True')
 
         if rank == 0:
             logger.info(f"Generating gap junction pairs between populations {pp[0]} and {pp[1]}...")
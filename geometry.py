@@ -381,8 +381,129 @@ def get_volume_distances(ip_vol, origin_spec=None, nsample=1000, alpha_radius=12
     return (origin_ranges, obs_uvl, distances_u, distances_v)
 
 
+def uvl_in_bounds_array(uvl_coords, layer_extents, pop_layers):
+    """
+    Array version of uvl_in_bounds: returns a boolean array that
+    indicates which rows of the given (N, 3) array of U, V, L
+    coordinates are within the extents of any layer of the population.
+    """
+    uvl_coords = np.asarray(uvl_coords).reshape((-1, 3))
+    result = np.zeros((uvl_coords.shape[0],), dtype=bool)
+    for layer, count in viewitems(pop_layers):
+        if count > 0:
+            min_extent = np.asarray(layer_extents[layer][0])
+            max_extent = np.asarray(layer_extents[layer][1])
+            result |= np.all((uvl_coords < (max_extent + 0.001)) &
+                             (uvl_coords > (min_extent - 0.001)), axis=1)
+    return result
+
+
+class SomaDistanceArrays(object):
+    """Columnar representation of the soma arc distances of the cells of a population.
+
+    The gids are stored in sorted order, together with the U and V
+    distances of the corresponding somas, as contiguous arrays. For
+    compatibility with the dictionary representation returned by
+    `interp_soma_distances`, instances also support read-only mapping
+    access of the form { gid: (distance_U, distance_V) }.
+
+    Parameters
+    ----------
+    gids : array of int
+        Cell identifiers
+    distance_u : array of float
+        Arc distances along the first dimension of the volume
+    distance_v : array of float
+        Arc distances along the second dimension of the volume
+    """
+
+    def __init__(self, gids, distance_u, distance_v):
+        gids = np.asarray(gids, dtype=np.uint32).reshape((-1,))
+        distance_u = np.asarray(distance_u, dtype=np.float64).reshape((-1,))
+        distance_v = np.asarray(distance_v, dtype=np.float64).reshape((-1,))
+        if not (gids.shape == distance_u.shape == distance_v.shape):
+            raise ValueError(f'SomaDistanceArrays: mismatched array lengths: {len(gids)} gids, '
+                             f'{len(distance_u)} U distances, {len(distance_v)} V distances')
+        order = np.argsort(gids, kind='stable')
+        self.gids = gids[order]
+        self.distance_u = distance_u[order]
+        self.distance_v = distance_v[order]
+
+    @classmethod
+    def from_dict(cls, dist_dict):
+        """
+        Creates a columnar representation from a dictionary of the form { gid: (distance_U, distance_V) }.
+        """
+        n = len(dist_dict)
+        gids = np.fromiter(dist_dict.keys(), dtype=np.uint32, count=n)
+        distance_u = np.fromiter((v[0] for v in dist_dict.values()), dtype=np.float64, count=n)
+        distance_v = np.fromiter((v[1] for v in dist_dict.values()), dtype=np.float64, count=n)
+        return cls(gids, distance_u, distance_v)
+
+    def index(self, gids):
+        """
+        Returns the positions of the given gids in the sorted gid
+        array, or -1 for gids that are not present.
+        """
+        gids = np.asarray(gids, dtype=np.uint32).reshape((-1,))
+        if len(self.gids) == 0:
+            return np.full(gids.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.gids, gids), len(self.gids) - 1)
+        return np.where(self.gids[pos] == gids, pos, -1)
+
+    def lookup(self, gids):
+        """
+        Returns arrays of the U and V distances of the given gids.
+        Raises KeyError if any of the gids is not present.
+        """
+        pos = self.index(gids)
+        if np.any(pos < 0):
+            missing = np.asarray(gids).reshape((-1,))[pos < 0]
+            raise KeyError(f'SomaDistanceArrays: gids not found: {missing[:10]}')
+        return self.distance_u[pos], self.distance_v[pos]
+
+    def coords(self):
+        """
+        Returns an (N, 2) array of the U and V distances, in sorted gid order.
+        """
+        return np.column_stack((self.distance_u, self.distance_v))
+
+    def to_dict(self):
+        """
+        Returns the dictionary representation { gid: (distance_U, distance_V) }.
+        """
+        return dict(self.items())
+
+    def __len__(self):
+        return len(self.gids)
+
+    def __contains__(self, gid):
+        return self.index([gid])[0] >= 0
+
+    def __getitem__(self, gid):
+        pos = self.index([gid])[0]
+        if pos < 0:
+            raise KeyError(gid)
+        return (self.distance_u[pos], self.distance_v[pos])
+
+    def get(self, gid, default=None):
+        pos = self.index([gid])[0]
+        if pos < 0:
+            return default
+        return (self.distance_u[pos], self.distance_v[pos])
+
+    def __iter__(self):
+        return iter(self.gids)
+
+    def keys(self):
+        return iter(self.gids)
+
+    def items(self):
+        return zip(self.gids, zip(self.distance_u, self.distance_v))
+
+
 def interp_soma_distances(comm, ip_dist_u, ip_dist_v, soma_coords, layer_extents, population_layers, 
-                          interp_chunk_size=1000, populations=None, allgather=False):
+                          interp_chunk_size=1000, populations=None, allgather=False, columnar=False):
     """Interpolates path lengths of cell coordinates along the dimensions of an `RBFVolume` instance.
 
     Parameters
@@ -405,12 +526,20 @@ def interp_soma_distances(comm, ip_dist_u, ip_dist_v, soma_coords, layer_extents
          { layer_name: count }
     allgather: boolean (default: False)
        if True, the results are gathered from all ranks and combined
+    columnar: boolean (default: False)
+       if True, the distances of each population are returned as a
+       `SomaDistanceArrays` instance, and are gathered with Allgatherv
+       on the gid and distance arrays
     Returns
     -------
     A dictionary of the form:
 
       { population: { gid: (distance_U, distance_V } }
 
+    or, if columnar is True:
+
+      { population: SomaDistanceArrays }
+
     """
 
     rank = comm.rank
@@ -424,55 +553,65 @@ def interp_soma_distances(comm, ip_dist_u, ip_dist_v, soma_coords, layer_extents
         coords_dict = soma_coords[pop]
         if rank == 0:
             logger.info('Computing soma distances for %d cells from population %s...' % (len(coords_dict), pop))
-        count = 0
-        local_dist_dict = {}
         pop_layer = population_layers[pop]
-        u_obs = []
-        v_obs = []
-        gids = []
-        for gid, coords in viewitems(coords_dict):
-            if gid % size == rank:
-                soma_u, soma_v, soma_l = coords
-                try:
-                    assert(uvl_in_bounds(coords, layer_extents, pop_layer))
-                except Exception as e:
-                    logger.error("gid %i: out of limits error for coordinates: %f %f %f)" % \
-                                 (gid, soma_u, soma_v, soma_l))
-                    raise e
-
-                u_obs.append(np.array([soma_u, soma_v, soma_l]).ravel())
-                v_obs.append(np.array([soma_u, soma_v, soma_l]).ravel())
-                gids.append(gid)
-        if len(u_obs) > 0:
-            u_obs_array = np.vstack(u_obs)
-            v_obs_array = np.vstack(v_obs)
-            distance_u_obs = ip_dist_u(u_obs_array).reshape(-1, 1)
-            distance_v_obs = ip_dist_v(v_obs_array).reshape(-1, 1)
-            distance_u = np.mean(distance_u_obs, axis=1)
-            distance_v = np.mean(distance_v_obs, axis=1)
+        n_coords = len(coords_dict)
+        all_gids = np.fromiter(coords_dict.keys(), dtype=np.uint32, count=n_coords)
+        gid_mask = (all_gids % size) == rank
+        gids = all_gids[gid_mask]
+        uvl_obs_array = np.fromiter((x for (gid, coords) in viewitems(coords_dict) if gid % size == rank
+                                     for x in coords[:3]), dtype=np.float64, count=3 * len(gids)).reshape((-1, 3))
+
+        in_bounds = uvl_in_bounds_array(uvl_obs_array, layer_extents, pop_layer)
+        if not np.all(in_bounds):
+            i = np.flatnonzero(np.logical_not(in_bounds))[0]
+            soma_u, soma_v, soma_l = uvl_obs_array[i]
+            logger.error("gid %i: out of limits error for coordinates: %f %f %f)" % \
+                         (gids[i], soma_u, soma_v, soma_l))
+            raise RuntimeError(f'interp_soma_distances: population {pop}: gid {gids[i]}: coordinates out of bounds')
+
+        distance_u = np.zeros((0,), dtype=np.float64)
+        distance_v = np.zeros((0,), dtype=np.float64)
+        if len(gids) > 0:
+            distance_u = np.asarray(ip_dist_u(uvl_obs_array), dtype=np.float64).reshape((-1,))
+            distance_v = np.asarray(ip_dist_v(uvl_obs_array), dtype=np.float64).reshape((-1,))
             try:
                 assert (np.all(np.isfinite(distance_u)))
                 assert (np.all(np.isfinite(distance_v)))
             except Exception as e:
                 u_nan_idxs = np.where(np.isnan(distance_u))[0]
                 v_nan_idxs = np.where(np.isnan(distance_v))[0]
-                logger.error('Invalid distances: u: %s; v: %s', str(u_obs_array[u_nan_idxs]),
-                             str(v_obs_array[v_nan_idxs]))
+                logger.error('Invalid distances: u: %s; v: %s', str(uvl_obs_array[u_nan_idxs]),
+                             str(uvl_obs_array[v_nan_idxs]))
                 raise e
-
-        for (i, gid) in enumerate(gids):
-            local_dist_dict[gid] = (distance_u[i], distance_v[i])
             if rank == 0:
-                logger.info('gid %i: distances: %f %f' % (gid, distance_u[i], distance_v[i]))
-        if allgather:
-            dist_dicts = comm.allgather(local_dist_dict)
-            combined_dist_dict = {}
-            for dist_dict in dist_dicts:
-                for k, v in viewitems(dist_dict):
-                    combined_dist_dict[k] = v
-            soma_distances[pop] = combined_dist_dict
+                logger.info('Computed distances for %d cells from population %s on rank 0: '
+                            'U range: %f - %f; V range: %f - %f' %
+                            (len(gids), pop, np.min(distance_u), np.max(distance_u),
+                             np.min(distance_v), np.max(distance_v)))
+
+        if columnar:
+            if allgather:
+                counts = np.asarray(comm.allgather(len(gids)), dtype=np.int64)
+                n_total = int(np.sum(counts))
+                recv_gids = np.empty((n_total,), dtype=np.uint32)
+                recv_distance_u = np.empty((n_total,), dtype=np.float64)
+                recv_distance_v = np.empty((n_total,), dtype=np.float64)
+                comm.Allgatherv(gids, [recv_gids, counts])
+                comm.Allgatherv(distance_u, [recv_distance_u, counts])
+                comm.Allgatherv(distance_v, [recv_distance_v, counts])
+                gids, distance_u, distance_v = recv_gids, recv_distance_u, recv_distance_v
+            soma_distances[pop] = SomaDistanceArrays(gids, distance_u, distance_v)
         else:
-            soma_distances[pop] = local_dist_dict
+            local_dist_dict = { gid: (distance_u[i], distance_v[i]) for (i, gid) in enumerate(gids.tolist()) }
+            if allgather:
+                dist_dicts = comm.allgather(local_dist_dict)
+                combined_dist_dict = {}
+                for dist_dict in dist_dicts:
+                    for k, v in viewitems(dist_dict):
+                        combined_dist_dict[k] = v
+                soma_distances[pop] = combined_dist_dict
+            else:
+                soma_distances[pop] = local_dist_dict
 
     return soma_distances
 
@@ -553,7 +692,8 @@ def make_distance_interpolant(env, resolution=[30, 30, 10], nsample=1000):
     return origin_ranges, ip_dist_u, ip_dist_v
     
 
-def measure_distances(env, soma_coords, ip_dist, resolution=[30, 30, 10], interp_chunk_size=1000, allgather=False):
+def measure_distances(env, soma_coords, ip_dist, resolution=[30, 30, 10], interp_chunk_size=1000, allgather=False,
+                      columnar=False):
 
     rank = env.comm.rank
 
@@ -573,7 +713,7 @@ def measure_distances(env, soma_coords, ip_dist, resolution=[30, 30, 10], interp
     soma_distances = interp_soma_distances(env.comm, ip_dist_u, ip_dist_v, soma_coords, 
                                            layer_extents, cell_distribution, 
                                            interp_chunk_size=interp_chunk_size, 
-                                           allgather=allgather)
+                                           allgather=allgather, columnar=columnar)
 
     return soma_distances
 
@@ -219,26 +219,34 @@ def read_params(input_path):
     return pop_params_dict
 
 
-def spikeout(env, output_path, t_start=None, clear_data=False):
+def spikeout(env, output_path, t_start=None, clear_data=False, incremental=False):
     """
     Writes spike times to specified NeuroH5 output file.
 
+    Spikes are sorted once by (gid, t), split on gid boundaries, and
+    assigned trial indices and trial time offsets in a single pass
+    over all spikes of each population.
+
     :param env:
     :param output_path:
+    :param t_start: if not None, only spikes at or after this time are written
     :param clear_data: 
+    :param incremental: if True, only spikes recorded since the previous call are considered
     :return:
     """
     equilibration_duration = float(env.stimulus_config['Equilibration Duration'])
     n_trials = env.n_trials
 
-    t_vec = env.t_vec.as_numpy()
-    id_vec = np.asarray(env.id_vec.as_numpy(), dtype=np.uint32)
+    spike_offset = env.spike_output_offset if incremental else 0
+    t_vec = np.asarray(env.t_vec.as_numpy()[spike_offset:], dtype=np.float32)
+    id_vec = np.asarray(env.id_vec.as_numpy()[spike_offset:], dtype=np.uint32)
 
     trial_time_ranges = get_trial_time_ranges(env.t_rec.to_python(), env.n_trials)
     trial_time_bins = [ t_trial_start for t_trial_start, t_trial_end in trial_time_ranges ] 
     trial_dur = np.asarray([env.tstop + equilibration_duration] * n_trials, dtype=np.float32)
+    trial_offsets = np.asarray([np.sum(trial_dur[:trial_i]) + equilibration_duration
+                                for trial_i in range(n_trials)], dtype=np.float32)
 
-    binlst = []
     typelst = sorted(env.celltypes.keys())
     binvect = np.asarray([env.celltypes[k]['start'] for k in typelst ])
     sort_idx = np.argsort(binvect, axis=0)
@@ -246,6 +254,11 @@ def spikeout(env, output_path, t_start=None, clear_data=False):
     bins = binvect[sort_idx][1:]
     inds = np.digitize(id_vec, bins)
 
+    if t_start is not None:
+        t_mask = t_vec >= t_start
+    else:
+        t_mask = np.ones(t_vec.shape, dtype=bool)
+
     if env.results_namespace_id is None:
         namespace_id = "Spike Events"
     else:
@@ -253,39 +266,41 @@ def spikeout(env, output_path, t_start=None, clear_data=False):
 
     for i, pop_name in enumerate(pop_names):
         spkdict = {}
-        sinds = np.where(inds == i)
+        sinds = np.flatnonzero(np.logical_and(inds == i, t_mask))
         if len(sinds) > 0:
             ids = id_vec[sinds]
             ts = t_vec[sinds]
-            for j in range(0, len(ids)):
-                gid = ids[j]
-                t = ts[j]
-                if (t_start is None) or (t >= t_start):
-                    if gid in spkdict:
-                        spkdict[gid]['t'].append(t)
-                    else:
-                        spkdict[gid] = {'t': [t]}
-            for gid in spkdict:
-                is_artificial = gid in env.artificial_cells[pop_name]
-                spiketrain = np.array(spkdict[gid]['t'], dtype=np.float32)
-                if gid in env.spike_onset_delay:
-                    spiketrain -= env.spike_onset_delay[gid]
-                trial_bins = np.digitize(spiketrain, trial_time_bins) - 1
-                trial_spikes = [np.copy(spiketrain[np.where(trial_bins == trial_i)[0]])
-                                for trial_i in range(n_trials)]
-                for trial_i, trial_spiketrain in enumerate(trial_spikes):
-                    trial_spiketrain = trial_spikes[trial_i]
-                    trial_spiketrain -= np.sum(trial_dur[:(trial_i)]) + equilibration_duration
-                spkdict[gid]['t'] = np.concatenate(trial_spikes)
-                spkdict[gid]['Trial Duration'] = trial_dur
-                spkdict[gid]['Trial Index'] = np.asarray(trial_bins, dtype=np.uint8)
-                spkdict[gid]['artificial'] = np.asarray([1 if is_artificial else 0], dtype=np.uint8)
+            order = np.lexsort((ts, ids))
+            ids = ids[order]
+            ts = ts[order]
+            gids, gid_starts, gid_counts = np.unique(ids, return_index=True, return_counts=True)
+            if len(env.spike_onset_delay) > 0:
+                onset_delays = np.asarray([env.spike_onset_delay.get(gid, 0.) for gid in gids], dtype=np.float32)
+                ts -= np.repeat(onset_delays, gid_counts)
+            trial_bins = np.digitize(ts, trial_time_bins) - 1
+            ## spikes that fall outside of all trials are not written
+            in_trial = np.logical_and(trial_bins >= 0, trial_bins < n_trials)
+            ts = ts[in_trial] - trial_offsets[trial_bins[in_trial]]
+            trial_inds = np.asarray(trial_bins[in_trial], dtype=np.uint8)
+            gid_ends = np.cumsum(np.add.reduceat(in_trial.astype(np.intp), gid_starts))
+            gid_spiketrains = np.split(ts, gid_ends[:-1])
+            gid_trial_inds = np.split(trial_inds, gid_ends[:-1])
+            artificial_gids = env.artificial_cells[pop_name]
+            for gid, spiketrain, trial_index in zip(gids, gid_spiketrains, gid_trial_inds):
+                is_artificial = gid in artificial_gids
+                spkdict[gid] = {'t': spiketrain,
+                                'Trial Duration': trial_dur,
+                                'Trial Index': trial_index,
+                                'artificial': np.asarray([1 if is_artificial else 0], dtype=np.uint8)}
         append_cell_attributes(output_path, pop_name, spkdict, namespace=namespace_id, comm=env.comm, io_size=env.io_size)
         del (spkdict)
 
     if clear_data:
         env.t_vec.resize(0)
         env.id_vec.resize(0)
+        env.spike_output_offset = 0
+    else:
+        env.spike_output_offset = int(env.t_vec.size())
 
     env.comm.barrier()
     if env.comm.Get_rank() == 0:
@@ -374,6 +389,9 @@ def recsout(env, output_path, t_start=None, clear_data=False, write_cell_locatio
 def lfpout(env, output_path):
     """
     Writes local field potential voltage traces to specified HDF5 output file.
+    For multi-electrode recordings, v is a 2-D dataset of shape
+    (samples, electrodes), and the electrode positions are written to
+    the position dataset.
 
     :param env:
     :param output_path:
@@ -394,6 +412,7 @@ def lfpout(env, output_path):
 
         grp['t'] = np.asarray(lfp.t, dtype=np.float32)
         grp['v'] = np.asarray(lfp.meanlfp, dtype=np.float32)
+        grp['position'] = np.asarray(lfp.electrode_positions(), dtype=np.float32)
 
         output.close()
 
@@ -10,6 +10,7 @@ setting dt_lfp.
 import itertools, math, logging
 from builtins import object, range
 
+import numpy as np
 from neuron import h
 logger = logging.getLogger(__name__)
 
@@ -42,9 +43,68 @@ def interpxyz(nn, nsegs, xx, yy, zz, ll, xint, yint, zint):
     zint.interpolate(rangev, ll, zz)
 
 
+def lfp_segment_coeffs(sec, epoints, rho):
+    """Computes the LFP scaling coefficients of all segments of a
+    section with respect to one or more electrode positions. This is
+    the array counterpart of the per-segment computation in
+    LFP.setup_lfp_coeffs: the node coordinates are interpolated from
+    the pt3d data as in interpxyz, and the line source coefficients
+    are computed for all segments and electrodes at once.
+
+    :param sec: section
+    :param epoints: array of shape (N, 3) with electrode positions (um)
+    :param rho: extracellular resistivity (ohm cm)
+    :return: array of shape (N, nseg)
+    """
+    epoints = np.asarray(epoints, dtype=np.float64).reshape((-1, 3))
+    nn = int(sec.n3d())
+    nseg = int(sec.nseg)
+
+    pt3d = np.asarray([(sec.x3d(ii), sec.y3d(ii), sec.z3d(ii), sec.arc3d(ii)) for ii in range(nn)],
+                      dtype=np.float64)
+    ll = pt3d[:, 3] / pt3d[nn - 1, 3]
+    rangev = np.concatenate(([0.], (np.arange(nseg) + 0.5) / nseg, [1.]))
+    sxyz = np.column_stack([np.interp(rangev, ll, pt3d[:, ii]) for ii in range(3)])[:nseg]
+
+    ## l = L/nseg is compartment length 
+    ## rd is the perpendicular distance from the electrode to a line through the compartment
+    ## ld is longitudinal distance along this line from the electrode to one end of the compartment
+    ## sd = l - ld is longitudinal distance to the other end of the compartment
+    l = float(sec.L) / nseg
+    area = np.asarray([seg.area() for seg in sec], dtype=np.float64)
+    rd = np.sqrt(np.sum((epoints[:, np.newaxis, :] - sxyz[np.newaxis, :, :]) ** 2, axis=2))
+    ld = np.sqrt(np.sum((sxyz - sxyz[0]) ** 2, axis=1))
+    sd = l - ld
+    with np.errstate(divide='ignore', invalid='ignore'):
+        k = 0.0001 * area * (rho / (4.0 * math.pi * l)) * \
+            np.abs(np.log((np.sqrt(ld * ld + rd * rd) - ld) / (np.sqrt(sd * sd + rd * rd) - sd)))
+    k[~np.isfinite(k)] = 0.
+    return k
+
+
 class LFP(object):
 
-    def __init__(self, label, pc, pop_gid_dict, pos, rho=333.0, fdst=0.1, maxEDist=100., dt_lfp=0.5, seed=1):
+    def __init__(self, label, pc, pop_gid_dict, pos, rho=333.0, fdst=0.1, maxEDist=100., dt_lfp=0.5, seed=1,
+                 vectorized=False, buffered=False):
+        """
+        :param label: label of the LFP recording
+        :param pc: ParallelContext
+        :param pop_gid_dict: dict of population name to gids of cells that may contribute to the LFP
+        :param pos: electrode position (x, y, z) (um)
+        :param rho: extracellular resistivity (ohm cm)
+        :param fdst: fraction of distant cells to include in the computation
+        :param maxEDist: maximum distance of proximal cells from the electrode (um)
+        :param dt_lfp: LFP sampling interval (ms)
+        :param seed: random seed for the selection of distant cells
+        :param vectorized: if True, the membrane currents of all
+            compartments are gathered through a PtrVector, and each LFP
+            sample is computed as a single dot product with a flat
+            coefficient array
+        :param buffered: if True, local LFP contributions are
+            accumulated in a rank-local buffer and reduced across ranks
+            in one collective operation when flush is called, rather
+            than at every sample
+        """
         self.label = label
         self.pc = pc
         self.dt_lfp = dt_lfp
@@ -59,6 +119,14 @@ class LFP(object):
         self.lfp_types = {}
         self.lfp_coeffs = {}
         self.pop_gid_dict = pop_gid_dict
+        self.vectorized = vectorized
+        self.lfp_coeff_array = None
+        self.lfp_ptrvec = None
+        self.lfp_ivec = None
+        self.lfp_segs = []
+        self.buffered = buffered
+        self.lfp_buffer = []
+        self.t_buffer = []
         self.fih_lfp = h.FInitializeHandler(1, self.sample_lfp)
         self.setup_lfp()
 
@@ -129,13 +197,20 @@ class LFP(object):
                             lfp_coeffs.o(i).x[j] = k
                             j = j + 1
 
+    def electrode_positions(self):
+        """Returns the recording electrode positions as an array of shape (N, 3)."""
+        return np.asarray(self.epoint, dtype=np.float64).reshape((-1, 3))
+
+    def electrode_distance(self, x, y, z):
+        """Returns the distance of the given point from the recording electrode."""
+        ex, ey, ez = self.epoint
+        return math.sqrt((x - ex) ** 2 + (y - ey) ** 2 + (z - ez) ** 2)
+
     def setup_lfp(self):
         ## Calculate distances from recording electrode to all
         ## compartments of all cells, calculate scaling coefficients
         ## for the LFP calculation, and save them in lfp_coeffs.
 
-        ex, ey, ez = self.epoint
-
         ##printf ("host %d: entering setup_npole_lfp" % int(self.pc.id()))
 
         ## Determine which cells will be used for the LFP computation and the sizes of their compartments
@@ -190,7 +265,7 @@ class LFP(object):
                     )
 
                 ## Relative to the recording electrode position
-                if (math.sqrt((x - ex) ** 2 + (y - ey) ** 2 + (z - ez) ** 2) < self.maxEDist):
+                if (self.electrode_distance(x, y, z) < self.maxEDist):
                     lfptype = 1  ## proximal cell; compute extracellular potential
                 else:
                     if (ransample < self.fdst):
@@ -213,12 +288,72 @@ class LFP(object):
             self.lfp_types[pop_name] = lfp_types
             self.lfp_coeffs[pop_name] = lfp_coeffs
 
-        self.setup_lfp_coeffs()
+        if self.vectorized:
+            self.setup_lfp_coeffs_vec()
+        else:
+            self.setup_lfp_coeffs()
 
-    def pos_lfp(self):
-        ## Calculate the average LFP of select cells in the network,
-        ##  only including cells whose somata are within maxEDist
-        ##  microns of the (x,y,z) recording electrode location
+    def setup_lfp_coeffs_vec(self):
+        ## Computes the scaling coefficients of all compartments of
+        ## the selected cells into a flat array, and gathers pointers
+        ## to the membrane currents of the same compartments in a
+        ## PtrVector, in the same order.
+
+        coeffs = []
+        i_membrane_segs = []
+        for pop_name in self.pop_gid_dict:
+
+            lfp_ids = self.lfp_ids[pop_name]
+            lfp_types = self.lfp_types[pop_name]
+
+            for i in range(0, int(lfp_ids.size())):
+                gid = lfp_ids.x[i]
+                cell = self.pc.gid2cell(gid)
+
+                for sec in list(cell.all):
+                    if h.ismembrane('extracellular', sec=sec):
+                        k = lfp_segment_coeffs(sec, self.electrode_positions(), self.rho)
+                        ## Distal cell
+                        if (lfp_types.x[i] == 2):
+                            k = (1.0 / self.fdst) * k
+                        coeffs.append(k)
+                        i_membrane_segs.extend([seg for seg in sec])
+
+        n = len(i_membrane_segs)
+        if n > 0:
+            self.lfp_coeff_array = np.concatenate(coeffs, axis=1)
+        else:
+            self.lfp_coeff_array = np.zeros((len(self.electrode_positions()), 0), dtype=np.float64)
+        self.lfp_segs = i_membrane_segs
+        self.lfp_ptrvec = h.PtrVector(n)
+        ## The membrane current storage is reallocated by
+        ## finitialize and cache_efficient after the LFP objects are
+        ## created, so the pointers are re-bound whenever NEURON
+        ## updates its data pointers (NEURON versions with stable
+        ## data handles do not have this callback).
+        if hasattr(self.lfp_ptrvec, 'ptr_update_callback'):
+            self.lfp_ptrvec.ptr_update_callback(self.update_lfp_ptrvec)
+        self.update_lfp_ptrvec()
+        self.lfp_ivec = h.Vector(n)
+
+    def update_lfp_ptrvec(self):
+        ## Binds the elements of the PtrVector to the membrane
+        ## currents of the LFP compartments.
+
+        for j, seg in enumerate(self.lfp_segs):
+            self.lfp_ptrvec.pset(j, seg._ref_i_membrane)
+
+    def local_lfp(self):
+        ## Calculate the contribution of the cells on this rank to
+        ##  the LFP, only including cells whose somata are within
+        ##  maxEDist microns of the (x,y,z) recording electrode location
+
+        if self.vectorized:
+            vlfp = 0.
+            if self.lfp_coeff_array.shape[1] > 0:
+                self.lfp_ptrvec.gather(self.lfp_ivec)
+                vlfp = float(np.dot(self.lfp_coeff_array[0], self.lfp_ivec.as_numpy()))
+            return vlfp
 
         vlfp = 0.
 
@@ -238,22 +373,105 @@ class LFP(object):
                             vlfp = vlfp + (seg._ref_i_membrane[0] * lfp_coeffs.o(i).x[j])
                             j = j + 1
 
-        meanlfp = self.pc.allreduce(vlfp, 1)
+        return vlfp
+
+    def pos_lfp(self):
+        ## Calculate the average LFP of select cells in the network
+
+        meanlfp = self.pc.allreduce(self.local_lfp(), 1)
         return meanlfp
 
     def sample_lfp(self):
 
-        ## recording electrode position (um)
-        ex, ey, ez = self.epoint
-
-        ## Compute LFP across the subset of cells:
-        meanlfp = self.pos_lfp()
+        if self.buffered:
+            ## Accumulate the local contribution; the reduction
+            ## across ranks is performed by flush
+            self.lfp_buffer.append(self.local_lfp())
+            self.t_buffer.append(h.t)
+        else:
+            ## Compute LFP across the subset of cells:
+            meanlfp = self.pos_lfp()
 
-        if (int(self.pc.id()) == 0):
-            ## For this time step, append to lists with entries of time and average LFP
-            self.meanlfp.append(meanlfp)
-            self.t.append(h.t)
+            if (int(self.pc.id()) == 0):
+                ## For this time step, append to lists with entries of time and average LFP
+                self.meanlfp.append(meanlfp)
+                self.t.append(h.t)
 
         ## Add another event to the event queue, to 
         ## execute sample_lfp again, dt_lfp ms from now
         h.cvode.event(h.t + self.dt_lfp, self.sample_lfp)
+
+    def flush(self):
+        """Reduces the buffered local LFP contributions across all
+        ranks in one collective operation, and appends the reduced
+        samples to meanlfp on rank 0. Must be called on all ranks;
+        this is a no-op if the recording is not buffered."""
+
+        if not self.buffered:
+            return
+        n_samples = len(self.t_buffer)
+        if n_samples > 0:
+            lfp_block = np.asarray(self.lfp_buffer, dtype=np.float64)
+            lfp_block_vec = h.Vector(lfp_block.size)
+            lfp_block_vec.from_python(lfp_block.ravel())
+            self.pc.allreduce(lfp_block_vec, 1)
+            if (int(self.pc.id()) == 0):
+                reduced_block = lfp_block_vec.as_numpy().reshape(lfp_block.shape)
+                self.meanlfp.extend(list(reduced_block.copy()))
+                self.t.extend(self.t_buffer)
+        self.lfp_buffer = []
+        self.t_buffer = []
+
+
+class LFPArray(LFP):
+    """Multi-electrode LFP recording, such as a linear probe or a
+    tetrode grid. Cells are selected for the LFP computation if their
+    soma is within maxEDist of any of the electrodes, or otherwise
+    with probability fdst, as in :class:'LFP'. The coefficients of all
+    compartments for all electrodes are kept in an (N x compartments)
+    matrix; each sample reads the membrane currents once, computes all
+    channels with one matrix-vector product, and reduces them with a
+    single allreduce of an N-vector. Each entry of meanlfp is an array
+    of N channel values. The membrane current pointers are re-bound on
+    NEURON pointer updates, as in the vectorized :class:'LFP'.
+    """
+
+    def __init__(self, label, pc, pop_gid_dict, positions, rho=333.0, fdst=0.1, maxEDist=100., dt_lfp=0.5, seed=1,
+                 buffered=False):
+        """
+        :param label: label of the LFP recording
+        :param pc: ParallelContext
+        :param pop_gid_dict: dict of population name to gids of cells that may contribute to the LFP
+        :param positions: sequence of N electrode positions (x, y, z) (um)
+        :param rho: extracellular resistivity (ohm cm)
+        :param fdst: fraction of distant cells to include in the computation
+        :param maxEDist: maximum distance of proximal cells from the nearest electrode (um)
+        :param dt_lfp: LFP sampling interval (ms)
+        :param seed: random seed for the selection of distant cells
+        :param buffered: if True, local LFP contributions are reduced across ranks when flush is called
+        """
+        self.lfp_vec = h.Vector(len(positions))
+        super().__init__(label, pc, pop_gid_dict, positions, rho=rho, fdst=fdst, maxEDist=maxEDist,
+                         dt_lfp=dt_lfp, seed=seed, vectorized=True, buffered=buffered)
+
+    def electrode_distance(self, x, y, z):
+        """Returns the distance of the given point from the nearest recording electrode."""
+        return float(np.min(np.linalg.norm(self.electrode_positions() - np.asarray([x, y, z]), axis=1)))
+
+    def local_lfp(self):
+        ## Calculate the contribution of the cells on this rank to
+        ## the LFP at all electrodes
+
+        if self.lfp_coeff_array.shape[1] > 0:
+            self.lfp_ptrvec.gather(self.lfp_ivec)
+            return np.dot(self.lfp_coeff_array, self.lfp_ivec.as_numpy())
+        else:
+            return np.zeros((self.lfp_coeff_array.shape[0],), dtype=np.float64)
+
+    def pos_lfp(self):
+        ## Calculate the LFP of select cells in the network at all
+        ## electrodes, and reduce all channels in a single allreduce
+
+        self.lfp_vec.from_python(self.local_lfp())
+        self.pc.allreduce(self.lfp_vec, 1)
+        return self.lfp_vec.as_numpy().copy()
@@ -6,8 +6,8 @@ __author__ = 'See AUTHORS.md'
 import os, sys, gc, time, resource, random, pprint
 import numpy as np
 
-from dentate import cells, io_utils, lfp, lpt, simtime, synapses
-from dentate.neuron_utils import h, configure_hoc_env, cx, make_rec, mkgap, load_cell_template
+from dentate import activity, cells, io_utils, lfp, lpt, simtime, synapses
+from dentate.neuron_utils import h, configure_hoc_env, cx, make_rec, mkgap, mkgaps, load_cell_template
 from dentate.utils import compose_iter, imapreduce, get_module_logger, profile_memory, Promise
 from dentate.utils import range, str, viewitems, viewkeys, zip, zip_longest
 from neuroh5.io import bcast_graph, read_cell_attribute_selection, scatter_read_cell_attribute_selection, read_graph_selection, read_tree_selection, scatter_read_cell_attributes, scatter_read_graph, scatter_read_trees, write_cell_attributes, write_graph, NeuroH5CellAttrGen, NeuroH5TreeGen
@@ -759,11 +759,75 @@ def connect_cell_selection(env):
 
 
 
+def gj_gid_owners(env, populations):
+    """
+    Returns the sorted gids of the cells of the given populations on
+    all ranks, and the ranks that own them.
+
+    :param env: an instance of the `dentate.Env` class
+    :param populations: list of population names
+    :return: tuple of array of gids, array of ranks
+    """
+    local_gids = np.fromiter((gid for pop_name in populations for gid in viewkeys(env.cells.get(pop_name, {}))),
+                             dtype=np.uint32)
+    counts = np.asarray(env.comm.allgather(len(local_gids)), dtype=np.int64)
+    all_gids = np.empty((int(np.sum(counts)),), dtype=np.uint32)
+    env.comm.Allgatherv(local_gids, [all_gids, counts])
+    all_ranks = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+    sort_idx = np.argsort(all_gids, kind='stable')
+    return all_gids[sort_idx], all_ranks[sort_idx]
+
+
+def gj_edge_index(comm, srcs):
+    """
+    Returns the positions of the given local gap junction edges in the
+    order of source gid and edge position on all ranks, as if the gap
+    junction graph were read on a single rank, and the total number of
+    edges. The local edges of each source gid must be in graph order;
+    if the edges of a source gid are on several ranks, they are
+    ordered by rank.
+
+    :param comm: MPI communicator
+    :param srcs: array of source gids of the local edges
+    :return: tuple of array of int, int
+    """
+    local_src_gids, local_src_counts = np.unique(srcs, return_counts=True)
+    src_counts = np.asarray(comm.allgather(len(local_src_gids)), dtype=np.int64)
+    all_src_gids = np.empty((int(np.sum(src_counts)),), dtype=np.uint32)
+    all_src_counts = np.empty((int(np.sum(src_counts)),), dtype=np.int64)
+    comm.Allgatherv(local_src_gids.astype(np.uint32), [all_src_gids, src_counts])
+    comm.Allgatherv(local_src_counts.astype(np.int64), [all_src_counts, src_counts])
+    src_sort_idx = np.argsort(all_src_gids, kind='stable')
+    all_src_gids = all_src_gids[src_sort_idx]
+    all_src_offsets = np.concatenate(([0], np.cumsum(all_src_counts[src_sort_idx])[:-1])).astype(np.int64)
+    ## Offset of the local edges of each source gid: the edges of the
+    ## same source gid on lower ranks come first
+    local_src_offsets = np.empty((len(local_src_gids),), dtype=np.int64)
+    all_src_ranks = np.repeat(np.arange(len(src_counts)), src_counts)[src_sort_idx]
+    rank_pos = np.flatnonzero(all_src_ranks == comm.rank)
+    local_src_offsets[np.searchsorted(local_src_gids, all_src_gids[rank_pos])] = all_src_offsets[rank_pos]
+    src_sort_idx = np.argsort(srcs, kind='stable')
+    edge_index = np.empty((len(srcs),), dtype=np.int64)
+    edge_index[src_sort_idx] = \
+        np.repeat(local_src_offsets, local_src_counts) + \
+        (np.arange(len(srcs)) - np.repeat(np.cumsum(local_src_counts) - local_src_counts, local_src_counts))
+    return edge_index, int(np.sum(all_src_counts))
+
+
 def connect_gjs(env):
     """
     Loads NeuroH5 connectivity file, instantiates the corresponding
     half-gap mechanisms on the pre- and post-junction cells.
 
+    The gap junction graph is read with scatter_read_graph, so that
+    each rank only reads the edges of its local cells; the half-gaps
+    of edges whose other end is on a different rank are sent to the
+    owning rank. The source/target variable ids of each gap junction
+    are computed from the position of its edge in the graph ordered by
+    projection and gid, and are therefore independent of the number
+    of ranks. Edges of gids that are not instantiated on any rank are
+    not read, and are not assigned ids.
+
     :param env: an instance of the `dentate.Env` class
 
     """
@@ -778,62 +842,115 @@ def connect_gjs(env):
     num_gj_inter = 0
     if gapjunctions_file_path is not None:
 
-        (graph, a) = bcast_graph(gapjunctions_file_path, \
-                                 namespaces=['Coupling strength', 'Location'], \
-                                 comm=env.comm)
+        gj_names = sorted(viewkeys(gapjunctions))
+        owner_gids, owner_ranks = gj_gid_owners(env, sorted(set([p for name in gj_names for p in name])))
 
         ggid = 2e6
-        for name in sorted(viewkeys(gapjunctions)):
+        for name in gj_names:
             if rank == 0:
                 logger.info(f'*** Creating gap junctions {name}')
-            prj = graph[name[0]][name[1]]
+            if env.node_allocation is None:
+                (graph, a) = scatter_read_graph(gapjunctions_file_path, comm=env.comm, io_size=env.io_size,
+                                                projections=[(name[1], name[0])],
+                                                namespaces=['Coupling strength', 'Location'])
+            else:
+                (graph, a) = scatter_read_graph(gapjunctions_file_path, comm=env.comm, io_size=env.io_size,
+                                                node_allocation=env.node_allocation,
+                                                projections=[(name[1], name[0])],
+                                                namespaces=['Coupling strength', 'Location'])
+            edge_iter = graph[name[0]][name[1]]
             attrmap = a[(name[1], name[0])]
             cc_src_idx = attrmap['Coupling strength']['Source']
-            cc_dst_idx = attrmap['Coupling strength']['Destination']
             dstsec_idx = attrmap['Location']['Destination section']
             dstpos_idx = attrmap['Location']['Destination position']
             srcsec_idx = attrmap['Location']['Source section']
             srcpos_idx = attrmap['Location']['Source position']
 
-            for src in sorted(viewkeys(prj)):
-                edges = prj[src]
+            src_lst = []
+            dst_lst = []
+            srcsec_lst = []
+            srcpos_lst = []
+            dstsec_lst = []
+            dstpos_lst = []
+            wgt_lst = []
+            for src, edges in edge_iter:
                 destinations = edges[0]
                 cc_dict = edges[1]['Coupling strength']
                 loc_dict = edges[1]['Location']
-                srcweights = cc_dict[cc_src_idx]
-                dstweights = cc_dict[cc_dst_idx]
-                dstposs = loc_dict[dstpos_idx]
-                dstsecs = loc_dict[dstsec_idx]
-                srcposs = loc_dict[srcpos_idx]
-                srcsecs = loc_dict[srcsec_idx]
-                for i in range(0, len(destinations)):
-                    dst = destinations[i]
-                    srcpos = srcposs[i]
-                    srcsec = srcsecs[i]
-                    dstpos = dstposs[i]
-                    dstsec = dstsecs[i]
-                    wgt = srcweights[i] * 0.001
-                    if env.pc.gid_exists(src):
-                        if rank == 0:
-                            logger.info('host %d: gap junction: gid = %d sec = %d coupling = %g '
-                                        'sgid = %d dgid = %d\n' %
-                                        (rank, src, srcsec, wgt, ggid, ggid + 1))
-                        cell = env.pc.gid2cell(src)
-                        gj = mkgap(env, cell, src, srcpos, srcsec, ggid, ggid + 1, wgt)
-                    if env.pc.gid_exists(dst):
-                        if rank == 0:
-                            logger.info('host %d: gap junction: gid = %d sec = %d coupling = %g '
-                                        'sgid = %d dgid = %d\n' %
-                                        (rank, dst, dstsec, wgt, ggid + 1, ggid))
-                        cell = env.pc.gid2cell(dst)
-                        gj = mkgap(env, cell, dst, dstpos, dstsec, ggid + 1, ggid, wgt)
-                    ggid = ggid + 2
-                    if env.pc.gid_exists(src) or env.pc.gid_exists(dst):
-                        num_gj += 1
-                        if env.pc.gid_exists(src) and env.pc.gid_exists(dst):
-                            num_gj_intra += 1
-                        else:
-                            num_gj_inter += 1
+                src_lst.append(np.full((len(destinations),), src, dtype=np.uint32))
+                dst_lst.append(np.asarray(destinations, dtype=np.uint32))
+                srcsec_lst.append(np.asarray(loc_dict[srcsec_idx]))
+                srcpos_lst.append(np.asarray(loc_dict[srcpos_idx]))
+                dstsec_lst.append(np.asarray(loc_dict[dstsec_idx]))
+                dstpos_lst.append(np.asarray(loc_dict[dstpos_idx]))
+                wgt_lst.append(np.asarray(cc_dict[cc_src_idx]) * 0.001)
+            del graph
+
+            if len(src_lst) > 0:
+                srcs = np.concatenate(src_lst)
+                dsts = np.concatenate(dst_lst)
+                srcsecs = np.concatenate(srcsec_lst)
+                srcposs = np.concatenate(srcpos_lst)
+                dstsecs = np.concatenate(dstsec_lst)
+                dstposs = np.concatenate(dstpos_lst)
+                wgts = np.concatenate(wgt_lst)
+            else:
+                srcs = np.zeros((0,), dtype=np.uint32)
+                dsts = np.zeros((0,), dtype=np.uint32)
+                srcsecs = np.zeros((0,), dtype=np.uint32)
+                srcposs = np.zeros((0,), dtype=np.float32)
+                dstsecs = np.zeros((0,), dtype=np.uint32)
+                dstposs = np.zeros((0,), dtype=np.float32)
+                wgts = np.zeros((0,), dtype=np.float32)
+            del src_lst, dst_lst, srcsec_lst, srcpos_lst, dstsec_lst, dstpos_lst, wgt_lst
+
+            ## Gap junction ids are assigned in order of source gid and
+            ## edge position, as if the graph were read on a single rank.
+            edge_index, n_edges = gj_edge_index(env.comm, srcs)
+            sgids = ggid + 2. * edge_index
+            ggid = ggid + 2. * float(n_edges)
+
+            ## Half-gaps on the destination side are created on the rank that owns the destination gid
+            ## (destination gids that are not instantiated on any rank are assigned rank -1)
+            dst_ranks = np.full((len(dsts),), -1, dtype=np.int32)
+            if len(owner_gids) > 0:
+                dst_pos = np.minimum(np.searchsorted(owner_gids, dsts), len(owner_gids) - 1)
+                dst_found = owner_gids[dst_pos] == dsts
+                dst_ranks[dst_found] = owner_ranks[dst_pos[dst_found]]
+            is_local_dst = dst_ranks == rank
+            sendbuf = []
+            for dest_rank in range(nhosts):
+                sel = np.flatnonzero(dst_ranks == dest_rank) if dest_rank != rank else np.zeros((0,), dtype=np.intp)
+                sendbuf.append((dsts[sel], dstposs[sel], dstsecs[sel], sgids[sel] + 1., sgids[sel], wgts[sel]))
+            recvbuf = env.comm.alltoall(sendbuf)
+            del sendbuf
+
+            half_gaps = [(srcs, srcposs, srcsecs, sgids, sgids + 1., wgts),
+                         (dsts[is_local_dst], dstposs[is_local_dst], dstsecs[is_local_dst],
+                          sgids[is_local_dst] + 1., sgids[is_local_dst], wgts[is_local_dst])] + \
+                         [recv for recv in recvbuf if len(recv[0]) > 0]
+            gj_gids, gj_poss, gj_secs, gj_sgids, gj_dgids, gj_wgts = \
+                [np.concatenate([half_gap[i] for half_gap in half_gaps]) for i in range(6)]
+            del half_gaps, recvbuf
+
+            gid_sort_idx = np.argsort(gj_gids, kind='stable')
+            cell_gids, cell_starts = np.unique(gj_gids[gid_sort_idx], return_index=True)
+            cell_ends = np.append(cell_starts[1:], len(gid_sort_idx))
+            for gid, cell_start, cell_end in zip(cell_gids, cell_starts, cell_ends):
+                idxs = gid_sort_idx[cell_start:cell_end]
+                cell = env.pc.gid2cell(int(gid))
+                mkgaps(env, cell, int(gid), gj_poss[idxs], gj_secs[idxs], gj_sgids[idxs], gj_dgids[idxs], gj_wgts[idxs])
+
+            this_num_gj_intra = int(np.count_nonzero(is_local_dst))
+            this_num_gj = len(gj_gids) - this_num_gj_intra
+            num_gj += this_num_gj
+            num_gj_intra += this_num_gj_intra
+            num_gj_inter += this_num_gj - this_num_gj_intra
+            total_num_gj = env.comm.reduce(len(srcs), op=MPI.SUM, root=0)
+            total_num_gj_inter = env.comm.reduce(len(srcs) - this_num_gj_intra, op=MPI.SUM, root=0)
+            if rank == 0:
+                logger.info(f'*** Created {total_num_gj} gap junctions {name}: '
+                            f'{total_num_gj - total_num_gj_inter} intraprocessor {total_num_gj_inter} interprocessor')
 
         logger.info(f'*** rank {rank}: created total {num_gj} gap junctions: {num_gj_intra} intraprocessor {num_gj_inter} interprocessor')
 
@@ -1561,11 +1678,21 @@ def init(env, subworld_size=None):
         lfp_pop_dict = { pop_name: set(viewkeys(env.cells[pop_name])).difference(set(viewkeys(env.artificial_cells[pop_name])))
                          for pop_name in viewkeys(env.cells) }
         for lfp_label, lfp_config_dict in sorted(viewitems(env.LFP_config)):
-            env.lfp[lfp_label] = lfp.LFP(lfp_label, env.pc, lfp_pop_dict,
-                                         lfp_config_dict['position'], rho=lfp_config_dict['rho'],
-                                         dt_lfp=lfp_config_dict['dt'], fdst=lfp_config_dict['fraction'],
-                                         maxEDist=lfp_config_dict['maxEDist'],
-                                         seed=int(env.model_config['Random Seeds']['Local Field Potential']))
+            if 'positions' in lfp_config_dict:
+                env.lfp[lfp_label] = lfp.LFPArray(lfp_label, env.pc, lfp_pop_dict,
+                                                  lfp_config_dict['positions'], rho=lfp_config_dict['rho'],
+                                                  dt_lfp=lfp_config_dict['dt'], fdst=lfp_config_dict['fraction'],
+                                                  maxEDist=lfp_config_dict['maxEDist'],
+                                                  seed=int(env.model_config['Random Seeds']['Local Field Potential']),
+                                                  buffered=lfp_config_dict['buffered'])
+            else:
+                env.lfp[lfp_label] = lfp.LFP(lfp_label, env.pc, lfp_pop_dict,
+                                             lfp_config_dict['position'], rho=lfp_config_dict['rho'],
+                                             dt_lfp=lfp_config_dict['dt'], fdst=lfp_config_dict['fraction'],
+                                             maxEDist=lfp_config_dict['maxEDist'],
+                                             seed=int(env.model_config['Random Seeds']['Local Field Potential']),
+                                             vectorized=lfp_config_dict['vectorized'],
+                                             buffered=lfp_config_dict['buffered'])
         if rank == 0:
             logger.info("*** LFP objects instantiated")
     lfp_time = time.time() - st
@@ -1602,6 +1729,13 @@ def init(env, subworld_size=None):
     tstop = (env.tstop + equilibration_duration)*float(env.n_trials)
     if not env.use_coreneuron:
         env.simtime = simtime.SimTimeEvent(env.pc, tstop, env.max_walltime_hours, env.results_write_time, max_setup_time)
+    if env.spike_accumulator_interval is not None:
+        env.spike_accumulator = activity.SpikeAccumulatorEvent(env, env.stimulus_config['Temporal Resolution'],
+                                                               dt_update=env.spike_accumulator_interval,
+                                                               clear_data=env.spike_accumulator_clear_data,
+                                                               gid_bin_size=env.spike_accumulator_bin_size)
+    if env.activity_watchdog_config is not None:
+        env.activity_watchdog = activity.make_activity_watchdog(env)
     h.v_init = env.v_init
     h.stdinit()
     if env.optldbal or env.optlptbal:
@@ -1628,6 +1762,8 @@ def run(env, output=True, shutdown=True, output_syn_spike_count=False):
 
     if output_syn_spike_count and env.cleanup:
         raise RuntimeError("Unable to compute synapse spike counts when cleanup is True")
+    if output and (env.spike_accumulator is not None) and env.spike_accumulator.clear_data:
+        raise RuntimeError("Unable to output spike data when the spike accumulator clears recorded spikes")
     gc.collect()
 
     if rank == 0:
@@ -1649,6 +1785,7 @@ def run(env, output=True, shutdown=True, output_syn_spike_count=False):
     env.t_rec.resize(0)
     env.t_vec.resize(0)
     env.id_vec.resize(0)
+    env.spike_output_offset = 0
 
     h.t = env.tstart
     if env.simtime is not None:
@@ -1684,11 +1821,20 @@ def run(env, output=True, shutdown=True, output_syn_spike_count=False):
         env.pc.timeout(env.nrn_timeout)
         env.pc.psolve(h.tstop)
         while h.t < h.tstop - h.dt/2:
+            if (env.activity_watchdog is not None) and env.activity_watchdog.triggered:
+                break
             env.pc.psolve(h.t + 1.0)
+        for lfp_label in sorted(env.lfp):
+            env.lfp[lfp_label].flush()
+        if env.spike_accumulator is not None:
+            env.spike_accumulator.fold()
         if output:
             if rank == 0:
                 logger.info(f"*** Writing spike data up to {h.t:.2f} ms")
-            io_utils.spikeout(env, env.results_file_path, t_start=env.last_checkpoint, clear_data=env.checkpoint_clear_data)
+            io_utils.spikeout(env, env.results_file_path, t_start=env.last_checkpoint,
+                              clear_data=env.checkpoint_clear_data, incremental=True)
+            if env.spike_accumulator is not None:
+                env.spike_accumulator.sync_offset()
             if env.recording_profile is not None:
                 if rank == 0:
                     logger.info(f"*** Writing intracellular data up to {h.t:.2f} ms")
@@ -1696,6 +1842,10 @@ def run(env, output=True, shutdown=True, output_syn_spike_count=False):
             env.last_checkpoint = h.t
         if env.simtime is not None:
             env.tstop = env.simtime.tstop
+        if (env.activity_watchdog is not None) and env.activity_watchdog.triggered:
+            if rank == 0:
+                logger.info(f"*** Simulation stopped by activity watchdog at {h.t:.2f} ms")
+            break
     if output_syn_spike_count:
        for pop_name in sorted(viewkeys(env.biophys_cells)):
            presyn_names = sorted(env.projection_dict[pop_name])
@@ -14,7 +14,7 @@ from neuroh5.io import (
 import h5py
 import numpy as np
 import click
-from dentate import io_utils, spikedata, synapses, stimulus, cell_clamp, optimization
+from dentate import activity, io_utils, spikedata, synapses, stimulus, cell_clamp, optimization
 from dentate.cells import (
     h,
     make_input_cell,
@@ -163,7 +163,14 @@ def init_inputs_from_spikes(
     spike_train_attr_name="t",
     n_trials=1,
 ):
-    """Initializes presynaptic spike sources from a file with spikes times."""
+    """Initializes presynaptic spike sources from a file with spikes times.
+
+    The spike events are grouped by gid once per population (see
+    spikedata.read_spike_train_index); if env.spike_index_cache_dir is
+    not None, the grouped spike trains are cached on disk in that
+    directory, so that subsequent network clamp runs with the same
+    inputs skip reading and grouping the spike events.
+    """
     populations = sorted(presyn_sources.keys())
 
     equilibration_duration = float(
@@ -181,36 +188,29 @@ def init_inputs_from_spikes(
     else:
         this_spike_events_namespace = spike_events_namespace
 
-    ## Load spike times of presynaptic cells
-    spkdata = spikedata.read_spike_events(
+    ## Load spike times of presynaptic cells, grouped by gid
+    spike_index = spikedata.read_spike_train_index(
         spike_events_path,
         populations,
         this_spike_events_namespace,
         spike_train_attr_name=spike_train_attr_name,
         time_range=spkdata_time_range,
         n_trials=n_trials,
-        merge_trials=True,
         comm=env.comm,
         io_size=env.io_size,
+        cache_dir=env.spike_index_cache_dir,
     )
 
-    spkindlst = spkdata["spkindlst"]
-    spktlst = spkdata["spktlst"]
-    spkpoplst = spkdata["spkpoplst"]
-    pop_active_cells = spkdata["pop_active_cells"]
-
     ## Organize spike times by index of presynaptic population and gid
     input_source_dict = {}
     for population in populations:
         pop_index = int(env.Populations[population])
-        spk_pop_index = list_index(population, spkpoplst)
-        if spk_pop_index is None:
+        spike_arrays = spike_index.get(population, None)
+        if spike_arrays is None:
             logger.warning(
                 f"No spikes found for population {population} in file {spike_events_path}"
             )
             continue
-        spk_inds = spkindlst[spk_pop_index]
-        spk_ts = spktlst[spk_pop_index]
 
         spikes_attr_dict = {}
         gid_range = presyn_sources[population]
@@ -218,11 +218,12 @@ def init_inputs_from_spikes(
             f"Initializing {len(gid_range)} spike sources for population {population}."
         )
 
-        for gid in gid_range:
-            this_spk_inds = np.argwhere(spk_inds == gid)
-            if len(this_spk_inds) > 0:
-                ts = spk_ts[this_spk_inds] + equilibration_duration
-                spikes_attr_dict[gid] = {spike_train_attr_name: ts}
+        source_gids = np.fromiter(gid_range, dtype=np.int64, count=len(gid_range))
+        gid_index = spike_arrays.index(source_gids)
+        offsets = spike_arrays.offsets
+        for gid, i in zip(source_gids[gid_index >= 0], gid_index[gid_index >= 0]):
+            ts = spike_arrays.t[offsets[i]:offsets[i + 1]] + equilibration_duration
+            spikes_attr_dict[int(gid)] = {spike_train_attr_name: ts}
 
         input_source_dict[pop_index] = {"spiketrains": spikes_attr_dict}
 
@@ -683,6 +684,15 @@ def init(
 
     mindelay = env.pc.set_maxstep(10)
 
+    ## spike vectors are not cleared here, because the objective
+    ## functions obtain the spike trains from them after each run
+    if env.spike_accumulator_interval is not None:
+        env.spike_accumulator = activity.SpikeAccumulatorEvent(env, env.stimulus_config["Temporal Resolution"],
+                                                               dt_update=env.spike_accumulator_interval,
+                                                               gid_bin_size=env.spike_accumulator_bin_size)
+    if env.activity_watchdog_config is not None:
+        env.activity_watchdog = activity.make_activity_watchdog(env)
+
     if is_interactive:
         context.update(locals())
 
@@ -690,7 +700,7 @@ def init(
     return my_cell_index_set
 
 
-def run(env, cvode=False, pc_runworker=False):
+def run(env, cvode=False, pc_runworker=False, columnar=False):
     """
     Runs network clamp simulation. Assumes that procedure `init` has been
     called with the network configuration provided by the `env`
@@ -698,6 +708,7 @@ def run(env, cvode=False, pc_runworker=False):
 
     :param env: instance of env.Env
     :param cvode: whether to use adaptive integration
+    :param columnar: whether to return spike trains as :class:'spikedata.SpikeTrainArrays' objects
     """
 
     rank = int(env.pc.id())
@@ -737,6 +748,8 @@ def run(env, cvode=False, pc_runworker=False):
 
     env.pc.barrier()
     env.pc.psolve(h.tstop)
+    if env.spike_accumulator is not None:
+        env.spike_accumulator.fold()
 
     if rank == 0:
         logger.info("*** Simulation completed")
@@ -753,6 +766,8 @@ def run(env, cvode=False, pc_runworker=False):
         env.pc.runworker()
     env.pc.done()
 
+    if columnar:
+        return spikedata.get_env_spike_arrays(env, include_artificial=None)
     return spikedata.get_env_spike_dict(env, include_artificial=None)
 
 
@@ -808,7 +823,7 @@ def update_params(env, pop_param_dict, verbose=False):
                     )
 
 
-def run_with(env, param_dict, cvode=False, pc_runworker=False):
+def run_with(env, param_dict, cvode=False, pc_runworker=False, columnar=False):
     """
     Runs network clamp simulation with the specified parameters for the given gid(s).
     Assumes that procedure `init` has been called with
@@ -817,6 +832,7 @@ def run_with(env, param_dict, cvode=False, pc_runworker=False):
     :param env: instance of env.Env
     :param param_dict: dictionary { gid: params }
     :param cvode: whether to use adaptive integration
+    :param columnar: whether to return spike trains as :class:'spikedata.SpikeTrainArrays' objects
     """
 
     rank = int(env.pc.id())
@@ -868,6 +884,8 @@ def run_with(env, param_dict, cvode=False, pc_runworker=False):
 
     env.pc.barrier()
     env.pc.psolve(h.tstop)
+    if env.spike_accumulator is not None:
+        env.spike_accumulator.fold()
 
     if rank == 0:
         logger.info("*** Simulation completed")
@@ -890,6 +908,8 @@ def run_with(env, param_dict, cvode=False, pc_runworker=False):
             syn_attrs.restore_syn_attrs(pop_name, gid, stash_id)
             synapses.config_biophys_cell_syns(env, gid, pop_name, insert=False)
 
+    if columnar:
+        return spikedata.get_env_spike_arrays(env, include_artificial=None)
     return spikedata.get_env_spike_dict(env, include_artificial=None)
 
 
@@ -1157,22 +1177,16 @@ def init_rate_objfun(
             result.append((param_tuple, params_dict[param_pattern]))
         return result
 
-    def gid_firing_rate(spkdict, cell_index_set):
+    def gid_firing_rate(spike_arrays, cell_index_set):
         rates_dict = defaultdict(list)
-        mean_rates_dict = {}
+        pop_spike_arrays = spike_arrays[population]
+        cell_gids = list(cell_index_set)
+        spike_counts = pop_spike_arrays.spike_counts(cell_gids)
         for i in range(n_trials):
-            spkdict1 = {}
-            for gid in cell_index_set:
-                if gid in spkdict[population]:
-                    spk_ts = spkdict[population][gid][i]
-                    spkdict1[gid] = spk_ts
-                else:
-                    spkdict1[gid] = np.asarray([], dtype=np.float32)
-
-            for gid in cell_index_set:
-                this_rate = len(spkdict1[gid]) / tsecs
+            for gid, gid_spike_counts in zip(cell_gids, spike_counts):
+                this_rate = gid_spike_counts[i] / tsecs
                 logger.info(
-                    f"firing rate objective: spike times of gid {gid}: {pprint.pformat(spkdict1[gid])}"
+                    f"firing rate objective: spike times of gid {gid}: {pprint.pformat(pop_spike_arrays.spike_train(gid, i))}"
                 )
                 logger.info(
                     f"firing rate objective: rate of gid {gid} is {this_rate:.02f}"
@@ -1221,7 +1235,7 @@ def init_rate_objfun(
         return abs(max_rate - target_rate)
 
     def eval_problem(cell_param_dict, **kwargs):
-        spkdict = run_with(
+        spike_arrays = run_with(
             env,
             {
                 population: {
@@ -1229,8 +1243,9 @@ def init_rate_objfun(
                     for gid in my_cell_index_set
                 }
             },
+            columnar=True,
         )
-        firing_rates_dict = gid_firing_rate(spkdict, my_cell_index_set)
+        firing_rates_dict = gid_firing_rate(spike_arrays, my_cell_index_set)
         mean_v_dict = gid_mean_v(
             equilibration_duration,
             target_v_threshold,
@@ -1277,9 +1292,11 @@ def init_rate_objfun(
             feature_array["mean_v"] = mean_v_dict[gid]
             features_dict[gid] = feature_array
 
+        ## Invalid runs are penalized once, regardless of how many checks fail
+        watchdog_triggered = env.activity_watchdog is not None and env.activity_watchdog.triggered
         for gid in my_cell_index_set:
             constraints_dict[gid] = np.asarray([1], dtype=np.int8)
-            if (
+            if watchdog_triggered or (
                 np.mean(features_dict[gid]["mean_v"])
                 >= target_v_threshold - target_v_margin
             ):
@@ -1398,24 +1415,20 @@ def init_rate_dist_objfun(
             result.append((param_tuple, params_dict[param_pattern]))
         return result
 
-    def gid_firing_rate_vectors(spkdict, cell_index_set):
+    def gid_firing_rate_vectors(spike_arrays, cell_index_set):
         rates_dict = defaultdict(list)
+        pop_spike_arrays = spike_arrays[population]
+        cell_spike_arrays = pop_spike_arrays.select(list(cell_index_set))
         for i in range(n_trials):
-            spkdict1 = {}
-            for gid in cell_index_set:
-                if gid in spkdict[population]:
-                    spkdict1[gid] = spkdict[population][gid][i]
-                else:
-                    spkdict1[gid] = np.asarray([], dtype=np.float32)
             spike_density_dict = spikedata.spike_density_estimate(
-                population, spkdict1, time_bins
+                population, cell_spike_arrays, time_bins, trial=i
             )
             for gid in cell_index_set:
                 rate_vector = spike_density_dict[gid]["rate"]
                 idxs = np.where(np.isclose(rate_vector, 0.0, atol=1e-3, rtol=1e-3))[0]
                 rate_vector[idxs] = 0.0
                 rates_dict[gid].append(rate_vector)
-            for gid in spkdict[population]:
+            for gid in pop_spike_arrays.gids:
                 logger.info(
                     f"firing rate objective: trial {i} firing rate of gid {gid}: {spike_density_dict[gid]}"
                 )
@@ -1461,18 +1474,19 @@ def init_rate_dist_objfun(
                         for gid in my_cell_index_set
                     }
                 },
+                columnar=True,
             ),
             my_cell_index_set,
         )
         if trial_regime == "mean":
-            return {
+            objectives_dict = {
                 gid: -mean_trial_rate_mse(
                     gid, firing_rate_vectors_dict[gid], target_rate_vector_dict[gid]
                 )
                 for gid in my_cell_index_set
             }
         elif trial_regime == "best":
-            return {
+            objectives_dict = {
                 gid: -best_trial_rate_mse(
                     gid, firing_rate_vectors_dict[gid], target_rate_vector_dict[gid]
                 )
@@ -1480,6 +1494,12 @@ def init_rate_dist_objfun(
             }
         else:
             raise RuntimeError(f"firing_rate_dist: unknown trial regime {trial_regime}")
+        ## Invalid runs are penalized as in init_rate_objfun
+        watchdog_triggered = env.activity_watchdog is not None and env.activity_watchdog.triggered
+        if watchdog_triggered:
+            for gid in my_cell_index_set:
+                objectives_dict[gid] -= 1e6
+        return objectives_dict
 
     return opt_eval_fun(problem_regime, my_cell_index_set, eval_problem)
 
@@ -1848,6 +1868,7 @@ def show(
     write_cell,
     profile_memory,
     recording_profile,
+    spike_index_cache_dir=None,
 ):
     """
     Show configuration for the specified cell.
@@ -1924,6 +1945,7 @@ def go(
     profile_memory,
     recording_profile,
     input_seed,
+    spike_index_cache_dir=None,
 ):
     """
     Runs network clamp simulation for the specified gid, or for all gids found in the input data file.
@@ -2083,6 +2105,9 @@ def optimize(
     use_coreneuron,
     cooperative_init,
     target,
+    rate_map_cache_dir=None,
+    activity_watchdog=None,
+    spike_index_cache_dir=None,
 ):
     """
     Optimize the firing rate of the specified cell in a network clamp configuration.
@@ -2335,6 +2360,12 @@ def cli():
     default="Network clamp default",
     help="recording profile to use",
 )
+@click.option(
+    "--spike-index-cache-dir",
+    required=False,
+    type=click.Path(file_okay=False, dir_okay=True),
+    help="path to directory for caching the input spike trains grouped by gid",
+)
 def show_cmd(
     config,
     population,
@@ -2355,6 +2386,7 @@ def show_cmd(
     write_cell,
     profile_memory,
     recording_profile,
+    spike_index_cache_dir,
 ):
     """
     Show configuration for the specified cell.
@@ -2379,6 +2411,7 @@ def show_cmd(
                 write_cell,
                 profile_memory,
                 recording_profile,
+                spike_index_cache_dir=spike_index_cache_dir,
     )
 
 
@@ -2544,6 +2577,12 @@ def show_cmd(
     help="recording profile to use",
 )
 @click.option("--input-seed", type=int, help="seed for generation of spike trains")
+@click.option(
+    "--spike-index-cache-dir",
+    required=False,
+    type=click.Path(file_okay=False, dir_okay=True),
+    help="path to directory for caching the input spike trains grouped by gid",
+)
 def go_cmd(
     config,
     population,
@@ -2577,6 +2616,7 @@ def go_cmd(
     profile_memory,
     recording_profile,
     input_seed,
+    spike_index_cache_dir,
 ):
     """
     Runs network clamp simulation for the specified gid, or for all gids found in the input data file.
@@ -2612,7 +2652,8 @@ def go_cmd(
               write_cell,
               profile_memory,
               recording_profile,
-              input_seed
+              input_seed,
+              spike_index_cache_dir=spike_index_cache_dir,
     )
 
 
@@ -2792,6 +2833,24 @@ def go_cmd(
     is_flag=True,
     help="use a single worker to read model data then send to the remaining workers",
 )
+@click.option(
+    "--rate-map-cache-dir",
+    required=False,
+    type=click.Path(file_okay=False, dir_okay=True),
+    help="path to directory for caching target rate maps computed from input features",
+)
+@click.option(
+    "--activity-watchdog",
+    required=False,
+    type=click.Path(exists=True, file_okay=True, dir_okay=False),
+    help="path to YAML file with population rate bounds used to stop runaway or silent simulations early",
+)
+@click.option(
+    "--spike-index-cache-dir",
+    required=False,
+    type=click.Path(file_okay=False, dir_okay=True),
+    help="path to directory for caching the input spike trains grouped by gid",
+)
 @click.argument("target")  # help='rate, rate_dist, state'
 def optimize_cmd(
     config,
@@ -2833,6 +2892,9 @@ def optimize_cmd(
     use_coreneuron,
     cooperative_init,
     target,
+    rate_map_cache_dir,
+    activity_watchdog,
+    spike_index_cache_dir,
 ):
     """
     Optimize the firing rate of the specified cell in a network clamp configuration.
@@ -2877,6 +2939,9 @@ def optimize_cmd(
                     use_coreneuron,
                     cooperative_init,
                     target,
+                    rate_map_cache_dir=rate_map_cache_dir,
+                    activity_watchdog=activity_watchdog,
+                    spike_index_cache_dir=spike_index_cache_dir,
     )
 
 
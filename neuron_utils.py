@@ -116,7 +116,7 @@ def mknetcon_vecstim(syn, delay=0.1, weight=0, source=None):
     return nc, vs
 
 
-def mkgap(env, cell, gid, secpos, secidx, sgid, dgid, w):
+def mkgap(env, cell, gid, secpos, secidx, sgid, dgid, w, sections=None):
     """
     Create gap junctions
     :param pc:
@@ -126,6 +126,7 @@ def mkgap(env, cell, gid, secpos, secidx, sgid, dgid, w):
     :param sgid:
     :param dgid:
     :param w:
+    :param sections: optional list of the sections of cell
     :return:
     """
 
@@ -152,7 +153,9 @@ def mkgap(env, cell, gid, secpos, secidx, sgid, dgid, w):
         else:
             sec = cell_soma
     else:
-        sec = list(cell.sections)[secidx]
+        if sections is None:
+            sections = list(cell.sections)
+        sec = sections[secidx]
 
     seg = sec(secpos)
         
@@ -166,6 +169,27 @@ def mkgap(env, cell, gid, secpos, secidx, sgid, dgid, w):
     return gj
 
 
+def mkgaps(env, cell, gid, secposs, secidxs, sgids, dgids, ws):
+    """
+    Creates the given half-gap junctions on a single cell; the section
+    list of the cell is obtained once for all junctions.
+    :param env: :class:'Env'
+    :param cell: hoc cell object
+    :param gid: int
+    :param secposs: array of section positions
+    :param secidxs: array of section indices
+    :param sgids: array of source variable ids
+    :param dgids: array of target variable ids
+    :param ws: array of coupling weights
+    :return: list of gap junction objects
+    """
+    sections = None
+    if not getattr(cell, 'is_reduced', False):
+        sections = list(cell.sections)
+    return [mkgap(env, cell, gid, float(secpos), int(secidx), float(sgid), float(dgid), float(w), sections=sections)
+            for secpos, secidx, sgid, dgid, w in zip(secposs, secidxs, sgids, dgids, ws)]
+
+
 def find_template(env, template_name, path=['templates'], template_file=None, bcast_template=False, root=0):
     """
     Finds and loads a template located in a directory within the given path list.
@@ -264,7 +264,42 @@ def selectivity_optimization_params(optimization_config, pop_names, param_config
     return SelectivityOptConfig(mask_param_names=mask_param_names, mask_param_tuples=mask_param_tuples)
 
 
-def update_network_params(env, param_tuples):
+def update_syn_param(env, biophys_cell, sec_type, syn_name, param_name, param_key, param_value,
+                     sources=None, is_reduced=False, compiled=True):
+    """
+    Sets a synaptic parameter of the given cell. If compiled is True,
+    scalar parameters are set through the compiled parameter binding
+    of the cell (see synapses.compile_syn_param), which is resolved
+    on first use and reused by subsequent updates. Expression
+    parameters (param_key is not None) and parameters that cannot be
+    bound are set with synapses.modify_syn_param.
+
+    :param env: :class:'Env'
+    :param biophys_cell: :class:'BiophysCell'
+    :param sec_type: str
+    :param syn_name: str
+    :param param_name: str
+    :param param_key: str or None; name of the expression parameter
+    :param param_value: float
+    :param sources: list of str
+    :param is_reduced: bool
+    :param compiled: bool
+    """
+    filters = {'sources': sources} if sources is not None else None
+    origin = None if is_reduced else 'soma'
+    if compiled and (param_key is None):
+        binding = synapses.get_syn_param_binding(biophys_cell, env, sec_type, syn_name, param_name,
+                                                 filters=filters, origin=origin)
+        if binding is not None:
+            binding.apply(param_value)
+            return
+    synapses.modify_syn_param(biophys_cell, env, sec_type, syn_name,
+                              param_name=param_name,
+                              value={param_key: param_value} if (param_key is not None) else param_value,
+                              filters=filters, origin=origin, update_targets=True)
+
+
+def update_network_params(env, param_tuples, compiled=True):
     
     for population in env.biophys_cells:
         
@@ -315,15 +350,11 @@ def update_network_params(env, param_tuples):
                     is_reduced = biophys_cell.is_reduced
 
                 for this_sec_type in sec_types:
-                    synapses.modify_syn_param(biophys_cell, env, this_sec_type, syn_name,
-                                              param_name=p, 
-                                              value={s: param_value} if (s is not None) else param_value,
-                                              filters={'sources': sources} if sources is not None else None,
-                                              origin=None if is_reduced else 'soma', 
-                                              update_targets=True)
+                    update_syn_param(env, biophys_cell, this_sec_type, syn_name, p, s, param_value,
+                                     sources=sources, is_reduced=is_reduced, compiled=compiled)
 
 
-def update_run_params(env, param_tuples):
+def update_run_params(env, param_tuples, compiled=True):
     
     for population in env.biophys_cells:
         
@@ -366,24 +397,33 @@ def update_run_params(env, param_tuples):
                     is_reduced = biophys_cell.is_reduced
 
                 for this_sec_type in sec_types:
-                    synapses.modify_syn_param(biophys_cell, env, this_sec_type, syn_name,
-                                              param_name=p, 
-                                              value={s: param_value} if (s is not None) else param_value,
-                                              filters={'sources': sources} if sources is not None else None,
-                                              origin=None if is_reduced else 'soma', 
-                                              update_targets=True)
+                    update_syn_param(env, biophys_cell, this_sec_type, syn_name, p, s, param_value,
+                                     sources=sources, is_reduced=is_reduced, compiled=compiled)
 
 
 
-def network_features(env, target_trj_rate_map_dict, t_start, t_stop, target_populations):
+def network_features(env, target_trj_rate_map_dict, t_start, t_stop, target_populations, use_spike_accumulator=False):
 
     features_dict = dict()
  
     temporal_resolution = float(env.stimulus_config['Temporal Resolution'])
     time_bins  = np.arange(t_start, t_stop, temporal_resolution)
 
-    pop_spike_dict = spikedata.get_env_spike_dict(env, include_artificial=False)
-    
+    ## If use_spike_accumulator is True, the spike trains are
+    ## reconstructed from the per-gid binned counts accumulated
+    ## during the simulation, with each spike placed at the center of
+    ## its bin, and the rates are estimated with the same spike
+    ## density estimator as the recorded spike trains.
+    spike_accumulator = env.spike_accumulator
+    if use_spike_accumulator:
+        if spike_accumulator is None or spike_accumulator.gid_bin_size is None:
+            raise RuntimeError('network_features: use_spike_accumulator requires a spike accumulator with per-gid binning')
+        accumulator_bin_centers = spike_accumulator.gid_time_bins() + 0.5 * spike_accumulator.gid_bin_size
+    else:
+        if spike_accumulator is not None and spike_accumulator.clear_data:
+            raise RuntimeError('network_features: recorded spikes are cleared by the spike accumulator; '
+                               'use_spike_accumulator is required')
+        pop_spike_arrays = spikedata.get_env_spike_arrays(env, include_artificial=False)
 
     for pop_name in target_populations:
 
@@ -391,7 +431,14 @@ def network_features(env, target_trj_rate_map_dict, t_start, t_stop, target_popu
 
         n_active = 0
         sum_mean_rate = 0.
-        spike_density_dict = spikedata.spike_density_estimate (pop_name, pop_spike_dict[pop_name], time_bins)
+        if use_spike_accumulator:
+            pop_gids = spike_accumulator.gids[pop_name]
+            pop_counts = spike_accumulator.spike_counts[pop_name][:, 0, :]
+            pop_spkdict = { gid: np.repeat(accumulator_bin_centers, gid_counts)
+                            for gid, gid_counts in zip(pop_gids, pop_counts) }
+            spike_density_dict = spikedata.spike_density_estimate (pop_name, pop_spkdict, time_bins)
+        else:
+            spike_density_dict = spikedata.spike_density_estimate (pop_name, pop_spike_arrays[pop_name], time_bins)
         for gid, dens_dict in utils.viewitems(spike_density_dict):
             mean_rate = np.mean(dens_dict['rate'])
             sum_mean_rate += mean_rate
@@ -322,7 +322,13 @@ def network_objfun(env, operational_config, opt_targets,
     env.tstop = t_stop
     network.run(env, output=False, shutdown=False)
 
-    return network_features(env, target_trj_rate_map_dict, t_start, t_stop, target_populations)
+    features_dict = network_features(env, target_trj_rate_map_dict, t_start, t_stop, target_populations,
+                                     use_spike_accumulator=operational_config.get('use_spike_accumulator', False))
+    watchdog_triggered = (env.activity_watchdog is not None) and env.activity_watchdog.triggered
+    for pop_name in features_dict:
+        features_dict[pop_name]['watchdog_triggered'] = watchdog_triggered
+
+    return features_dict
 
 
 
@@ -330,6 +336,7 @@ def compute_objectives(local_features, operational_config, opt_targets):
 
     all_features_dict = {}
     constraints = []
+    watchdog_triggered = False
     
     target_populations = operational_config['target_populations']
     for pop_name in target_populations:
@@ -348,6 +355,7 @@ def compute_objectives(local_features, operational_config, opt_targets):
             n_target_rate_map_local = pop_feature_dict['n_target_rate_map']
             sum_mean_rate_local = pop_feature_dict['sum_mean_rate']
             sum_snr_local = pop_feature_dict['sum_snr']
+            watchdog_triggered = watchdog_triggered or pop_feature_dict.get('watchdog_triggered', False)
 
             n_total += n_total_local
             n_active += n_active_local
@@ -401,6 +409,14 @@ def compute_objectives(local_features, operational_config, opt_targets):
         objectives.append(objective)
         features.append(feature_val)
 
+    ## Simulations stopped early by the activity watchdog are assigned
+    ## a sentinel objective value and infeasible constraints
+    if watchdog_triggered:
+        watchdog_objective = operational_config.get('watchdog_objective', 1e6)
+        logger.info(f'simulation stopped by activity watchdog; objectives set to {watchdog_objective}')
+        objectives = [watchdog_objective] * len(objectives)
+        constraints = [-1.] * len(constraints)
+
     result = (np.asarray(objectives),
               np.array([tuple(features)], dtype=np.dtype(feature_dtypes)),
               np.asarray(constraints, dtype=np.float32))
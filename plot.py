@@ -18,7 +18,7 @@ from matplotlib.ticker import FormatStrFormatter, MaxNLocator
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import dentate
 from dentate.graph import vertex_distribution, vertex_metrics
-from dentate.statedata import read_state, query_state
+from dentate.statedata import read_state, read_state_arrays, query_state
 from dentate.cells import default_ordered_sec_types, get_distance_to_node, make_biophys_morph_graph
 from dentate.env import Env
 from dentate.synapses import get_syn_filter_dict, get_syn_mech_param
@@ -1908,30 +1908,39 @@ def plot_intracellular_state (input_path, namespace_ids, include = ['eachPop'],
                         raise RuntimeError('unable to find recording for state variable %s population %s namespace %s' % (state_variable, population, namespace))
 
 
-    pop_states_dict = defaultdict(lambda: defaultdict(lambda: dict()))
+    pop_state_arrays_dict = defaultdict(lambda: dict())
     for namespace_id in namespace_ids:
         logger.info(f"Reading state values from namespace {namespace_id}...")
-        data = read_state (input_path, include, namespace_id, time_variable=time_variable,
-                           state_variables=[state_variable], time_range=time_range, max_units = max_units,
-                           gid = gid_set, n_trials=n_trials)
+        data = read_state_arrays (input_path, include, namespace_id, time_variable=time_variable,
+                                  state_variables=[state_variable], time_range=time_range, max_units = max_units,
+                                  gid = gid_set, n_trials=n_trials)
         states  = data['states']
         n_trials = data['n_trials']
         
-        for (pop_name, pop_states) in viewitems(states):
-            for (gid, cell_states) in viewitems(pop_states):
-                pop_states_dict[pop_name][gid][namespace_id] = cell_states
+        for (pop_name, state_arrays) in viewitems(states):
+            pop_state_arrays_dict[pop_name][namespace_id] = state_arrays
 
     pop_state_mat_dict = defaultdict(lambda: dict())
-    for (pop_name, pop_states) in viewitems(pop_states_dict):
-        for (gid, cell_state_dict) in viewitems(pop_states):
-            nss = sorted(cell_state_dict.keys())
-            cell_state_x = cell_state_dict[nss[0]][time_variable]
-            cell_state_mats = np.stack([np.row_stack([cell_state_dict[ns][state_variable][i][:len(cell_state_x[0])]
-                                                      for ns in nss])
+    for (pop_name, ns_state_arrays) in viewitems(pop_state_arrays_dict):
+        nss = sorted(ns_state_arrays.keys())
+        pop_gids = np.unique(np.concatenate([ns_state_arrays[ns].gids for ns in nss]))
+        ## State matrices of each namespace and trial, with one row per recorded gid in the order of pop_gids
+        ns_has_gid = { ns: ns_state_arrays[ns].index(pop_gids) >= 0 for ns in nss }
+        ns_rows = { ns: np.cumsum(ns_has_gid[ns]) - 1 for ns in nss }
+        ns_state_mats = { ns: [ns_state_arrays[ns].trial_states(state_variable, i, pop_gids[ns_has_gid[ns]])
+                               for i in range(n_trials)] for ns in nss }
+        ns_distances = { ns: ns_state_arrays[ns].cell_attrs('distance', pop_gids[ns_has_gid[ns]]) for ns in nss }
+        ns_ri = { ns: ns_state_arrays[ns].cell_attrs('ri', pop_gids[ns_has_gid[ns]]) for ns in nss }
+        for k, gid in enumerate(pop_gids.tolist()):
+            gid_nss = [ns for ns in nss if ns_has_gid[ns][k]]
+            cell_state_x = [ns_state_arrays[gid_nss[0]].trial_time(i) for i in range(n_trials)]
+            cell_state_mats = np.stack([np.row_stack([ns_state_mats[ns][i][ns_rows[ns][k], :len(cell_state_x[0])]
+                                                      for ns in gid_nss])
                                         for i in range(n_trials)], axis=0)
-            cell_state_distances = [cell_state_dict[ns]['distance'] for ns in nss]
-            cell_state_ri = [cell_state_dict[ns]['ri'] for ns in nss]
-            cell_state_labels = [f'{ns} {state_variable}' for ns in nss]
+            cell_state_distances = [None if ns_distances[ns] is None else ns_distances[ns][ns_rows[ns][k]]
+                                    for ns in gid_nss]
+            cell_state_ri = [None if ns_ri[ns] is None else ns_ri[ns][ns_rows[ns][k]] for ns in gid_nss]
+            cell_state_labels = [f'{ns} {state_variable}' for ns in gid_nss]
             pop_state_mat_dict[pop_name][gid] = (cell_state_x, cell_state_mats, cell_state_labels, cell_state_distances, cell_state_ri)
     
     stplots = []
@@ -2096,29 +2105,39 @@ def plot_state_in_tree (state_path, state_namespace_ids, population, gid, cell_d
     for (gid,tree_dict) in tree_iter:
         tree_dict = tree_dict
     
-    pop_states_dict = defaultdict(lambda: defaultdict(lambda: dict()))
+    pop_state_arrays_dict = defaultdict(lambda: dict())
     for namespace_id in state_namespace_ids:
         logger.info(f"Reading state values from namespace {namespace_id}...")
-        data = read_state (state_path, include, namespace_id, time_variable=time_variable,
-                           state_variables=[state_variable], time_range=time_range, 
-                           gid = gid_set, n_trials=n_trials)
+        data = read_state_arrays (state_path, include, namespace_id, time_variable=time_variable,
+                                  state_variables=[state_variable], time_range=time_range, 
+                                  gid = gid_set, n_trials=n_trials)
         states  = data['states']
         
-        for (pop_name, pop_states) in viewitems(states):
-            for (gid, cell_states) in viewitems(pop_states):
-                pop_states_dict[pop_name][gid][namespace_id] = cell_states
+        for (pop_name, state_arrays) in viewitems(states):
+            pop_state_arrays_dict[pop_name][namespace_id] = state_arrays
 
 
     pop_state_mat_dict = defaultdict(lambda: dict())
-    for (pop_name, pop_states) in viewitems(pop_states_dict):
-        for (gid, cell_state_dict) in viewitems(pop_states):
-            nss = sorted(cell_state_dict.keys())
-            cell_state_x = cell_state_dict[nss[0]][time_variable]
-            cell_state_sections = [cell_state_dict[ns]['section'] for ns in nss]
-            cell_state_mat = { section_index: np.mean(np.row_stack(cell_state_dict[ns][state_variable]), axis=0)
-                               for section_index, ns in zip(cell_state_sections, nss) }
-            cell_state_locs = [cell_state_dict[ns]['loc'] for ns in nss]
-            cell_state_labels = [f'{ns} {state_variable}' for ns in nss]
+    for (pop_name, ns_state_arrays) in viewitems(pop_state_arrays_dict):
+        nss = sorted(ns_state_arrays.keys())
+        pop_gids = np.unique(np.concatenate([ns_state_arrays[ns].gids for ns in nss]))
+        ## Trial-averaged state matrices of each namespace, with one row per recorded gid in the order of pop_gids
+        ns_has_gid = { ns: ns_state_arrays[ns].index(pop_gids) >= 0 for ns in nss }
+        ns_rows = { ns: np.cumsum(ns_has_gid[ns]) - 1 for ns in nss }
+        ns_state_means = { ns: np.mean(np.stack([ns_state_arrays[ns].trial_states(state_variable, i,
+                                                                                  pop_gids[ns_has_gid[ns]])
+                                                 for i in range(ns_state_arrays[ns].n_trials)]), axis=0)
+                           for ns in nss }
+        ns_sections = { ns: ns_state_arrays[ns].cell_attrs('section', pop_gids[ns_has_gid[ns]]) for ns in nss }
+        ns_locs = { ns: ns_state_arrays[ns].cell_attrs('loc', pop_gids[ns_has_gid[ns]]) for ns in nss }
+        for k, gid in enumerate(pop_gids.tolist()):
+            gid_nss = [ns for ns in nss if ns_has_gid[ns][k]]
+            cell_state_x = [ns_state_arrays[gid_nss[0]].trial_time(i) for i in range(ns_state_arrays[gid_nss[0]].n_trials)]
+            cell_state_sections = [None if ns_sections[ns] is None else ns_sections[ns][ns_rows[ns][k]] for ns in gid_nss]
+            cell_state_mat = { section_index: ns_state_means[ns][ns_rows[ns][k]]
+                               for section_index, ns in zip(cell_state_sections, gid_nss) }
+            cell_state_locs = [None if ns_locs[ns] is None else ns_locs[ns][ns_rows[ns][k]] for ns in gid_nss]
+            cell_state_labels = [f'{ns} {state_variable}' for ns in gid_nss]
             pop_state_mat_dict[pop_name][gid] = (cell_state_x,
                                                  cell_state_mat,
                                                  cell_state_labels,
@@ -2270,29 +2289,39 @@ def plot_state_correlation_in_tree (config_file, config_prefix, state_path, stat
     for (gid,tree_dict) in tree_iter:
         tree_dict = tree_dict
     
-    pop_states_dict = defaultdict(lambda: defaultdict(lambda: dict()))
+    pop_state_arrays_dict = defaultdict(lambda: dict())
     for namespace_id in state_namespace_ids:
         logger.info(f"Reading state values from namespace {namespace_id}...")
-        data = read_state (state_path, include, namespace_id, time_variable=time_variable,
-                           state_variables=[state_variable], time_range=time_range, 
-                           gid = gid_set, n_trials=n_trials)
+        data = read_state_arrays (state_path, include, namespace_id, time_variable=time_variable,
+                                  state_variables=[state_variable], time_range=time_range, 
+                                  gid = gid_set, n_trials=n_trials)
         states  = data['states']
         
-        for (pop_name, pop_states) in viewitems(states):
-            for (gid, cell_states) in viewitems(pop_states):
-                pop_states_dict[pop_name][gid][namespace_id] = cell_states
+        for (pop_name, state_arrays) in viewitems(states):
+            pop_state_arrays_dict[pop_name][namespace_id] = state_arrays
 
 
     pop_state_mat_dict = defaultdict(lambda: dict())
-    for (pop_name, pop_states) in viewitems(pop_states_dict):
-        for (gid, cell_state_dict) in viewitems(pop_states):
-            nss = sorted(cell_state_dict.keys())
-            cell_state_x = cell_state_dict[nss[0]][time_variable]
-            cell_state_sections = [cell_state_dict[ns]['section'] for ns in nss]
-            cell_state_mat = { section_index: np.mean(np.row_stack(cell_state_dict[ns][state_variable]), axis=0)
-                               for section_index, ns in zip(cell_state_sections, nss) }
-            cell_state_locs = [cell_state_dict[ns]['loc'] for ns in nss]
-            cell_state_labels = [f'{ns} {state_variable}' for ns in nss]
+    for (pop_name, ns_state_arrays) in viewitems(pop_state_arrays_dict):
+        nss = sorted(ns_state_arrays.keys())
+        pop_gids = np.unique(np.concatenate([ns_state_arrays[ns].gids for ns in nss]))
+        ## Trial-averaged state matrices of each namespace, with one row per recorded gid in the order of pop_gids
+        ns_has_gid = { ns: ns_state_arrays[ns].index(pop_gids) >= 0 for ns in nss }
+        ns_rows = { ns: np.cumsum(ns_has_gid[ns]) - 1 for ns in nss }
+        ns_state_means = { ns: np.mean(np.stack([ns_state_arrays[ns].trial_states(state_variable, i,
+                                                                                  pop_gids[ns_has_gid[ns]])
+                                                 for i in range(ns_state_arrays[ns].n_trials)]), axis=0)
+                           for ns in nss }
+        ns_sections = { ns: ns_state_arrays[ns].cell_attrs('section', pop_gids[ns_has_gid[ns]]) for ns in nss }
+        ns_locs = { ns: ns_state_arrays[ns].cell_attrs('loc', pop_gids[ns_has_gid[ns]]) for ns in nss }
+        for k, gid in enumerate(pop_gids.tolist()):
+            gid_nss = [ns for ns in nss if ns_has_gid[ns][k]]
+            cell_state_x = [ns_state_arrays[gid_nss[0]].trial_time(i) for i in range(ns_state_arrays[gid_nss[0]].n_trials)]
+            cell_state_sections = [None if ns_sections[ns] is None else ns_sections[ns][ns_rows[ns][k]] for ns in gid_nss]
+            cell_state_mat = { section_index: ns_state_means[ns][ns_rows[ns][k]]
+                               for section_index, ns in zip(cell_state_sections, gid_nss) }
+            cell_state_locs = [None if ns_locs[ns] is None else ns_locs[ns][ns_rows[ns][k]] for ns in gid_nss]
+            cell_state_labels = [f'{ns} {state_variable}' for ns in gid_nss]
             pop_state_mat_dict[pop_name][gid] = (cell_state_x,
                                                  cell_state_mat,
                                                  cell_state_labels,
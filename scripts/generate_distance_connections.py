@@ -10,7 +10,7 @@ import dentate
 import dentate.utils as utils
 from dentate.connection_generator import ConnectionProb, generate_uv_distance_connections
 from dentate.env import Env
-from dentate.geometry import make_distance_interpolant, measure_distances
+from dentate.geometry import SomaDistanceArrays, make_distance_interpolant, measure_distances
 from dentate.neuron_utils import configure_hoc_env
 from neuroh5.io import read_cell_attributes, read_population_names, read_population_ranges
 import h5py
@@ -43,12 +43,13 @@ sys.excepthook = mpi_excepthook
 @click.option("--value-chunk-size", type=int, default=1000)
 @click.option("--cache-size", type=int, default=1)
 @click.option("--write-size", type=int, default=1)
+@click.option("--batch-size", type=int, default=1)
 @click.option("--verbose", "-v", is_flag=True)
 @click.option("--dry-run", is_flag=True)
 @click.option("--debug", is_flag=True)
 def main(config, config_prefix, include, forest_path, connectivity_path, connectivity_namespace, coords_path, 
          coords_namespace, synapses_namespace, distances_namespace, resolution, interp_chunk_size, io_size,
-         chunk_size, value_chunk_size, cache_size, write_size, verbose, dry_run, debug):
+         chunk_size, value_chunk_size, cache_size, write_size, batch_size, verbose, dry_run, debug):
 
     utils.config_logging(verbose)
     logger = utils.get_script_logger(os.path.basename(__file__))
@@ -95,8 +96,8 @@ def main(config, config_prefix, include, forest_path, connectivity_path, connect
                                             float(v['V Coordinate'][0]), 
                                             float(v['L Coordinate'][0])) for (k,v) in coords_iter }
 
-            distances = { k: (float(v['U Distance'][0]), 
-                              float(v['V Distance'][0])) for (k,v) in distances_iter }
+            distances = SomaDistanceArrays.from_dict({ k: (float(v['U Distance'][0]), 
+                                                           float(v['V Distance'][0])) for (k,v) in distances_iter })
             
             if len(distances) > 0:
                  soma_distances[population] = distances
@@ -123,7 +124,8 @@ def main(config, config_prefix, include, forest_path, connectivity_path, connect
     if len(soma_distances) == 0:
         (origin_ranges, ip_dist_u, ip_dist_v) = make_distance_interpolant(env, resolution=resolution, nsample=nsample)
         ip_dist = (origin_ranges, ip_dist_u, ip_dist_v)
-        soma_distances = measure_distances(env, soma_coords, ip_dist, resolution=resolution)
+        soma_distances = measure_distances(env, soma_coords, ip_dist, resolution=resolution,
+                                           allgather=True, columnar=True)
 
 
     for destination_population in destination_populations:
@@ -149,7 +151,7 @@ def main(config, config_prefix, include, forest_path, connectivity_path, connect
                                          synapse_seed, connectivity_seed, cluster_seed,
                                          synapses_namespace, connectivity_namespace, connectivity_path,
                                          io_size, chunk_size, value_chunk_size, cache_size, write_size,
-                                         dry_run=dry_run, debug=debug)
+                                         batch_size=batch_size, dry_run=dry_run, debug=debug)
     MPI.Finalize()
 
 if __name__ == '__main__':
@@ -39,8 +39,10 @@ sys.excepthook = mpi_excepthook
 @click.option("--write-size", type=int, default=1)
 @click.option("--verbose", "-v", is_flag=True)
 @click.option("--dry-run", is_flag=True)
+@click.option("--hoc-cells/--no-hoc-cells", default=True,
+              help='choose gap junction locations on instantiated hoc cells, or on morphologies computed from the neurotree data')
 def main(config, template_path, types_path, forest_path, connectivity_path, connectivity_namespace, coords_path, coords_namespace,
-         io_size, chunk_size, value_chunk_size, cache_size, write_size, verbose, dry_run):
+         io_size, chunk_size, value_chunk_size, cache_size, write_size, verbose, dry_run, hoc_cells):
 
     utils.config_logging(verbose)
     logger = utils.get_script_logger(os.path.basename(__file__))
@@ -96,7 +98,7 @@ def main(config, template_path, types_path, forest_path, connectivity_path, conn
     generate_gj_connections(env, forest_path, soma_coords, gj_config, gj_seed, 
                             connectivity_namespace, connectivity_path,
                             io_size, chunk_size, value_chunk_size, cache_size,
-                            dry_run=dry_run)
+                            dry_run=dry_run, hoc_cells=hoc_cells)
 
         
     MPI.Finalize()
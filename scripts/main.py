@@ -88,6 +88,7 @@ sys.excepthook = mpi_excepthook
 @click.option("--lptbal", is_flag=True, help='optimize load balancing assignment with LPT algorithm')
 @click.option('--cleanup/--no-cleanup', default=True,
               help='delete from memory the synapse attributes metadata after specifying connections')
+@click.option('--columnar-synapses', is_flag=True, help='store synapse attributes in per-cell columnar arrays')
 @click.option('--profile-memory', is_flag=True, help='calculate and print heap usage while constructing the network')
 @click.option("--write-selection", is_flag=True, help='write out cell and connectivity data for selection')
 @click.option('--verbose', '-v', is_flag=True, help='print verbose diagnostic messages while constructing the network')
@@ -97,7 +98,7 @@ def main(arena_id, cell_selection_path, config, template_paths, hoc_lib_path, da
          results_path, results_id, node_rank_file, io_size, use_cell_attr_gen, cell_attr_gen_cache_size, recording_fraction, recording_scale, recording_profile, output_syn_spike_count,
          use_coreneuron, trajectory_id, tstop, v_init, stimulus_onset, max_walltime_hours, microcircuit_inputs, 
          checkpoint_clear_data, checkpoint_interval, results_write_time, spike_input_path, spike_input_namespace, 
-         spike_input_attr, dt, ldbal, lptbal, cleanup, profile_memory, write_selection, verbose, debug, dry_run):
+         spike_input_attr, dt, ldbal, lptbal, cleanup, columnar_synapses, profile_memory, write_selection, verbose, debug, dry_run):
 
     profile_time = False
     config_logging(verbose)
@@ -1,10 +1,11 @@
-import sys, math, copy
+import os, sys, math, copy, itertools, hashlib, shutil
 from collections import defaultdict
 import numpy as np
+from mpi4py import MPI
 from scipy import interpolate
-from neuroh5.io import scatter_read_cell_attributes, read_cell_attributes, read_population_names, read_population_ranges, write_cell_attributes
+from neuroh5.io import scatter_read_cell_attributes, read_cell_attributes, read_population_names, read_population_ranges, write_cell_attributes, append_cell_attributes
 import dentate
-from dentate.utils import get_module_logger, Struct, autocorr, baks, consecutive, mvcorrcoef, viewitems, zip, get_trial_time_ranges
+from dentate.utils import get_module_logger, Struct, autocorr, baks, baks_batch, consecutive, mvcorrcoef, viewitems, zip, get_trial_time_ranges
 
 ## This logger will inherit its setting from its root logger, dentate,
 ## which is created in module env
@@ -12,26 +13,132 @@ logger = get_module_logger(__name__)
 
 # Default spike analysis configuration
 default_baks_analysis_options = Struct(**{'BAKS Alpha': 4.77,
-                                          'BAKS Beta': None})
+                                          'BAKS Beta': None,
+                                          'BAKS Truncate': None})
 default_pf_analysis_options = Struct(**{'Minimum Width': 10.,
                                         'Minimum Rate': None})
 
 
-def get_env_spike_dict(env, include_artificial=True):
+class SpikeTrainArrays(object):
+    """Columnar spike trains of one population, with the spike times
+    of each cell and trial stored as consecutive segments of a single
+    time array (CSR layout):
+      - gids - sorted cell gids (uint32)
+      - t - spike times (float32), grouped by gid and then by trial
+      - offsets - segment boundaries of shape (len(gids) * n_trials + 1,);
+        the spike times of the gid at index i in trial j are
+        t[offsets[i * n_trials + j]:offsets[i * n_trials + j + 1]]
+      - n_trials - number of trials
     """
-    Constructs  a dictionary with per-gid per-trial spike times from the output vectors with spike times and gids contained in env.
+
+    __slots__ = 'gids', 't', 'offsets', 'n_trials'
+
+    def __init__(self, gids, t, offsets, n_trials):
+        self.gids = gids
+        self.t = t
+        self.offsets = offsets
+        self.n_trials = n_trials
+
+    def __len__(self):
+        return len(self.gids)
+
+    def __contains__(self, gid):
+        return self.index(gid) >= 0
+
+    def index(self, gids):
+        """
+        Returns the positions of the given gids in the gids array, and
+        -1 for gids that have no spikes.
+        """
+        gids = np.asarray(gids)
+        pos = np.searchsorted(self.gids, gids)
+        if len(self.gids) == 0:
+            return np.full(pos.shape, -1, dtype=np.intp) if pos.ndim > 0 else -1
+        pos_clip = np.minimum(pos, len(self.gids) - 1)
+        return np.where(self.gids[pos_clip] == gids, pos_clip, -1)
+
+    def bounds(self, trial, gid_index=None):
+        """
+        Returns the start and end offsets of the spike trains of the
+        given trial, for all gids or for the given gid positions.
+        """
+        rows = np.arange(len(self.gids)) if gid_index is None else np.asarray(gid_index)
+        rows = rows * self.n_trials + trial
+        return self.offsets[rows], self.offsets[rows + 1]
+
+    def spike_train(self, gid, trial):
+        """
+        Returns the spike times of the given gid in the given trial
+        (empty if the gid has no spikes).
+        """
+        i = self.index(gid)
+        if i < 0:
+            return np.asarray([], dtype=np.float32)
+        k = i * self.n_trials + trial
+        return self.t[self.offsets[k]:self.offsets[k+1]]
+
+    def spike_counts(self, gids=None):
+        """
+        Returns the spike counts per gid and trial as an array of
+        shape (number of gids, n_trials). If gids is given, rows are in
+        the order of gids, with zero counts for gids that have no spikes.
+        """
+        counts = np.diff(self.offsets).reshape((len(self.gids), self.n_trials))
+        if gids is None:
+            return counts
+        gid_index = self.index(gids)
+        result = np.zeros((len(gid_index), self.n_trials), dtype=counts.dtype)
+        has_spikes = gid_index >= 0
+        result[has_spikes] = counts[gid_index[has_spikes]]
+        return result
+
+    def select(self, gids):
+        """
+        Returns a :class:'SpikeTrainArrays' object with the spike
+        trains of the given gids; gids without spikes are included
+        with empty spike trains.
+        """
+        gids = np.unique(np.asarray(gids, dtype=self.gids.dtype))
+        gid_index = self.index(gids)
+        counts = self.spike_counts(gids).reshape((-1,))
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        rows = (np.maximum(gid_index, 0)[:, np.newaxis] * self.n_trials + np.arange(self.n_trials)).reshape((-1,))
+        src = np.repeat(self.offsets[rows] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return SpikeTrainArrays(gids, self.t[src], offsets, self.n_trials)
+
+    def to_dict(self):
+        """
+        Returns the spike trains as a dictionary { gid: [ trial spike times ] }.
+        """
+        offsets = self.offsets
+        n_trials = self.n_trials
+        return {gid: [np.copy(self.t[offsets[i*n_trials+j]:offsets[i*n_trials+j+1]]) for j in range(n_trials)]
+                for i, gid in enumerate(self.gids)}
+
+
+def get_env_spike_arrays(env, include_artificial=True):
+    """
+    Constructs per-population columnar spike trains from the output
+    vectors with spike times and gids contained in env. Spike times
+    are relative to the start of their trial, after equilibration.
+
+    :param env: :class:'Env'
+    :param include_artificial: whether to include the spikes of artificial cells
+    :return: dict { pop_name: :class:'SpikeTrainArrays' }
     """
     equilibration_duration = float(env.stimulus_config['Equilibration Duration'])
     n_trials = env.n_trials
 
-    t_vec = env.t_vec.as_numpy()
+    t_vec = np.asarray(env.t_vec.as_numpy(), dtype=np.float32)
     id_vec = np.asarray(env.id_vec.as_numpy(), dtype=np.uint32)
 
     trial_time_ranges = get_trial_time_ranges(env.t_rec.to_python(), env.n_trials)
     trial_time_bins = [ t_trial_start for t_trial_start, t_trial_end in trial_time_ranges ] 
     trial_dur = np.asarray([env.tstop + equilibration_duration] * n_trials, dtype=np.float32)
+    trial_offsets = np.asarray([np.sum(trial_dur[:trial_i]) + equilibration_duration for trial_i in range(n_trials)],
+                               dtype=np.float32)
     
-    binlst = []
     typelst = sorted(env.celltypes.keys())
     binvect = np.asarray([env.celltypes[k]['start'] for k in typelst ])
     sort_idx = np.argsort(binvect, axis=0)
@@ -39,41 +146,72 @@ def get_env_spike_dict(env, include_artificial=True):
     bins = binvect[sort_idx][1:]
     inds = np.digitize(id_vec, bins)
 
-    pop_spkdict = {}
+    if len(env.spike_onset_delay) > 0:
+        delay_gids = np.fromiter(env.spike_onset_delay.keys(), dtype=np.int64, count=len(env.spike_onset_delay))
+        delay_order = np.argsort(delay_gids)
+        delay_gids = delay_gids[delay_order]
+        delays = np.asarray(list(env.spike_onset_delay.values()), dtype=np.float32)[delay_order]
+    else:
+        delay_gids = None
+
+    pop_spike_arrays = {}
     for i, pop_name in enumerate(pop_names):
-        spkdict = {}
-        sinds = np.where(inds == i)
-        if len(sinds) > 0:
-            ids = id_vec[sinds]
-            ts = t_vec[sinds]
-            for j in range(0, len(ids)):
-                gid = ids[j]
-                t = ts[j]
-                if (not include_artificial) and (gid in env.artificial_cells[pop_name]):
-                    continue
-                if gid in spkdict:
-                   spkdict[gid].append(t)
-                else:
-                   spkdict[gid] = [t]
-            for gid in spkdict:
-                spiketrain = np.array(spkdict[gid], dtype=np.float32)
-                if gid in env.spike_onset_delay:
-                    spiketrain -= env.spike_onset_delay[gid]
-                trial_bins = np.digitize(spiketrain, trial_time_bins) - 1
-                trial_spikes = [np.copy(spiketrain[np.where(trial_bins == trial_i)[0]])
-                                for trial_i in range(env.n_trials)]
-                for trial_i, trial_spiketrain in enumerate(trial_spikes):
-                    trial_spiketrain -= np.sum(trial_dur[:(trial_i)]) + equilibration_duration
-                spkdict[gid] = trial_spikes
-        pop_spkdict[pop_name] = spkdict
-
-    return pop_spkdict
+        sinds = np.flatnonzero(inds == i)
+        ids = id_vec[sinds]
+        ts = t_vec[sinds]
+        if (not include_artificial) and len(env.artificial_cells[pop_name]) > 0:
+            artificial_gids = np.fromiter(env.artificial_cells[pop_name], dtype=np.int64)
+            is_real = ~np.isin(ids, artificial_gids)
+            ids = ids[is_real]
+            ts = ts[is_real]
+        if delay_gids is not None and len(ids) > 0:
+            pos = np.minimum(np.searchsorted(delay_gids, ids), len(delay_gids) - 1)
+            has_delay = delay_gids[pos] == ids
+            ts = np.where(has_delay, ts - delays[pos], ts)
+        gids, gid_index = np.unique(ids, return_inverse=True)
+        trial_index = np.digitize(ts, trial_time_bins) - 1
+        in_trial = (trial_index >= 0) & (trial_index < n_trials)
+        gid_index = gid_index[in_trial]
+        trial_index = trial_index[in_trial]
+        ts = ts[in_trial] - trial_offsets[trial_index]
+        order = np.lexsort((trial_index, gid_index))
+        rows = gid_index[order] * n_trials + trial_index[order]
+        offsets = np.zeros(len(gids) * n_trials + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(gids) * n_trials), out=offsets[1:])
+        pop_spike_arrays[pop_name] = SpikeTrainArrays(gids, ts[order], offsets, n_trials)
+
+    return pop_spike_arrays
 
 
-def read_spike_events(input_file, population_names, namespace_id, spike_train_attr_name='t', time_range=None,
-                      max_spikes=None, n_trials=-1, merge_trials=False, comm=None, io_size=0, include_artificial=True):
+def get_env_spike_dict(env, include_artificial=True):
     """
-    Reads spike trains from a NeuroH5 file, and returns a dictionary with spike times and cell indices.
+    Constructs  a dictionary with per-gid per-trial spike times from the output vectors with spike times and gids contained in env.
+    """
+    return {pop_name: spike_arrays.to_dict()
+            for pop_name, spike_arrays in viewitems(get_env_spike_arrays(env, include_artificial=include_artificial))}
+
+
+def read_spike_events_iter(input_file, population_names, namespace_id, spike_train_attr_name='t', time_range=None,
+                           max_spikes=None, n_trials=-1, merge_trials=False, comm=None, io_size=0, include_artificial=True):
+    """
+    Reads spike trains from a NeuroH5 file, and yields the spike
+    events of each population in columnar form, one population at a
+    time. The per-cell spike trains are concatenated once, and trial
+    merging and time filtering are performed with array operations.
+
+    For each population, yields a tuple (pop_name, pop_spkdata), where
+    pop_spkdata is a dictionary with the following keys:
+
+      - gid: array of cell indices of the spike events
+      - t: array of spike times
+      - trial: array of trial indices of the spike events
+      - active_cells: set of indices of cells with at least one spike
+      - num_cell_spks: number of spike events read for the population
+      - n_trials: number of trials
+      - tmin, tmax: minimum and maximum spike times of the population
+
+    The event arrays are sorted by trial and then by spike time.
+
     :param input_file: str (path to file)
     :param population_names: list of str
     :param namespace_id: str
@@ -82,23 +220,18 @@ def read_spike_events(input_file, population_names, namespace_id, spike_train_at
     :param max_spikes: float
     :param n_trials: int
     :param merge_trials: bool
-    :return: dict
+    :return: generator of (str, dict)
     """
     assert((n_trials >= 1) | (n_trials == -1))
 
     trial_index_attr = 'Trial Index'
     trial_dur_attr = 'Trial Duration'
     artificial_attr = 'artificial'
-    
-    spkpoplst = []
-    spkindlst = []
-    spktlst = []
-    spktrials = []
-    num_cell_spks = {}
-    pop_active_cells = {}
 
-    tmin = float('inf')
-    tmax = 0.
+    # Time Range
+    if time_range is not None:
+        if time_range[0] is None:
+            time_range[0] = 0.0
 
     for pop_name in population_names:
 
@@ -112,64 +245,49 @@ def read_spike_events(input_file, population_names, namespace_id, spike_train_at
                                                     mask=spike_train_attr_set, comm=comm, io_size=io_size)
         spkiter = spkiter_dict[namespace_id]
         
-        this_num_cell_spks = 0
-        active_set = set([])
-
         pop_spkindlst = []
         pop_spktlst = []
         pop_spktriallst = []
 
         logger.info('Read spike cell attributes for population %s...' % pop_name)
 
-        # Time Range
-        if time_range is not None:
-            if time_range[0] is None:
-                time_range[0] = 0.0
-
         for spkind, spkattrs in spkiter:
             is_artificial_flag = spkattrs.get(artificial_attr, None)
             is_artificial = (is_artificial_flag[0] > 0) if is_artificial_flag is not None else None
             if is_artificial is not None:
                 if is_artificial and (not include_artificial):
                     continue
-            slen = len(spkattrs[spike_train_attr_name])
-            trial_dur = spkattrs.get(trial_dur_attr, np.asarray([0.]))
+            spkts = spkattrs[spike_train_attr_name]
+            slen = len(spkts)
             trial_ind = spkattrs.get(trial_index_attr, np.zeros((slen,),dtype=np.uint8))[:slen]
             if n_trials == -1:
                 n_trials = len(set(trial_ind))
-            filtered_spk_idxs_by_trial = np.argwhere(trial_ind <= n_trials).ravel()
-            filtered_spkts = spkattrs[spike_train_attr_name][filtered_spk_idxs_by_trial]
-            filtered_trial_ind = trial_ind[filtered_spk_idxs_by_trial]
+            filtered_spk_idxs = trial_ind <= n_trials
             if time_range is not None:
-                filtered_spk_idxs_by_time = np.argwhere(np.logical_and(filtered_spkts >= time_range[0],
-                                                                       filtered_spkts <= time_range[1])).ravel()
-                filtered_spkts = filtered_spkts[filtered_spk_idxs_by_time]
-                filtered_trial_ind = filtered_trial_ind[filtered_spk_idxs_by_time]
-            pop_spkindlst.append(np.repeat([spkind], len(filtered_spkts)).astype(np.uint32))
-            pop_spktriallst.append(filtered_trial_ind)
-            this_num_cell_spks += len(filtered_spkts)
-            if len(filtered_spkts) > 0:
-                active_set.add(spkind)
-            for i, spkt in enumerate(filtered_spkts):
-                trial_i = filtered_trial_ind[i]
-                if merge_trials:
-                    spkt += np.sum(trial_dur[:trial_i])
-                pop_spktlst.append(spkt)
-                tmin = min(tmin, spkt)
-                tmax = max(tmax, spkt)
-
-        pop_active_cells[pop_name] = active_set
-        num_cell_spks[pop_name] = this_num_cell_spks
-
-        if not active_set:
-            continue
+                filtered_spk_idxs &= np.logical_and(spkts >= time_range[0], spkts <= time_range[1])
+            filtered_spkts = spkts[filtered_spk_idxs]
+            filtered_trial_ind = trial_ind[filtered_spk_idxs]
+            if merge_trials and (len(filtered_spkts) > 0):
+                trial_dur = spkattrs.get(trial_dur_attr, np.asarray([0.]))
+                trial_offsets = np.concatenate(([0.], np.cumsum(trial_dur)))
+                filtered_spkts = filtered_spkts + \
+                    trial_offsets[np.minimum(filtered_trial_ind, len(trial_dur))]
+            pop_spkindlst.append(np.full(len(filtered_spkts), spkind, dtype=np.uint32))
+            pop_spktlst.append(np.asarray(filtered_spkts, dtype=np.float32))
+            pop_spktriallst.append(np.asarray(filtered_trial_ind, dtype=np.uint32))
+
+        if len(pop_spkindlst) > 0:
+            pop_spkinds = np.concatenate(pop_spkindlst)
+            pop_spkts = np.concatenate(pop_spktlst)
+            pop_spktrials = np.concatenate(pop_spktriallst)
+        else:
+            pop_spkinds = np.asarray([], dtype=np.uint32)
+            pop_spkts = np.asarray([], dtype=np.float32)
+            pop_spktrials = np.asarray([], dtype=np.uint32)
+        del pop_spkindlst, pop_spktlst, pop_spktriallst
 
-        pop_spkts = np.asarray(pop_spktlst, dtype=np.float32)
-        del (pop_spktlst)
-        pop_spkinds = np.concatenate(pop_spkindlst, dtype=np.uint32)
-        del (pop_spkindlst)
-        pop_spktrials = np.concatenate(pop_spktriallst, dtype=np.uint32)
-        del (pop_spktriallst)
+        this_num_cell_spks = len(pop_spkts)
+        active_set = set(np.unique(pop_spkinds).tolist())
 
         # Limit to max_spikes
         if (max_spikes is not None) and (len(pop_spkts) > max_spikes):
@@ -178,38 +296,252 @@ def read_spike_events(input_file, population_names, namespace_id, spike_train_at
             sample_inds = np.random.randint(0, len(pop_spkinds) - 1, size=int(max_spikes))
             pop_spkts = pop_spkts[sample_inds]
             pop_spkinds = pop_spkinds[sample_inds]
-            pop_spktrials = pop_spkinds[sample_inds]
-            tmax = max(tmax, max(pop_spkts))
+            pop_spktrials = pop_spktrials[sample_inds]
+
+        # Sort events by trial, and within each trial by spike time;
+        # events of trials outside of [0, n_trials) are discarded
+        trial_sort_idxs = np.lexsort((pop_spkts, pop_spktrials))
+        trial_sort_idxs = trial_sort_idxs[pop_spktrials[trial_sort_idxs] < n_trials]
+
+        pop_spkdata = {'gid': pop_spkinds[trial_sort_idxs],
+                       't': pop_spkts[trial_sort_idxs],
+                       'trial': pop_spktrials[trial_sort_idxs],
+                       'active_cells': active_set,
+                       'num_cell_spks': this_num_cell_spks,
+                       'n_trials': n_trials,
+                       'tmin': float(np.min(pop_spkts)) if this_num_cell_spks > 0 else float('inf'),
+                       'tmax': float(np.max(pop_spkts)) if this_num_cell_spks > 0 else 0.}
+        del pop_spkts, pop_spkinds, pop_spktrials
+
+        if active_set:
+            logger.info(' Read %i spikes and %i trials for population %s' % (this_num_cell_spks, n_trials, pop_name))
+
+        yield pop_name, pop_spkdata
+
+
+def read_spike_events(input_file, population_names, namespace_id, spike_train_attr_name='t', time_range=None,
+                      max_spikes=None, n_trials=-1, merge_trials=False, comm=None, io_size=0, include_artificial=True,
+                      columnar=False):
+    """
+    Reads spike trains from a NeuroH5 file, and returns a dictionary with spike times and cell indices.
+    :param input_file: str (path to file)
+    :param population_names: list of str
+    :param namespace_id: str
+    :param spike_train_attr_name: str
+    :param time_range: list of float
+    :param max_spikes: float
+    :param n_trials: int
+    :param merge_trials: bool
+    :param columnar: bool; if True, the entries of spkindlst and
+      spktlst are flat per-population arrays sorted by trial and spike
+      time, and an additional entry spktriallst contains the
+      corresponding trial indices
+    :return: dict
+    """
+    
+    spkpoplst = []
+    spkindlst = []
+    spktlst = []
+    spktriallst = []
+    num_cell_spks = {}
+    pop_active_cells = {}
+
+    tmin = float('inf')
+    tmax = 0.
+
+    for pop_name, pop_spkdata in read_spike_events_iter(input_file, population_names, namespace_id,
+                                                        spike_train_attr_name=spike_train_attr_name,
+                                                        time_range=time_range, max_spikes=max_spikes,
+                                                        n_trials=n_trials, merge_trials=merge_trials,
+                                                        comm=comm, io_size=io_size,
+                                                        include_artificial=include_artificial):
+
+        active_set = pop_spkdata['active_cells']
+        n_trials = pop_spkdata['n_trials']
+        pop_active_cells[pop_name] = active_set
+        num_cell_spks[pop_name] = pop_spkdata['num_cell_spks']
+        tmin = min(tmin, pop_spkdata['tmin'])
+        tmax = max(tmax, pop_spkdata['tmax'])
+
+        if not active_set:
+            continue
 
         spkpoplst.append(pop_name)
-        pop_trial_spkindlst = []
-        pop_trial_spktlst = []
-        for trial_i in range(n_trials):
-            trial_idxs = np.where(pop_spktrials == trial_i)[0]
-            sorted_trial_idxs = np.argsort(pop_spkts[trial_idxs])
-            pop_trial_spktlst.append(np.take(pop_spkts[trial_idxs], sorted_trial_idxs))
-            pop_trial_spkindlst.append(np.take(pop_spkinds[trial_idxs], sorted_trial_idxs))
-                
-        del pop_spkts
-        del pop_spkinds
-        del pop_spktrials
+        pop_spkinds = pop_spkdata['gid']
+        pop_spkts = pop_spkdata['t']
+        pop_spktrials = pop_spkdata['trial']
 
-        if merge_trials:
-            pop_spkinds = np.concatenate(pop_trial_spkindlst)
-            pop_spktlst = np.concatenate(pop_trial_spktlst)
+        if columnar:
+            spkindlst.append(pop_spkinds)
+            spktlst.append(pop_spkts)
+            spktriallst.append(pop_spktrials)
+        elif merge_trials:
             spkindlst.append(pop_spkinds)
-            spktlst.append(pop_spktlst)
+            spktlst.append(pop_spkts)
         else:
-            spkindlst.append(pop_trial_spkindlst)
-            spktlst.append(pop_trial_spktlst)
-            
+            trial_bounds = np.searchsorted(pop_spktrials, np.arange(1, n_trials))
+            spkindlst.append(np.split(pop_spkinds, trial_bounds))
+            spktlst.append(np.split(pop_spkts, trial_bounds))
 
-        logger.info(' Read %i spikes and %i trials for population %s' % (this_num_cell_spks, n_trials, pop_name))
+    spkdata = {'spkpoplst': spkpoplst, 'spktlst': spktlst, 'spkindlst': spkindlst,
+               'tmin': tmin, 'tmax': tmax,
+               'pop_active_cells': pop_active_cells, 'num_cell_spks': num_cell_spks,
+               'n_trials': n_trials}
+    if columnar:
+        spkdata['spktriallst'] = spktriallst
 
-    return {'spkpoplst': spkpoplst, 'spktlst': spktlst, 'spkindlst': spkindlst,
-            'tmin': tmin, 'tmax': tmax,
-            'pop_active_cells': pop_active_cells, 'num_cell_spks': num_cell_spks,
-            'n_trials': n_trials}
+    return spkdata
+
+
+def spike_train_arrays_from_events(spk_inds, spk_ts):
+    """
+    Groups arrays of spike events by gid into a single-trial
+    :class:'SpikeTrainArrays' object, so that the spike train of each
+    gid is a slice of the time array. The grouping is stable, so that
+    the spike times of each gid remain in their original order.
+
+    :param spk_inds: array of cell indices of the spike events
+    :param spk_ts: array of spike times
+    :return: :class:'SpikeTrainArrays'
+    """
+    spk_inds = np.asarray(spk_inds, dtype=np.uint32)
+    sort_idx = np.argsort(spk_inds, kind='stable')
+    gids, gid_starts = np.unique(spk_inds[sort_idx], return_index=True)
+    offsets = np.empty(len(gids) + 1, dtype=np.int64)
+    offsets[:-1] = gid_starts
+    offsets[-1] = len(sort_idx)
+    return SpikeTrainArrays(gids, np.asarray(spk_ts)[sort_idx], offsets, 1)
+
+
+def spike_train_index_cache_path(cache_dir, input_file, key_items):
+    """
+    Returns the path of the spike train index cache entry for the given
+    spike events file and read parameters in the given cache
+    directory. The path and the size and modification time of the
+    file are part of the key, so that entries are invalidated when the
+    file changes.
+
+    :param cache_dir: str (path to cache directory)
+    :param input_file: str (path to file)
+    :param key_items: list of str, numbers and tuples
+    :return: str
+    """
+    input_stat = os.stat(input_file)
+    file_key = (os.path.abspath(input_file), input_stat.st_size, input_stat.st_mtime_ns)
+    key_hash = hashlib.sha256(repr([file_key, key_items]).encode()).hexdigest()
+    return os.path.join(cache_dir, f'spike_index_{key_hash}')
+
+
+def read_spike_train_index_cache(cache_path):
+    """
+    Reads a spike train index cache entry, if it exists. The arrays are
+    memory-mapped in copy-on-write mode.
+
+    :param cache_path: str
+    :return: dict { pop_name: :class:'SpikeTrainArrays' }, or None
+    """
+    if not os.path.isdir(cache_path):
+        return None
+    spike_index = {}
+    for pop_name in np.load(os.path.join(cache_path, 'populations.npy')):
+        pop_name = str(pop_name)
+        gids = np.load(os.path.join(cache_path, f'{pop_name}.gids.npy'))
+        t = np.load(os.path.join(cache_path, f'{pop_name}.t.npy'), mmap_mode='c')
+        offsets = np.load(os.path.join(cache_path, f'{pop_name}.offsets.npy'))
+        spike_index[pop_name] = SpikeTrainArrays(gids, t, offsets, 1)
+    return spike_index
+
+
+def write_spike_train_index_cache(cache_path, spike_index, rank=0):
+    """
+    Writes a spike train index cache entry. The entry is written to a
+    temporary directory that is then atomically renamed, so that
+    concurrent readers never observe a partially written entry. Failure
+    to write the entry (e.g. in a read-only directory) is logged and
+    otherwise ignored.
+
+    :param cache_path: str
+    :param spike_index: dict { pop_name: :class:'SpikeTrainArrays' }
+    :param rank: int; rank of the writing process, used to name the temporary directory
+    """
+    tmp_path = f'{cache_path}.tmp.{os.getpid()}.{rank}'
+    try:
+        os.makedirs(tmp_path, exist_ok=True)
+        pop_names = sorted(spike_index.keys())
+        np.save(os.path.join(tmp_path, 'populations.npy'), np.asarray(pop_names, dtype=np.str_))
+        for pop_name in pop_names:
+            spike_arrays = spike_index[pop_name]
+            np.save(os.path.join(tmp_path, f'{pop_name}.gids.npy'), spike_arrays.gids)
+            np.save(os.path.join(tmp_path, f'{pop_name}.t.npy'), spike_arrays.t)
+            np.save(os.path.join(tmp_path, f'{pop_name}.offsets.npy'), spike_arrays.offsets)
+    except OSError as e:
+        logger.warning(f'unable to write spike train index cache {cache_path}: {e}')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process has already written this entry
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def read_spike_train_index(input_file, population_names, namespace_id, spike_train_attr_name='t', time_range=None,
+                           n_trials=-1, comm=None, io_size=0, cache_dir=None):
+    """
+    Reads spike trains from a NeuroH5 file with merged trials, and
+    returns them grouped by gid as per-population
+    :class:'SpikeTrainArrays' objects, so that the spike train of
+    each cell is obtained with a single slice.
+
+    If cache_dir is not None, the grouped spike trains are stored in an
+    on-disk cache in this directory, keyed by the spike events file and
+    the read parameters, and are memory-mapped from the cache on
+    subsequent calls. Each rank stores its own part of the spike
+    trains, so the number of ranks is part of the key. The
+    decision to use the cache is made collectively, so that the
+    collective read of the spike events proceeds when any rank misses
+    the cache.
+
+    :param input_file: str (path to file)
+    :param population_names: list of str
+    :param namespace_id: str
+    :param spike_train_attr_name: str
+    :param time_range: list of float
+    :param n_trials: int
+    :param comm: MPI communicator
+    :param io_size: int
+    :param cache_dir: str or None
+    :return: dict { pop_name: :class:'SpikeTrainArrays' }
+    """
+    rank = 0 if comm is None else comm.rank
+    cache_path = None
+    if cache_dir is not None:
+        key_items = [sorted(population_names), namespace_id, spike_train_attr_name,
+                     None if time_range is None else tuple(time_range), n_trials,
+                     1 if comm is None else comm.size, io_size, rank]
+        cache_path = spike_train_index_cache_path(cache_dir, input_file, key_items)
+        spike_index = read_spike_train_index_cache(cache_path)
+        cache_hit = spike_index is not None
+        if comm is not None:
+            cache_hit = all(comm.allgather(cache_hit))
+        if cache_hit:
+            logger.info(f'Read spike train index from cache {cache_path}')
+            return spike_index
+
+    spkdata = read_spike_events(input_file, population_names, namespace_id,
+                                spike_train_attr_name=spike_train_attr_name,
+                                time_range=time_range, n_trials=n_trials, merge_trials=True,
+                                comm=comm, io_size=io_size)
+
+    spike_index = {}
+    for pop_name, spk_inds, spk_ts in zip(spkdata['spkpoplst'], spkdata['spkindlst'], spkdata['spktlst']):
+        spike_index[pop_name] = spike_train_arrays_from_events(spk_inds, spk_ts)
+    del spkdata
+
+    if cache_path is not None:
+        write_spike_train_index_cache(cache_path, spike_index, rank=rank)
+
+    return spike_index
 
 
 def make_spike_dict(spkinds, spkts):
@@ -291,10 +623,44 @@ def spike_covariate(population, spkdict, time_bins, nbins_before, nbins_after):
 
 
 
+def baks_rate_chunk(spktrains, time_bins, a, b, truncate=None):
+    """
+    Evaluates the BAKS firing rate of a chunk of spike trains at the given time bins (ms).
+    Spike trains with fewer than two spikes are assigned a zero rate.
+    :param spktrains: list of arrays with spike times (ms)
+    :param time_bins: array
+    :param a: BAKS shape parameter
+    :param b: BAKS scale parameter
+    :param truncate: number of bandwidths of the truncated kernel support, or None
+    :return: list of arrays
+    """
+    rates = [np.zeros(time_bins.shape) for _ in spktrains]
+    baks_inds = [i for i, spkts in enumerate(spktrains) if len(spkts) > 1]
+    if len(baks_inds) > 0:
+        baks_rates, _ = baks_batch([spktrains[i] / 1000. for i in baks_inds], time_bins / 1000., a=a, b=b,
+                                   truncate=truncate)
+        for k, i in enumerate(baks_inds):
+            rates[i] = baks_rates[k]
+    return rates
+
+
 def spike_density_estimate(population, spkdict, time_bins, arena_id=None, trajectory_id=None, output_file_path=None,
-                            progress=False, inferred_rate_attr_name='Inferred Rate Map', **kwargs):
+                           progress=False, inferred_rate_attr_name='Inferred Rate Map', parallel=None,
+                           n_workers=None, comm=None, chunk_size=1000, io_size=0, trial=0, **kwargs):
     """
     Calculates spike density function for the given spike trains.
+    The spike trains can be given as a dictionary { gid: spike times },
+    or as a :class:'SpikeTrainArrays' object, in which case the spike
+    trains of the given trial are used.
+
+    The spike trains are evaluated in chunks of chunk_size cells with
+    a batched BAKS kernel. If parallel is 'process', the chunks are
+    evaluated across a process pool with n_workers processes; if
+    parallel is 'mpi', the chunks are distributed round-robin across
+    the ranks of comm, and the results are gathered on all ranks. In
+    the latter case, spkdict must be the same on all ranks. If an
+    output file is given, results are appended to it after each chunk.
+
     :param population:
     :param spkdict:
     :param time_bins:
@@ -303,12 +669,23 @@ def spike_density_estimate(population, spkdict, time_bins, arena_id=None, trajec
     :param output_file_path:
     :param progress:
     :param inferred_rate_attr_name: str
+    :param parallel: None, 'process' or 'mpi'
+    :param n_workers: number of worker processes when parallel is 'process'
+    :param comm: MPI communicator
+    :param chunk_size: number of cells per chunk
+    :param io_size: number of I/O ranks for output
+    :param trial: trial index when spkdict is a :class:'SpikeTrainArrays' object
     :param kwargs: dict
     :return: dict
     """
     if progress:
         from tqdm import tqdm
 
+    if parallel not in (None, 'process', 'mpi'):
+        raise RuntimeError(f'spike_density_estimate: unknown parallel mode {parallel}')
+    if parallel == 'mpi' and comm is None:
+        raise RuntimeError('spike_density_estimate: comm is required when parallel is mpi')
+
     analysis_options = copy.copy(default_baks_analysis_options)
     analysis_options.update(kwargs)
 
@@ -320,32 +697,95 @@ def spike_density_estimate(population, spkdict, time_bins, arena_id=None, trajec
     t_start = time_bins[0]
     t_stop = time_bins[-1]
 
-    spktrains = {ind: make_spktrain(lst, t_start, t_stop) for (ind, lst) in viewitems(spkdict)}
-    baks_args = dict()
-    baks_args['a'] = analysis_options['BAKS Alpha']
-    baks_args['b'] = analysis_options['BAKS Beta']
-    
-    if progress:
-        seq = tqdm(viewitems(spktrains))
-    else:
-        seq = viewitems(spktrains)
-        
-    spk_rate_dict = {ind: baks(spkts / 1000., time_bins / 1000., **baks_args)[0].reshape((-1,))
-                     if len(spkts) > 1 else np.zeros(time_bins.shape)
-                     for ind, spkts in seq}
-
+    namespace = None
     if output_file_path is not None:
         if arena_id is None or trajectory_id is None:
             raise RuntimeError('spike_density_estimate: arena_id and trajectory_id required to write Spike Density'
                                'Function namespace')
         namespace = 'Spike Density Function %s %s' % (arena_id, trajectory_id)
-        attr_dict = {ind: {inferred_rate_attr_name: np.asarray(spk_rate_dict[ind], dtype='float32')}
-                     for ind in spk_rate_dict}
-        write_cell_attributes(output_file_path, population, attr_dict, namespace=namespace)
 
-    result = {ind: {'rate': rate, 'time': time_bins} for ind, rate in viewitems(spk_rate_dict)}
+    if isinstance(spkdict, SpikeTrainArrays):
+        inds = list(spkdict.gids)
+        in_range = (spkdict.t >= t_start) & (spkdict.t <= t_stop)
+        range_t = spkdict.t[in_range]
+        range_offsets = np.concatenate(([0], np.cumsum(in_range)))
+        starts, ends = spkdict.bounds(trial)
+        starts = range_offsets[starts]
+        ends = range_offsets[ends]
+        def chunk_spktrains(chunk_inds):
+            return [range_t[starts[i]:ends[i]] for i in spkdict.index(np.asarray(chunk_inds, dtype=spkdict.gids.dtype))]
+    else:
+        inds = list(spkdict.keys())
+        def chunk_spktrains(chunk_inds):
+            return [make_spktrain(spkdict[ind], t_start, t_stop) for ind in chunk_inds]
+    chunk_size = max(int(chunk_size), 1)
+    chunks = [inds[i:i+chunk_size] for i in range(0, len(inds), chunk_size)]
+    baks_args = (analysis_options['BAKS Alpha'], analysis_options['BAKS Beta'],
+                 analysis_options['BAKS Truncate'])
+
+    executor = None
+    if parallel == 'process':
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(max_workers=n_workers)
+        chunk_seq = zip(chunks, executor.map(baks_rate_chunk, (chunk_spktrains(chunk_inds) for chunk_inds in chunks),
+                                             itertools.repeat(time_bins), itertools.repeat(baks_args[0]),
+                                             itertools.repeat(baks_args[1]), itertools.repeat(baks_args[2])))
+    elif parallel == 'mpi':
+        rank = comm.rank
+        nranks = comm.size
+        n_rounds = int(math.ceil(len(chunks) / nranks))
+        def mpi_chunk_seq():
+            for round_i in range(n_rounds):
+                chunk_i = round_i * nranks + rank
+                chunk_inds = chunks[chunk_i] if chunk_i < len(chunks) else []
+                yield chunk_inds, baks_rate_chunk(chunk_spktrains(chunk_inds), time_bins, *baks_args)
+        chunk_seq = mpi_chunk_seq()
+    else:
+        chunk_seq = ((chunk_inds, baks_rate_chunk(chunk_spktrains(chunk_inds), time_bins, *baks_args))
+                     for chunk_inds in chunks)
+
+    if progress:
+        chunk_seq = tqdm(chunk_seq, total=n_rounds if parallel == 'mpi' else len(chunks))
+
+    write_kwds = {}
+    if comm is not None:
+        write_kwds['comm'] = comm
+        write_kwds['io_size'] = io_size
+
+    ## append_cell_attributes is collective, but outside of mpi mode
+    ## the number of chunks depends on the local spike trains; all
+    ## ranks perform the maximum number of writes, with empty
+    ## attribute dictionaries once their chunks are exhausted.
+    n_writes = 0
+    if namespace is not None:
+        if parallel == 'mpi':
+            n_writes = n_rounds
+        else:
+            write_comm = MPI.COMM_WORLD if comm is None else comm
+            n_writes = write_comm.allreduce(len(chunks), op=MPI.MAX)
+
+    spk_rate_dict = {}
+    try:
+        for chunk_inds, chunk_rates in chunk_seq:
+            chunk_rate_dict = dict(zip(chunk_inds, chunk_rates))
+            if namespace is not None:
+                attr_dict = {ind: {inferred_rate_attr_name: np.asarray(rate, dtype='float32')}
+                             for ind, rate in viewitems(chunk_rate_dict)}
+                append_cell_attributes(output_file_path, population, attr_dict, namespace=namespace,
+                                       **write_kwds)
+                n_writes -= 1
+            spk_rate_dict.update(chunk_rate_dict)
+        for _ in range(n_writes):
+            append_cell_attributes(output_file_path, population, {}, namespace=namespace, **write_kwds)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    if parallel == 'mpi':
+        for rank_rate_dict in comm.allgather(spk_rate_dict):
+            spk_rate_dict.update(rank_rate_dict)
+        spk_rate_dict = {ind: spk_rate_dict[ind] for ind in inds}
 
-        
     result = { ind: { 'rate': rate, 'time': time_bins }
               for ind, rate in viewitems(spk_rate_dict) }
     
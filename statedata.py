@@ -1,4 +1,5 @@
 
+import os
 import numpy as np
 from mpi4py import MPI
 
@@ -144,3 +145,261 @@ def read_state(input_file, population_names, namespace_id, time_variable='t', st
              'time_variable': time_variable,
              'state_variables': state_variables,
              'n_trials': this_n_trials }
+
+
+def state_trial_bounds(tvals, n_trials=-1):
+    """
+    Determines the trial boundaries of a recording time vector in
+    which each trial starts at the same time value, as in read_state.
+
+    :param tvals: array of recording times
+    :param n_trials: maximum number of trials, or -1 for all trials
+    :return: tuple of (number of trials, array of trial boundaries of length number of trials + 1)
+    """
+    trial_bounds = list(np.where(np.isclose(tvals, tvals[0], atol=1e-4))[0])
+    n_trial_bounds = len(trial_bounds)
+    trial_bounds.append(len(tvals))
+    if n_trials == -1:
+        this_n_trials = n_trial_bounds
+    else:
+        this_n_trials = min(n_trial_bounds, n_trials)
+    trial_bounds_consecutive = consecutive(np.asarray(trial_bounds))
+    trial_bounds_unique = [x[-1] for x in trial_bounds_consecutive]
+    if this_n_trials > 1:
+        bounds = [0] + list(trial_bounds_unique[1:n_trials]) + [len(tvals)]
+    else:
+        bounds = [0, trial_bounds_unique[1]]
+    return len(bounds) - 1, np.asarray(bounds, dtype=np.int64)
+
+
+class StateArrays(object):
+    """
+    Columnar representation of the intracellular state recordings of
+    one population in one namespace. All cells share a single time
+    vector t, and each state variable is stored as a dense array of
+    shape (number of cells, number of samples), which may be a memory
+    map. Rows are in the order in which the cells were read; gids
+    holds the gid of each row, and the index method maps gids to rows.
+    Trial k consists of the samples trial_bounds[k]:trial_bounds[k+1].
+
+    The per-cell attributes distance, section, loc and ri are arrays
+    with one element per row, or None if they were not recorded.
+    """
+
+    def __init__(self, gids, t, states, trial_bounds, distance=None, section=None, loc=None, ri=None):
+        self.gids = np.asarray(gids, dtype=np.uint32).reshape((-1,))
+        self.t = t
+        self.states = states
+        self.trial_bounds = np.asarray(trial_bounds, dtype=np.int64)
+        self.distance = distance
+        self.section = section
+        self.loc = loc
+        self.ri = ri
+        self.sort_index = np.argsort(self.gids, kind='stable')
+        self.sorted_gids = self.gids[self.sort_index]
+        for state_variable, state_array in states.items():
+            if state_array.shape != (len(self.gids), len(t)):
+                raise ValueError(f'StateArrays: state variable {state_variable} has shape {state_array.shape}, '
+                                 f'expected {(len(self.gids), len(t))}')
+
+    @property
+    def n_trials(self):
+        return len(self.trial_bounds) - 1
+
+    def index(self, gids):
+        """
+        Returns the rows of the given gids, or -1 for gids that are not present.
+        """
+        gids = np.asarray(gids, dtype=np.uint32).reshape((-1,))
+        if len(self.gids) == 0:
+            return np.full(gids.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.sorted_gids, gids), len(self.gids) - 1)
+        return np.where(self.sorted_gids[pos] == gids, self.sort_index[pos], -1)
+
+    def trial_slice(self, trial):
+        return slice(self.trial_bounds[trial], self.trial_bounds[trial+1])
+
+    def trial_time(self, trial):
+        """
+        Returns the time vector of the given trial.
+        """
+        return self.t[self.trial_slice(trial)]
+
+    def trial_states(self, state_variable, trial, gids=None):
+        """
+        Returns the values of the given state variable in the given
+        trial, as an array of shape (number of cells, number of trial
+        samples), for all cells or for the given gids.
+        """
+        state_array = self.states[state_variable]
+        if gids is None:
+            return state_array[:, self.trial_slice(trial)]
+        rows = self.index(gids)
+        if np.any(rows < 0):
+            missing = np.asarray(gids).reshape((-1,))[rows < 0]
+            raise KeyError(f'StateArrays: gids not found: {missing[:10]}')
+        return state_array[rows, self.trial_slice(trial)]
+
+    def cell_attrs(self, attr_name, gids):
+        """
+        Returns the values of the given per-cell attribute (distance,
+        section, loc or ri) for the given gids, or None if the
+        attribute was not recorded.
+        """
+        attr_values = getattr(self, attr_name)
+        if attr_values is None:
+            return None
+        rows = self.index(gids)
+        if np.any(rows < 0):
+            missing = np.asarray(gids).reshape((-1,))[rows < 0]
+            raise KeyError(f'StateArrays: gids not found: {missing[:10]}')
+        return attr_values[rows]
+
+    def cell_states(self, gid, time_variable='t'):
+        """
+        Returns the recordings of the given gid in the per-cell
+        dictionary representation of read_state, with one view of the
+        shared arrays per trial.
+        """
+        row = self.index([gid])[0]
+        if row < 0:
+            raise KeyError(gid)
+        trial_slices = [self.trial_slice(i) for i in range(self.n_trials)]
+        cell_state_dict = { time_variable: [self.t[s] for s in trial_slices] }
+        for attr_name in ['distance', 'section', 'loc', 'ri']:
+            attr_values = getattr(self, attr_name)
+            cell_state_dict[attr_name] = None if attr_values is None else attr_values[row]
+        for state_variable, state_array in self.states.items():
+            cell_state_dict[state_variable] = [state_array[row, s] for s in trial_slices]
+        return cell_state_dict
+
+    def __len__(self):
+        return len(self.gids)
+
+    def __contains__(self, gid):
+        return self.index([gid])[0] >= 0
+
+
+def read_state_arrays(input_file, population_names, namespace_id, time_variable='t', state_variables=['v'],
+                      time_range=None, max_units=None, gid=None, comm=None, n_trials=-1, mmap_dir=None):
+    """
+    Reads intracellular state recordings into a :class:'StateArrays'
+    per population. Unlike read_state, the time vector is processed
+    only once per namespace: the time range selection and the trial
+    boundaries are computed from the time vector of the first cell
+    and applied to all cells, which must therefore have been recorded
+    with the same time vector, as written by io_utils.recsout.
+
+    :param input_file: path to the state file
+    :param population_names: list of population names
+    :param namespace_id: namespace of the recordings
+    :param time_variable: name of the time variable
+    :param state_variables: list of state variable names
+    :param time_range: optional (start, stop) time range
+    :param max_units: maximum number of randomly sampled cells per population
+    :param gid: optional list of gids to read
+    :param comm: MPI communicator
+    :param n_trials: maximum number of trials, or -1 for all trials
+    :param mmap_dir: if not None, the state arrays are memory maps of .npy files in this directory
+    :return: dict with keys states ({ pop_name: StateArrays }), time_variable, state_variables, n_trials
+    """
+    if comm is None:
+        comm = MPI.COMM_WORLD
+    pop_state_dict = {}
+    this_n_trials = None
+
+    logger.info('Reading state data from populations %s, namespace %s gid = %s...' % (str(population_names), namespace_id, str(gid)))
+
+    attr_info_dict = read_cell_attribute_info(input_file, populations=population_names, read_cell_index=True)
+
+    for pop_name in population_names:
+        cell_index = None
+        for attr_name, attr_cell_index in attr_info_dict[pop_name][namespace_id]:
+            if attr_name in state_variables:
+                cell_index = attr_cell_index
+                break
+        if cell_index is None:
+            raise RuntimeError(f'read_state_arrays: Unable to find recordings for state variable {state_variables} in '
+                               f'population {pop_name} namespace {namespace_id}')
+        cell_set = set(cell_index)
+
+        # Limit to max_units
+        if gid is None:
+            if (max_units is not None) and (len(cell_set) > max_units):
+                logger.info('  Reading only randomly sampled %i out of %i units for population %s' % (
+                max_units, len(cell_set), pop_name))
+                sample_inds = np.random.randint(0, len(cell_set) - 1, size=int(max_units))
+                cell_set_lst = list(cell_set)
+                gid_set = set([cell_set_lst[i] for i in sample_inds])
+            else:
+                gid_set = cell_set
+            valiter = read_cell_attributes(input_file, pop_name, namespace=namespace_id, comm=comm)
+        else:
+            gid_set = set(gid)
+            valiter = read_cell_attribute_selection(input_file, pop_name, namespace=namespace_id,
+                                                    selection=list(gid_set), comm=comm)
+
+        n_max = len(gid_set)
+        n_t = None
+        t_sel = None
+        gids = []
+        state_arrays = None
+        attr_arrays = None
+        for cellind, vals in valiter:
+            if cellind is None or cellind not in gid_set:
+                continue
+            tvals = vals[time_variable]
+            if n_t is None:
+                # Time range selection by index arithmetic on the shared time vector
+                n_t = len(tvals)
+                if time_range is None:
+                    t_sel = slice(0, n_t)
+                else:
+                    tinds = np.flatnonzero(np.logical_and(tvals <= time_range[1], tvals >= time_range[0]))
+                    if len(tinds) == 0:
+                        raise ValueError(f'read_state_arrays: no samples in time range {time_range} in '
+                                         f'population {pop_name} namespace {namespace_id}')
+                    if tinds[-1] - tinds[0] + 1 == len(tinds):
+                        t_sel = slice(tinds[0], tinds[-1] + 1)
+                    else:
+                        t_sel = tinds
+                t = np.asarray(tvals[t_sel], dtype=np.float32).reshape((-1,))
+                this_n_trials, trial_bounds = state_trial_bounds(t, n_trials)
+                n_samples = trial_bounds[-1]
+                t = t[:n_samples]
+                state_arrays = {}
+                for state_variable in state_variables:
+                    if mmap_dir is None:
+                        state_arrays[state_variable] = np.empty((n_max, n_samples), dtype=np.float32)
+                    else:
+                        rank_suffix = f'.{comm.rank}' if comm.size > 1 else ''
+                        mmap_path = os.path.join(mmap_dir, f'{pop_name}.{namespace_id}.{state_variable}{rank_suffix}.npy')
+                        state_arrays[state_variable] = np.lib.format.open_memmap(mmap_path, mode='w+', dtype=np.float32,
+                                                                                 shape=(n_max, n_samples))
+                attr_arrays = { attr_name: np.empty((n_max,), dtype=vals[attr_name].dtype)
+                                for attr_name in ['distance', 'section', 'loc', 'ri'] if attr_name in vals }
+            elif len(tvals) != n_t:
+                raise RuntimeError(f'read_state_arrays: time vector of gid {cellind} in population {pop_name} '
+                                   f'namespace {namespace_id} has {len(tvals)} samples, expected {n_t}')
+            row = len(gids)
+            gids.append(cellind)
+            for state_variable in state_variables:
+                state_arrays[state_variable][row, :] = vals[state_variable][t_sel][:n_samples]
+            for attr_name, attr_array in attr_arrays.items():
+                attr_array[row] = vals[attr_name][0]
+
+        n_cells = len(gids)
+        if n_t is None:
+            t = np.zeros((0,), dtype=np.float32)
+            trial_bounds = np.zeros((1,), dtype=np.int64)
+            state_arrays = { state_variable: np.zeros((0, 0), dtype=np.float32) for state_variable in state_variables }
+            attr_arrays = {}
+        pop_state_dict[pop_name] = StateArrays(gids, t,
+                                               { k: v[:n_cells] for k, v in state_arrays.items() },
+                                               trial_bounds,
+                                               **{ k: v[:n_cells] for k, v in attr_arrays.items() })
+
+    return { 'states': pop_state_dict,
+             'time_variable': time_variable,
+             'state_variables': state_variables,
+             'n_trials': this_n_trials }
@@ -28,6 +28,65 @@ gamma_hazard - Compute the hazard function for a gamma process with parameters a
 """
 
 
+def thin_inhom_poisson_candidates(interp_rate, interp_t, dt, refractory, generator, block_size=None):
+    """
+    Generates spike times by thinning a homogeneous Poisson process
+    with rate max(interp_rate), with an absolute refractory period
+    after each spike. Candidate inter-spike intervals are drawn in
+    blocks, thinned with array masks, and the refractory period is
+    enforced by a scan over the accepted candidates that jumps to the
+    first candidate at least one refractory period after the previous
+    spike.
+    :param interp_rate: instantaneous rates at interp_t (1/ms), corrected for the refractory period
+    :param interp_t: time values (ms) at resolution dt
+    :param dt: temporal resolution for spike times (ms)
+    :param refractory: absolute deadtime following a spike (ms)
+    :param generator: :class:'np.random.RandomState()'
+    :param block_size: number of candidate events drawn per block
+    :return: array of spike times (ms)
+    """
+    n_t = len(interp_t)
+    max_rate = np.max(interp_rate)
+    if block_size is None:
+        block_size = int(1.25 * max_rate * n_t * dt) + 16
+
+    cand_inds = []
+    cand_ts = []
+    i = 0
+    ISI_sum = 0.
+    while i < n_t:
+        x = generator.uniform(0.0, 1.0, size=block_size)
+        x = x[x > 0.]
+        ISIs = -np.log(x) / max_rate
+        block_inds = i + np.cumsum((ISIs / dt).astype(np.int64))
+        block_ts = ISI_sum + np.cumsum(ISIs)
+        in_range = block_inds < n_t
+        block_inds = block_inds[in_range]
+        block_ts = block_ts[in_range]
+        p = generator.uniform(0.0, 1.0, size=len(block_inds))
+        accept = p <= (interp_rate[block_inds] / max_rate)
+        cand_inds.append(block_inds[accept])
+        cand_ts.append(block_ts[accept])
+        if not np.all(in_range):
+            break
+        if len(block_inds) == 0:
+            continue
+        i = block_inds[-1]
+        ISI_sum = block_ts[-1]
+
+    cand_inds = np.concatenate(cand_inds)
+    cand_ts = np.concatenate(cand_ts)
+    if (refractory <= 0.) or (len(cand_ts) == 0):
+        return interp_t[cand_inds]
+
+    spike_inds = []
+    k = 0
+    while k < len(cand_ts):
+        spike_inds.append(k)
+        k = np.searchsorted(cand_ts, cand_ts[k] + refractory, side='left')
+    return interp_t[cand_inds[spike_inds]]
+
+
 def get_inhom_poisson_spike_times_by_thinning(rate, t, dt=0.02, refractory=3., generator=None):
     """
     Given a time series of instantaneous spike rates in Hz, produce a spike train consistent 
@@ -40,35 +99,59 @@ def get_inhom_poisson_spike_times_by_thinning(rate, t, dt=0.02, refractory=3., g
     :return: list of m spike times (ms)
     """
     if generator is None:
-        generator = random
+        generator = np.random
     interp_t = np.arange(t[0], t[-1] + dt, dt)
-#    try:
     rate[np.isclose(rate, 0., atol=1e-3, rtol=1e-3)] = 0.
     rate_ip = Akima1DInterpolator(t, rate)
     interp_rate = rate_ip(interp_t)
-#    except Exception:
-#        print('t shape: %s rate shape: %s' % (str(t.shape), str(rate.shape)))
     interp_rate /= 1000.
-    spike_times = []
     non_zero = np.where(interp_rate > 1.e-100)[0]
     if len(non_zero) == 0:
-        return spike_times
+        return []
     interp_rate[non_zero] = 1. / (1. / interp_rate[non_zero] - refractory)
     max_rate = np.max(interp_rate)
     if not max_rate > 0.:
-        return spike_times
-    i = 0
-    ISI_memory = 0.
-    while i < len(interp_t):
-        x = generator.uniform(0.0, 1.0)
-        if x > 0.:
-            ISI = -np.log(x) / max_rate
-            i += int(ISI / dt)
-            ISI_memory += ISI
-            if (i < len(interp_t)) and (generator.uniform(0.0, 1.0) <= (interp_rate[i] / max_rate)) and ISI_memory >= 0.:
-                spike_times.append(interp_t[i])
-                ISI_memory = -refractory
-    return spike_times
+        return []
+    return list(thin_inhom_poisson_candidates(interp_rate, interp_t, dt, refractory, generator))
+
+
+def get_inhom_poisson_spike_times_by_thinning_batch(rates, t, seeds, dt=0.02, refractory=3.):
+    """
+    Given time series of instantaneous spike rates in Hz for multiple
+    cells that share the same time base, produce spike trains
+    consistent with inhomogeneous Poisson processes with a refractory
+    period after each spike. The rate interpolation is performed for
+    all cells at once, and each spike train is generated with its own
+    random number generator seeded with the corresponding seed, so
+    that the result for a given cell is the same as with
+    get_inhom_poisson_spike_times_by_thinning and a
+    np.random.RandomState initialized with that seed.
+    :param rates: array of instantaneous rates (Hz) with shape (number of cells, len(t))
+    :param t: corresponding time values (ms)
+    :param seeds: random seed for each cell
+    :param dt: temporal resolution for spike times (ms)
+    :param refractory: absolute deadtime following a spike (ms)
+    :return: list of arrays of spike times (ms)
+    """
+    rates = np.array(rates, dtype=np.float64, ndmin=2)
+    if rates.shape[0] != len(seeds):
+        raise RuntimeError(f'get_inhom_poisson_spike_times_by_thinning_batch: number of rate maps {rates.shape[0]} '
+                           f'does not match number of seeds {len(seeds)}')
+    interp_t = np.arange(t[0], t[-1] + dt, dt)
+    rates[np.isclose(rates, 0., atol=1e-3, rtol=1e-3)] = 0.
+    rate_ip = Akima1DInterpolator(t, rates.T, axis=0)
+    interp_rates = rate_ip(interp_t).T / 1000.
+    non_zero = interp_rates > 1.e-100
+    interp_rates[non_zero] = 1. / (1. / interp_rates[non_zero] - refractory)
+
+    spike_trains = []
+    for interp_rate, seed in zip(interp_rates, seeds):
+        spike_times = np.asarray([], dtype=np.float64)
+        if np.any(interp_rate > 1.e-100) and (np.max(interp_rate) > 0.):
+            generator = np.random.RandomState(int(seed))
+            spike_times = thin_inhom_poisson_candidates(interp_rate, interp_t, dt, refractory, generator)
+        spike_trains.append(spike_times)
+    return spike_trains
 
 
 class StGen(object):
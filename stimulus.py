@@ -1,4 +1,4 @@
-import os, sys, gc, copy, time
+import os, sys, gc, copy, time, hashlib, numbers, shutil
 import numpy as np
 from scipy.interpolate import Rbf
 from scipy.ndimage import gaussian_filter
@@ -534,15 +534,21 @@ def get_grid_rate_map(x0, y0, spacing, orientation, x, y, a=0.7):
     :param y: array
     :param a: concentrates field width relative to grid spacing
     :return: array
+
+    The parameters may also be arrays of shape (n, 1, ...), in which
+    case the rate maps of n cells are returned as an array of shape
+    (n, ...).
     """
     b = -1.5
     theta_k = [np.deg2rad(-30.), np.deg2rad(30.), np.deg2rad(90.)]
 
-    inner_sum = np.zeros_like(x)
+    inner_sum = np.zeros(np.broadcast_shapes(np.shape(x), np.shape(x0), np.shape(spacing), np.shape(orientation)),
+                         dtype=np.asarray(x).dtype)
+    dx = x - x0
+    dy = y - y0
+    k = (4. * np.pi) / (np.sqrt(3.) * spacing)
     for theta in theta_k:
-        inner_sum += np.cos(((4. * np.pi) / (np.sqrt(3.) * spacing)) *
-                            (np.cos(theta - orientation) * (x - x0) +
-                             np.sin(theta - orientation) * (y - y0)))
+        inner_sum += np.cos(k * np.cos(theta - orientation) * dx + k * np.sin(theta - orientation) * dy)
     transfer = lambda z: np.exp(a * (z - b)) - 1.
     max_rate = transfer(3.)
     rate_map = transfer(inner_sum) / max_rate
@@ -553,6 +559,82 @@ def get_grid_rate_map(x0, y0, spacing, orientation, x, y, a=0.7):
     
 
 
+def get_rate_maps(input_cell_configs, x, y, velocity=None, scale=1.0, initial_phase=0., chunk_size=None):
+    """
+    Evaluates the rate maps of multiple input cells over the given
+    coordinates. Grid and place cell configurations are grouped
+    together and evaluated in chunks of chunk_size cells with one
+    vectorized pass per chunk; other configurations, and
+    configurations with phase modulation, are evaluated with their own
+    get_rate_map method.
+
+    :param input_cell_configs: list of input cell configuration objects
+    :param x: array
+    :param y: array
+    :param velocity: array
+    :param scale: float; scaling factor for grid spacing and place field width
+    :param initial_phase: float
+    :param chunk_size: int; maximum number of cells evaluated at once;
+      by default, chosen so that each chunk has about 2**16 elements
+    :return: array of shape (len(input_cell_configs), ) + x.shape
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    if chunk_size is None:
+        chunk_size = max(1, 2**16 // max(x.size, 1))
+    rate_maps = np.zeros((len(input_cell_configs),) + x.shape)
+    expand = (slice(None),) + (np.newaxis,) * x.ndim
+
+    grid_inds = []
+    place_inds = []
+    for i, input_cell_config in enumerate(input_cell_configs):
+        if input_cell_config.phase_mod_function is None:
+            if isinstance(input_cell_config, GridInputCellConfig):
+                grid_inds.append(i)
+                continue
+            elif isinstance(input_cell_config, PlaceInputCellConfig):
+                place_inds.append(i)
+                continue
+        if isinstance(input_cell_config, ConstantInputCellConfig):
+            rate_maps[i] = input_cell_config.get_rate_map(x=x, y=y, velocity=velocity,
+                                                          initial_phase=initial_phase)
+        else:
+            rate_maps[i] = input_cell_config.get_rate_map(x=x, y=y, velocity=velocity, scale=scale,
+                                                          initial_phase=initial_phase)
+
+    for chunk_start in range(0, len(grid_inds), chunk_size):
+        chunk_inds = grid_inds[chunk_start:chunk_start+chunk_size]
+        chunk_configs = [input_cell_configs[i] for i in chunk_inds]
+        x0 = np.asarray([c.x0 for c in chunk_configs])[expand]
+        y0 = np.asarray([c.y0 for c in chunk_configs])[expand]
+        spacing = np.asarray([c.grid_spacing for c in chunk_configs])[expand]
+        orientation = np.asarray([c.grid_orientation for c in chunk_configs])[expand]
+        a = np.asarray([c.grid_field_width_concentration_factor for c in chunk_configs])[expand]
+        peak_rate = np.asarray([c.peak_rate for c in chunk_configs])[expand]
+        rate_maps[chunk_inds] = get_grid_rate_map(x0, y0, scale * spacing, orientation, x, y, a=a) * peak_rate
+
+    for chunk_start in range(0, len(place_inds), chunk_size):
+        chunk_inds = place_inds[chunk_start:chunk_start+chunk_size]
+        chunk_configs = [input_cell_configs[i] for i in chunk_inds]
+        num_fields = np.asarray([c.num_fields for c in chunk_configs], dtype=np.int64)
+        chunk_rate_maps = np.zeros((len(chunk_inds),) + x.shape)
+        for field_i in range(np.max(num_fields, initial=0)):
+            field_cells = np.flatnonzero(num_fields > field_i)
+            field_x0 = np.asarray([chunk_configs[i].x0[field_i] for i in field_cells])[expand]
+            field_y0 = np.asarray([chunk_configs[i].y0[field_i] for i in field_cells])[expand]
+            field_width = np.asarray([chunk_configs[i].field_width[field_i] for i in field_cells])[expand]
+            field_rate_maps = get_place_rate_map(field_x0, field_y0, field_width * scale, x, y)
+            if len(field_cells) == len(chunk_inds):
+                np.maximum(chunk_rate_maps, field_rate_maps, out=chunk_rate_maps)
+            else:
+                chunk_rate_maps[field_cells] = np.maximum(chunk_rate_maps[field_cells], field_rate_maps)
+        peak_rate = np.asarray([c.peak_rate for c in chunk_configs])[expand]
+        chunk_rate_maps *= peak_rate
+        rate_maps[chunk_inds] = gaussian_filter(chunk_rate_maps, sigma=(0,) + (1,) * x.ndim)
+
+    return rate_maps
+
+
 def get_input_cell_config(selectivity_type, selectivity_type_names, population=None, stimulus_config=None,
                           arena=None, selectivity_config=None, distance=None, local_random=None,
                           selectivity_attr_dict=None, phase_mod_config=None, noise_gen_dict=None, comm=None):
@@ -1359,11 +1441,127 @@ def bin_stimulus_features(features, t, bin_size, time_range):
 
 
 
+def rate_map_cache_key(key_items):
+    """
+    Computes a content hash of the given key items, which may be
+    nested lists, tuples and dicts of scalars, strings, arrays and
+    objects with attributes.
+
+    :param key_items: list
+    :return: str
+    """
+    key_hash = hashlib.sha256()
+
+    def update(item):
+        if isinstance(item, np.ndarray):
+            key_hash.update(f'ndarray{item.dtype.str}{item.shape}'.encode())
+            key_hash.update(np.ascontiguousarray(item).tobytes())
+        elif isinstance(item, dict):
+            key_hash.update(b'dict')
+            for k in sorted(item, key=str):
+                update(str(k))
+                update(item[k])
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            key_hash.update(type(item).__name__.encode())
+            for v in (sorted(item) if isinstance(item, (set, frozenset)) else item):
+                update(v)
+        elif isinstance(item, (str, bytes, bool, numbers.Number, type(None), np.generic)):
+            key_hash.update(repr(item).encode())
+        elif hasattr(item, '__dict__'):
+            update(type(item).__name__)
+            update({k: v for k, v in viewitems(vars(item)) if not callable(v)})
+        else:
+            key_hash.update(repr(item).encode())
+        key_hash.update(b';')
+
+    update(key_items)
+    return key_hash.hexdigest()
+
+
+def rate_map_cache_path(cache_dir, input_features_path, key_items):
+    """
+    Returns the path of the cache entry for rate maps computed from the
+    given input features file with the given parameters. The size and
+    modification time of the input features file are part of the key,
+    so that entries are invalidated when the file changes.
+
+    :param cache_dir: str
+    :param input_features_path: str (path to file)
+    :param key_items: list
+    :return: str
+    """
+    input_features_stat = os.stat(input_features_path)
+    file_key = (os.path.abspath(input_features_path), input_features_stat.st_size, input_features_stat.st_mtime_ns)
+    return os.path.join(cache_dir, f'rate_maps_{rate_map_cache_key([file_key, key_items])}')
+
+
+def read_rate_map_cache(cache_path):
+    """
+    Reads a rate map cache entry, if it exists. The rate maps are
+    memory-mapped in copy-on-write mode.
+
+    :param cache_path: str
+    :return: tuple of arrays (gids, rate maps), or None
+    """
+    if not os.path.isdir(cache_path):
+        return None
+    gids = np.load(os.path.join(cache_path, 'gids.npy'))
+    rate_maps = np.load(os.path.join(cache_path, 'rate_maps.npy'), mmap_mode='c')
+    return gids, rate_maps
+
+
+def write_rate_map_cache(cache_path, gids, rate_maps):
+    """
+    Writes a rate map cache entry. The entry is written to a temporary
+    directory that is then atomically renamed, so that concurrent
+    readers never observe a partially written entry.
+
+    :param cache_path: str
+    :param gids: array
+    :param rate_maps: array
+    """
+    tmp_path = f'{cache_path}.tmp.{os.getpid()}.{MPI.COMM_WORLD.rank}'
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'gids.npy'), np.asarray(gids, dtype=np.int64))
+    np.save(os.path.join(tmp_path, 'rate_maps.npy'), rate_maps)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # another process has already written this entry
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def cached_rate_maps(comm, cache_path):
+    """
+    Reads the given rate map cache entry on all ranks of comm. Returns
+    None on all ranks unless the entry exists on every rank, so that
+    the collective read of the input features can proceed when any
+    rank misses the cache.
+
+    :param comm: MPI communicator
+    :param cache_path: str or None
+    :return: tuple of arrays (gids, rate maps), or None
+    """
+    cached = read_rate_map_cache(cache_path) if cache_path is not None else None
+    if comm is not None:
+        if not comm.allreduce(cached is not None, op=MPI.LAND):
+            return None
+    return cached
+
+
 def rate_maps_from_features (env, population, cell_index_set, input_features_path=None, input_features_namespace=None, 
                              input_features_dict=None, arena_id=None, trajectory_id=None, time_range=None,
-                             include_time=False, phase_mod_config=None, include_empty=False):
+                             include_time=False, phase_mod_config=None, include_empty=False, cache_dir=None):
     
-    """Initializes presynaptic spike sources from a file with input selectivity features represented as firing rates."""
+    """Initializes presynaptic spike sources from a file with input selectivity features represented as firing rates.
+
+    If cache_dir (by default env.rate_map_cache_dir) is not None, and
+    input_features_path is given, the rate maps are stored in an
+    on-disk cache keyed by the input features file, namespace,
+    arena/trajectory, temporal resolution, phase modulation
+    configuration and cell selection, and are memory-mapped from the
+    cache on subsequent calls with the same key.
+    """
 
     if input_features_dict is not None:
         if (input_features_path is not None) or  (input_features_namespace is not None):
@@ -1416,6 +1614,24 @@ def rate_maps_from_features (env, population, cell_index_set, input_features_pat
 
     pop_index = int(env.Populations[population])
 
+    if cache_dir is None:
+        cache_dir = env.rate_map_cache_dir
+    cache_path = None
+    if (cache_dir is not None) and (input_features_path is not None):
+        cache_path = rate_map_cache_path(cache_dir, input_features_path,
+                                         ['trajectory', population, input_features_namespace, arena_id,
+                                          trajectory_id, trajectory, temporal_resolution, equilibration_duration,
+                                          time_range, phase_mod_config, include_empty,
+                                          sorted(cell_index_set)])
+    cached = cached_rate_maps(env.comm, cache_path)
+    if cached is not None:
+        for gid, rate_map in zip(cached[0], cached[1]):
+            if include_time:
+                input_rate_map_dict[int(gid)] = (t, rate_map)
+            else:
+                input_rate_map_dict[int(gid)] = rate_map
+        return input_rate_map_dict
+
     if input_features_path is not None:
         this_input_features_namespace = '%s %s' % (input_features_namespace, arena_id)
         input_features_iter = scatter_read_cell_attribute_selection(input_features_path, population,
@@ -1426,6 +1642,8 @@ def rate_maps_from_features (env, population, cell_index_set, input_features_pat
     else:
         input_features_iter = viewitems(input_features_dict)
         
+    input_cell_gids = []
+    input_cell_configs = []
     for gid, selectivity_attr_dict in input_features_iter:
 
         this_selectivity_type = selectivity_attr_dict['Selectivity Type'][0]
@@ -1440,10 +1658,17 @@ def rate_maps_from_features (env, population, cell_index_set, input_features_pat
                 if input_cell_config.num_fields < 1:
                     continue
 
-        rate_map = input_cell_config.get_rate_map(x=x, y=y, velocity=velocity if phase_mod_config is not None else None)
-        rate_map[np.isclose(rate_map, 0., atol=1e-3, rtol=1e-3)] = 0.
+        input_cell_gids.append(gid)
+        input_cell_configs.append(input_cell_config)
+
+    rate_maps = get_rate_maps(input_cell_configs, x=x, y=y,
+                              velocity=velocity if phase_mod_config is not None else None)
+    rate_maps[np.isclose(rate_maps, 0., atol=1e-3, rtol=1e-3)] = 0.
 
+    if cache_path is not None:
+        write_rate_map_cache(cache_path, input_cell_gids, rate_maps)
 
+    for gid, rate_map in zip(input_cell_gids, rate_maps):
         if include_time:
             input_rate_map_dict[gid] = (t, rate_map)
         else:
@@ -1453,9 +1678,14 @@ def rate_maps_from_features (env, population, cell_index_set, input_features_pat
 
 
 def arena_rate_maps_from_features (env, population, input_features_path, input_features_namespace, cell_index_set,
-                                   arena_id=None, time_range=None, n_trials=1):
+                                   arena_id=None, time_range=None, n_trials=1, cache_dir=None):
     
-    """Initializes presynaptic spike sources from a file with input selectivity features represented as firing rates."""
+    """Initializes presynaptic spike sources from a file with input selectivity features represented as firing rates.
+
+    If cache_dir (by default env.rate_map_cache_dir) is not None, the
+    rate maps are stored in and memory-mapped from an on-disk cache,
+    as in rate_maps_from_features.
+    """
         
     if time_range is not None:
         if time_range[0] is None:
@@ -1482,11 +1712,26 @@ def arena_rate_maps_from_features (env, population, input_features_path, input_f
     input_rate_map_dict = {}
     pop_index = int(env.Populations[population])
 
+    if cache_dir is None:
+        cache_dir = env.rate_map_cache_dir
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = rate_map_cache_path(cache_dir, input_features_path,
+                                         ['arena', population, input_features_namespace, arena_id,
+                                          arena.domain, spatial_resolution, sorted(cell_index_set)])
+    cached = cached_rate_maps(env.comm, cache_path)
+    if cached is not None:
+        for gid, rate_map in zip(cached[0], cached[1]):
+            input_rate_map_dict[int(gid)] = rate_map
+        return input_rate_map_dict
+
     input_features_iter = scatter_read_cell_attribute_selection(input_features_path, population,
                                                                 selection=cell_index_set,
                                                                 namespace=this_input_features_namespace,
                                                                 mask=set(input_features_attr_names), 
                                                                 comm=env.comm, io_size=env.io_size)
+    input_cell_gids = []
+    input_cell_configs = []
     for gid, selectivity_attr_dict in input_features_iter:
 
         this_selectivity_type = selectivity_attr_dict['Selectivity Type'][0]
@@ -1496,9 +1741,15 @@ def arena_rate_maps_from_features (env, population, input_features_path, input_f
                                                   selectivity_type_names=selectivity_type_names,
                                                   selectivity_attr_dict=selectivity_attr_dict)
         if input_cell_config.num_fields > 0:
-            rate_map = input_cell_config.get_rate_map(x=arena_x, y=arena_y)
-            rate_map[np.isclose(rate_map, 0., atol=1e-3, rtol=1e-3)] = 0.
-            input_rate_map_dict[gid] = rate_map
+            input_cell_gids.append(gid)
+            input_cell_configs.append(input_cell_config)
+
+    rate_maps = get_rate_maps(input_cell_configs, x=arena_x, y=arena_y)
+    rate_maps[np.isclose(rate_maps, 0., atol=1e-3, rtol=1e-3)] = 0.
+    if cache_path is not None:
+        write_rate_map_cache(cache_path, input_cell_gids, rate_maps)
+    for gid, rate_map in zip(input_cell_gids, rate_maps):
+        input_rate_map_dict[gid] = rate_map
             
     return input_rate_map_dict
 
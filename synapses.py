@@ -10,7 +10,7 @@ from dentate.cells import get_distance_to_node, get_donor, get_mech_rules_dict,
     custom_filter_modify_slope_if_terminal, custom_filter_by_branch_order
 from dentate.neuron_utils import h, default_ordered_sec_types, mknetcon, mknetcon_vecstim, interplocs, list_find
 from dentate.utils import KDDict, ExprClosure, Promise, NamedTupleWithDocstring, get_module_logger, generator_ifempty, map, range, str, \
-     viewitems, viewkeys, zip, zip_longest, partitionn, rejection_sampling
+     viewitems, viewkeys, viewvalues, zip, zip_longest, partitionn, rejection_sampling
 
 # This logger will inherit its settings from the root logger, created in dentate.env
 logger = get_module_logger(__name__)
@@ -197,18 +197,461 @@ Synapse = NamedTupleWithDocstring(
      ])
 
 
+class SynapseSourceView(object):
+    """Presents the source attributes of one row of a
+    :class:'SynapseArrays' store with the same interface as
+    :class:'SynapseSource'. Reads and writes of the gid, population
+    and delay attributes go directly to the underlying arrays.
+    """
+    __slots__ = 'store', 'row'
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    @property
+    def gid(self):
+        gid = self.store.source_gids[self.row]
+        return None if gid < 0 else int(gid)
+
+    @gid.setter
+    def gid(self, value):
+        self.store.source_gids[self.row] = -1 if value is None else value
+
+    @property
+    def population(self):
+        population = self.store.source_populations[self.row]
+        return None if population < 0 else int(population)
+
+    @population.setter
+    def population(self, value):
+        self.store.source_populations[self.row] = -1 if value is None else value
+
+    @property
+    def delay(self):
+        delay = self.store.delays[self.row]
+        return None if np.isnan(delay) else float(delay)
+
+    @delay.setter
+    def delay(self, value):
+        self.store.delays[self.row] = np.nan if value is None else value
+
+    def __repr__(self):
+        delay = self.delay
+        repr_delay = 'None' if delay is None else f'{delay:.02f}'
+        return f'SynapseSource({self.gid}, {self.population}, {repr_delay})'
+
+    __str__ = __repr__
+
+
+class SynapseMechAttrs(defaultdict):
+    """Mechanism attribute dictionary of one row of a
+    :class:'SynapseArrays' store. It is added to the side table of
+    the store when the row is first viewed, and all views of the row
+    share it.
+    """
+    __slots__ = 'store', 'row'
+
+    def __init__(self, store, row):
+        super().__init__(dict)
+        self.store = store
+        self.row = row
+
+    def __reduce__(self):
+        return (defaultdict, (dict,), None, None, iter(self.items()))
+
+
+class SynapseArrays(collections.abc.Mapping):
+    """Structure-of-arrays store of the synapses of one cell. Synapse
+    attributes are kept in columnar arrays indexed by row, and
+    mechanism attribute dictionaries are kept in a side table that
+    only contains entries for synapses that have been viewed.
+
+    The store behaves as a mapping of synapse id to :class:'Synapse',
+    with the same semantics as the per-gid dictionaries of the default
+    :class:'SynapseAttributes' backend: looking up a synapse id that
+    does not exist returns None. The Synapse tuples are views that
+    are created on access; their source attribute writes through to
+    the arrays.
+      - syn_ids - synapse ids (uint32)
+      - syn_types - enumerated synapse types (uint8)
+      - swc_types - enumerated swc types (uint8)
+      - syn_layers - enumerated synapse layers (int8)
+      - syn_secs - synapse section indices (uint32)
+      - syn_locs - synapse locations in section (float32)
+      - source_gids - source cell gids (int32; -1 if not set)
+      - source_populations - enumerated source population indices (int16; -1 if not set)
+      - delays - connection delays (float32; NaN if not set)
+      - sec_seq - sequence numbers of insertion into the synapse sections (int64),
+        used to order synapses within a section as in the sec_dict of the default backend
+      - attr_dicts - dict { row: { mechanism index: { attribute: value } } }
+    """
+
+    def __init__(self, syn_ids, syn_layers, syn_types, swc_types, syn_secs, syn_locs):
+        self.syn_ids = np.asarray(syn_ids, dtype=np.uint32)
+        n = len(self.syn_ids)
+        self.syn_layers = np.asarray(syn_layers, dtype=np.int8).reshape((n,))
+        self.syn_types = np.asarray(syn_types, dtype=np.uint8).reshape((n,))
+        self.swc_types = np.asarray(swc_types, dtype=np.uint8).reshape((n,))
+        self.syn_secs = np.asarray(syn_secs, dtype=np.uint32).reshape((n,))
+        self.syn_locs = np.asarray(syn_locs, dtype=np.float32).reshape((n,))
+        self.source_gids = np.full((n,), -1, dtype=np.int32)
+        self.source_populations = np.full((n,), -1, dtype=np.int16)
+        self.delays = np.full((n,), np.nan, dtype=np.float32)
+        self.sec_seq = np.arange(n, dtype=np.int64)
+        self.next_sec_seq = n
+        self.attr_dicts = {}
+        self.syn_id_order = np.argsort(self.syn_ids, kind='stable')
+        self.sorted_syn_ids = self.syn_ids[self.syn_id_order]
+        if n > 1 and np.any(self.sorted_syn_ids[1:] == self.sorted_syn_ids[:-1]):
+            raise RuntimeError('SynapseArrays: duplicate synapse ids')
+
+    def rows(self, syn_ids):
+        """
+        Returns the rows of the given synapse ids, and a boolean mask
+        that is False for synapse ids that do not exist in the store.
+
+        :param syn_ids: array of int
+        :return: tuple of array of int, array of bool
+        """
+        syn_ids = np.asarray(syn_ids, dtype=np.int64).reshape((-1,))
+        n = len(self.sorted_syn_ids)
+        if n == 0:
+            return np.zeros(syn_ids.shape, dtype=np.intp), np.zeros(syn_ids.shape, dtype=bool)
+        pos = np.minimum(np.searchsorted(self.sorted_syn_ids, syn_ids), n - 1)
+        found = self.sorted_syn_ids[pos] == syn_ids
+        return self.syn_id_order[pos], found
+
+    def row(self, syn_id):
+        """
+        Returns the row of the given synapse id, or None if it does not exist in the store.
+        """
+        n = len(self.sorted_syn_ids)
+        pos = np.searchsorted(self.sorted_syn_ids, syn_id)
+        if pos < n and self.sorted_syn_ids[pos] == syn_id:
+            return self.syn_id_order[pos]
+        else:
+            return None
+
+    def view(self, row):
+        """
+        Returns a :class:'Synapse' view of the given row.
+        """
+        attr_dict = self.attr_dicts.get(row, None)
+        if attr_dict is None:
+            attr_dict = SynapseMechAttrs(self, row)
+            self.attr_dicts[row] = attr_dict
+        return Synapse(syn_type=int(self.syn_types[row]), swc_type=int(self.swc_types[row]),
+                       syn_layer=int(self.syn_layers[row]), syn_loc=float(self.syn_locs[row]),
+                       syn_section=int(self.syn_secs[row]), source=SynapseSourceView(self, row),
+                       attr_dict=attr_dict)
+
+    def get_attr_dict(self, syn_id):
+        """
+        Returns the mechanism attribute dictionary of the given
+        synapse id without creating a side table entry, or None if the
+        synapse has not been viewed.
+        """
+        row = self.row(syn_id)
+        if row is None:
+            return None
+        return self.attr_dicts.get(row, None)
+
+    def modify_locs(self, syn_ids, syn_secs, syn_locs):
+        """
+        Modifies the section and location of existing synapses. The
+        modified synapses are moved to the end of their sections.
+        """
+        rows, found = self.rows(syn_ids)
+        if not np.all(found):
+            raise KeyError(f'SynapseArrays.modify_locs: synapse ids {np.asarray(syn_ids)[~found]} not found')
+        self.syn_secs[rows] = syn_secs
+        self.syn_locs[rows] = syn_locs
+        self.sec_seq[rows] = np.arange(self.next_sec_seq, self.next_sec_seq + len(rows), dtype=np.int64)
+        self.next_sec_seq += len(rows)
+
+    def init_sources(self, gid, presyn_index, presyn_gids, edge_syn_ids, delays):
+        """
+        Sets the source gid, source population index and delay of the
+        given synapse ids in one scatter operation. Raises an error if
+        any of the synapse ids does not exist, occurs more than once,
+        or has already been initialized with edge attributes.
+
+        :param gid: gid for post-synaptic (target) cell (int)
+        :param presyn_index: population index of presynaptic (source) cells (int)
+        :param presyn_gids: gids for presynaptic (source) cells (array of int)
+        :param edge_syn_ids: synapse ids on target cells to be used for connections (array of int)
+        :param delays: axon conduction (netcon) delays (array of float)
+        """
+        edge_syn_ids = np.asarray(edge_syn_ids).reshape((-1,))
+        presyn_gids = np.asarray(presyn_gids).reshape((-1,))
+        delays = np.asarray(delays).reshape((-1,))
+        if not (len(presyn_gids) == len(edge_syn_ids) == len(delays)):
+            raise RuntimeError(f'init_edge_attrs: gid {gid}: number of synapse ids ({len(edge_syn_ids)}), '
+                               f'source gids ({len(presyn_gids)}) and delays ({len(delays)}) do not match')
+        rows, found = self.rows(edge_syn_ids)
+        if not np.all(found):
+            raise RuntimeError(f'init_edge_attrs: gid {gid}: synapse ids {edge_syn_ids[~found]} '
+                               'have not been initialized')
+        initialized = self.source_gids[rows] >= 0
+        if np.any(initialized):
+            raise RuntimeError(f'init_edge_attrs: gid {gid}: synapse ids {edge_syn_ids[initialized]} '
+                               'have already been initialized with edge attributes')
+        unique_rows, row_counts = np.unique(rows, return_counts=True)
+        if np.any(row_counts > 1):
+            raise RuntimeError(f'init_edge_attrs: gid {gid}: synapse ids {self.syn_ids[unique_rows[row_counts > 1]]} '
+                               'occur more than once in edge attributes')
+        self.source_gids[rows] = presyn_gids
+        self.source_populations[rows] = presyn_index
+        self.delays[rows] = delays
+
+    def select(self, syn_sections=None, syn_indexes=None, syn_types=None, layers=None, sources=None,
+               swc_types=None):
+        """
+        Returns the rows of synapses that match all the given criteria,
+        in the order in which synapses were added to the store.
+        A criterion that is None matches all synapses.
+        """
+        mask = np.ones(self.syn_ids.shape, dtype=bool)
+        for values, column in ((syn_sections, self.syn_secs),
+                               (syn_indexes, self.syn_ids),
+                               (syn_types, self.syn_types),
+                               (layers, self.syn_layers),
+                               (sources, self.source_populations),
+                               (swc_types, self.swc_types)):
+            if values is not None:
+                values = np.asarray([v for v in values if isinstance(v, (int, np.integer))], dtype=np.int64)
+                mask &= np.isin(column, values)
+        return np.flatnonzero(mask)
+
+    def __getitem__(self, syn_id):
+        row = self.row(syn_id)
+        if row is None:
+            return None
+        return self.view(row)
+
+    def get(self, syn_id, default=None):
+        row = self.row(syn_id)
+        if row is None:
+            return default
+        return self.view(row)
+
+    def __contains__(self, syn_id):
+        return self.row(syn_id) is not None
+
+    def __iter__(self):
+        return iter(self.syn_ids.tolist())
+
+    def __len__(self):
+        return len(self.syn_ids)
+
+    def items(self):
+        return ((int(syn_id), self.view(row)) for row, syn_id in enumerate(self.syn_ids))
+
+    def values(self):
+        return (self.view(row) for row in range(len(self.syn_ids)))
+
+
+class SynapseFilterIndex(object):
+    """Inverted index of the synapses of one cell, used by
+    :class:'SynapseAttributes' to answer filter_synapses queries. For
+    each indexed attribute (section, synapse type, layer, swc type and
+    source population), the positions of the synapses with each
+    attribute value are stored as sorted arrays, and a query is
+    answered by intersecting the unions of the positions of the
+    requested values. Positions refer to the order of the synapse ids
+    given to the constructor.
+    """
+
+    def __init__(self, syn_ids, syn_secs, syn_types, syn_layers, swc_types, source_populations,
+                 sec_order=None):
+        """
+        :param syn_ids: array of synapse ids
+        :param syn_secs: array of section indices
+        :param syn_types: array of synapse types
+        :param syn_layers: array of layers
+        :param swc_types: array of swc types
+        :param source_populations: array of source population indices, -1 for synapses without source
+        :param sec_order: optional array with the rank of each synapse within its section, used to
+          order the results of queries by section
+        """
+        self.syn_ids = np.asarray(syn_ids)
+        self.syn_secs = np.asarray(syn_secs)
+        self.sec_order = None if sec_order is None else np.asarray(sec_order)
+        self.postings = {}
+        for name, column in (('syn_sections', syn_secs),
+                             ('syn_types', syn_types),
+                             ('layers', syn_layers),
+                             ('swc_types', swc_types),
+                             ('sources', source_populations)):
+            column = np.asarray(column)
+            order = np.argsort(column, kind='stable')
+            values, starts = np.unique(column[order], return_index=True)
+            self.postings[name] = dict(zip(values.tolist(), np.split(order, starts[1:])))
+
+    def __len__(self):
+        return len(self.syn_ids)
+
+    def positions(self, name, values):
+        """
+        Returns the sorted positions of synapses whose attribute has one of the given values.
+        """
+        postings = self.postings[name]
+        value_positions = [postings[v] for v in set(values) if isinstance(v, (int, np.integer)) and v in postings]
+        if len(value_positions) == 0:
+            return np.asarray([], dtype=np.intp)
+        elif len(value_positions) == 1:
+            return value_positions[0]
+        return np.sort(np.concatenate(value_positions))
+
+    def select(self, syn_sections=None, syn_indexes=None, syn_types=None, layers=None, sources=None,
+               swc_types=None, section_order=False):
+        """
+        Returns the positions of synapses that match all the given
+        criteria. A criterion that is None matches all synapses.
+        If section_order is True and syn_sections is given, the
+        positions are grouped by section in the order of syn_sections,
+        and ordered by sec_order within each section.
+        """
+        n = len(self.syn_ids)
+        counts = np.zeros((n,), dtype=np.uint8)
+        n_criteria = 0
+        for name, values in (('syn_sections', syn_sections),
+                             ('syn_types', syn_types),
+                             ('layers', layers),
+                             ('sources', sources),
+                             ('swc_types', swc_types)):
+            if values is not None:
+                counts[self.positions(name, values)] += 1
+                n_criteria += 1
+        if syn_indexes is not None:
+            syn_indexes = np.asarray([v for v in syn_indexes if isinstance(v, (int, np.integer))], dtype=np.int64)
+            counts[np.isin(self.syn_ids, syn_indexes)] += 1
+            n_criteria += 1
+        result = np.flatnonzero(counts == n_criteria)
+        if section_order and (syn_sections is not None) and (len(result) > 0):
+            section_rank = {}
+            for sec_index in syn_sections:
+                section_rank.setdefault(sec_index, len(section_rank))
+            result_ranks = np.asarray([section_rank[sec_index] for sec_index in self.syn_secs[result].tolist()])
+            if self.sec_order is None:
+                result = result[np.argsort(result_ranks, kind='stable')]
+            else:
+                result = result[np.lexsort((self.sec_order[result], result_ranks))]
+        return result
+
+
+class SynapseFilterCache(object):
+    """Bounded cache of filter_synapses query results with least
+    recently used eviction. Keys are tuples whose first element is
+    the cell gid, so that all entries of a cell can be invalidated at
+    once.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.gid_keys = defaultdict(set)
+
+    def get(self, key):
+        value = self.entries.get(key, None)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.gid_keys[key[0]].add(key)
+        while len(self.entries) > self.max_size:
+            evicted_key, _ = self.entries.popitem(last=False)
+            gid_keys = self.gid_keys[evicted_key[0]]
+            gid_keys.discard(evicted_key)
+            if len(gid_keys) == 0:
+                del self.gid_keys[evicted_key[0]]
+
+    def invalidate(self, gid):
+        for key in self.gid_keys.pop(gid, ()):
+            self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+        self.gid_keys.clear()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SynParamBinding(object):
+    """Resolved targets of one synaptic mechanism parameter on one
+    cell, as specified by a sec_type, mechanism name, parameter name
+    and synapse filters. The synapse attribute dictionaries, point
+    processes and netcons that modify_syn_param would update are
+    located once, so that applying a new value does not require
+    re-parsing rules or re-filtering synapses.
+      - attr_dicts - mechanism attribute dictionaries of the filtered synapses
+      - mech_targets - point processes with the parameter as an attribute
+      - netcon_targets - list of (netcon, weight index)
+    """
+
+    __slots__ = 'cell', 'sec_type', 'syn_name', 'param_name', 'rules', 'attr_dicts', 'mech_targets', 'netcon_targets'
+
+    def __init__(self, cell, sec_type, syn_name, param_name, rules, attr_dicts, mech_targets, netcon_targets):
+        self.cell = cell
+        self.sec_type = sec_type
+        self.syn_name = syn_name
+        self.param_name = param_name
+        self.rules = rules
+        self.attr_dicts = attr_dicts
+        self.mech_targets = mech_targets
+        self.netcon_targets = netcon_targets
+
+    def apply(self, value):
+        """
+        Sets the parameter to the given value in the mechanism
+        dictionary of the cell, the synapse attribute dictionaries and
+        all bound point processes and netcons.
+
+        :param value: float
+        """
+        param_name = self.param_name
+        rules = {'value': value}
+        rules.update(self.rules)
+        mech_dict = self.cell.mech_dict
+        sec_mech_dict = mech_dict.setdefault(self.sec_type, {})
+        syn_mech_dict = sec_mech_dict.setdefault('synapses', {})
+        syn_mech_dict.setdefault(self.syn_name, {})[param_name] = rules
+        for attr_dict in self.attr_dicts:
+            attr_dict[param_name] = value
+        for pps in self.mech_targets:
+            setattr(pps, param_name, value)
+        for nc, i in self.netcon_targets:
+            nc.weight[i] = value
+
+    def __len__(self):
+        return len(self.attr_dicts)
+
+
 class SynapseAttributes(object):
     """This class provides an interface to store, retrieve, and modify
     attributes of synaptic mechanisms. Handles instantiation of
     complex subcellular gradients of synaptic mechanism attributes.
     """
 
-    def __init__(self, env, syn_mech_names, syn_param_rules):
+    def __init__(self, env, syn_mech_names, syn_param_rules, columnar=False, filter_cache_size=10000):
         """An Env object containing imported network configuration metadata
         uses an instance of SynapseAttributes to track all metadata
         related to the identity, location, and configuration of all
         synaptic connections in the network.
 
+        If columnar is True, the synapses of each cell are stored in
+        a :class:'SynapseArrays' structure-of-arrays store rather than
+        in per-synapse :class:'Synapse' objects. Both backends provide
+        the same accessor interface.
+
         :param env: :class:'Env'
         :param syn_mech_names: dict of the form: { label: mechanism name }
         :param syn_param_rules: dict of the form:
@@ -217,8 +660,11 @@ class SynapseAttributes(object):
                     mech_params: list of parameter names
                     netcon_params: dictionary { parameter name: index }
                 }
+        :param columnar: bool; whether to use the structure-of-arrays synapse store
+        :param filter_cache_size: int; maximum number of cached filter_synapses query results
         """
         self.env = env
+        self.columnar = columnar
         self.syn_mech_names = syn_mech_names
         self.syn_config = { k: v['synapses'] for k, v in viewitems(env.celltypes) if 'synapses' in v }
         self.syn_param_rules = syn_param_rules
@@ -228,7 +674,9 @@ class SynapseAttributes(object):
         self.sec_dict = defaultdict(lambda: defaultdict(lambda: dict()))
         self.pps_dict = defaultdict(lambda: defaultdict(lambda: SynapsePointProcess(mech={}, netcon={}, vecstim={})))
         self.presyn_names = {id: name for name, id in viewitems(env.Populations)}
-        self.filter_cache = {}
+        self.filter_index = {}
+        self.filter_cache = SynapseFilterCache(filter_cache_size)
+        self.param_bindings = {}
 
     def init_syn_id_attrs_from_iter(self, cell_iter, attr_type='dict', attr_tuple_index=None, debug=False):
         """
@@ -285,6 +733,9 @@ class SynapseAttributes(object):
         """
         if gid in self.syn_id_attr_dict:
             raise RuntimeError(f'Entry {gid} exists in synapse attribute dictionary')
+        self.invalidate_filter_index(gid)
+        if self.columnar:
+            self.syn_id_attr_dict[gid] = SynapseArrays(syn_ids, syn_layers, syn_types, swc_types, syn_secs, syn_locs)
         else:
             syn_dict = self.syn_id_attr_dict[gid]
             sec_dict = self.sec_dict[gid]
@@ -300,6 +751,10 @@ class SynapseAttributes(object):
         """
         Modifies synaptic section and location for existing synapses.
         """
+        self.invalidate_filter_index(gid)
+        if self.columnar:
+            self.syn_id_attr_dict[gid].modify_locs(syn_ids, syn_secs, syn_locs)
+            return
         syn_dict = self.syn_id_attr_dict[gid]
         sec_dict = self.sec_dict[gid]
         for syn_id, syn_sec, syn_loc in zip(syn_ids, syn_secs, syn_locs):
@@ -326,9 +781,14 @@ class SynapseAttributes(object):
         connection_velocity = float(self.env.connection_velocity[presyn_name])
 
         if delays is None:
-            delays = [2.0*h.dt] * len(edge_syn_ids)
+            delays = np.full((len(edge_syn_ids),), 2.0*h.dt, dtype=np.float32)
 
         syn_id_dict = self.syn_id_attr_dict[gid]
+        self.invalidate_filter_index(gid)
+
+        if self.columnar:
+            syn_id_dict.init_sources(gid, presyn_index, presyn_gids, edge_syn_ids, delays)
+            return
 
         for edge_syn_id, presyn_gid, delay in zip_longest(edge_syn_ids, presyn_gids, delays):
             syn = syn_id_dict[edge_syn_id]
@@ -336,7 +796,7 @@ class SynapseAttributes(object):
                 raise RuntimeError(f'init_edge_attrs: gid {gid}: synapse id {edge_syn_id} has not been initialized')
 
             if syn.source.gid is not None:
-                raise RuntimeError('init_edge_attrs: gid {gid}: synapse id {edge_syn_id} has already been initialized with edge attributes')
+                raise RuntimeError(f'init_edge_attrs: gid {gid}: synapse id {edge_syn_id} has already been initialized with edge attributes')
 
             syn.source.gid = presyn_gid
             syn.source.population = presyn_index
@@ -373,7 +833,7 @@ class SynapseAttributes(object):
             edge_dists = edge_attrs['Connections'][distance_attr_index]
 
             if set_edge_delays:
-                delays = [max((distance / connection_velocity), 2.0*h.dt) for distance in edge_dists]
+                delays = np.maximum(np.asarray(edge_dists, dtype=np.float64) / connection_velocity, 2.0*h.dt)
             else:
                 delays = None
 
@@ -395,6 +855,7 @@ class SynapseAttributes(object):
             raise RuntimeError(f'add_pps: gid {gid} Synapse id {syn_id} already has mechanism {syn_name}')
         else:
             pps_dict.mech[syn_index] = pps
+        self.param_bindings.pop(gid, None)
         return pps
 
     def has_pps(self, gid, syn_id, syn_name):
@@ -447,6 +908,7 @@ class SynapseAttributes(object):
             raise RuntimeError(f'add_netcon: gid {gid} Synapse id {syn_id} mechanism {syn_name} already has netcon')
         else:
             pps_dict.netcon[syn_index] = nc
+        self.param_bindings.pop(gid, None)
         return nc
 
     def has_netcon(self, gid, syn_id, syn_name):
@@ -496,6 +958,7 @@ class SynapseAttributes(object):
         pps_dict = gid_pps_dict[syn_id]
         if syn_index in pps_dict.netcon:
             del pps_dict.netcon[syn_index]
+            self.param_bindings.pop(gid, None)
         else:
             if throw_error:
                 raise RuntimeError(f'del_netcon: gid {gid} synapse id {syn_id} has no netcon for mechanism {syn_name}')
@@ -565,6 +1028,9 @@ class SynapseAttributes(object):
         """
         syn_index = self.syn_name_index_dict[syn_name]
         syn_id_dict = self.syn_id_attr_dict[gid]
+        if self.columnar:
+            attr_dict = syn_id_dict.get_attr_dict(syn_id)
+            return (attr_dict is not None) and (syn_index in attr_dict)
         syn = syn_id_dict[syn_id]
         return syn_index in syn.attr_dict
 
@@ -579,9 +1045,12 @@ class SynapseAttributes(object):
         """
         syn_index = self.syn_name_index_dict[syn_name]
         syn_id_dict = self.syn_id_attr_dict[gid]
-        syn = syn_id_dict[syn_id]
-        if syn_index in syn.attr_dict:
-            return syn.attr_dict[syn_index]
+        if self.columnar:
+            attr_dict = syn_id_dict.get_attr_dict(syn_id)
+        else:
+            attr_dict = syn_id_dict[syn_id].attr_dict
+        if (attr_dict is not None) and (syn_index in attr_dict):
+            return attr_dict[syn_index]
         else:
             if throw_error:
                 raise RuntimeError(f'get_mech_attrs: gid {gid} synapse {syn_id}: attributes for mechanism {syn_name} not found')
@@ -629,6 +1098,7 @@ class SynapseAttributes(object):
         if syn_id_backup_dict is not None:
             self.syn_id_attr_dict[gid] = copy.deepcopy(syn_id_backup_dict)
             del(self.syn_id_attr_backup_dict[gid][stash_id])
+            self.invalidate_filter_index(gid)
 
 
         
@@ -790,38 +1260,72 @@ class SynapseAttributes(object):
         :param cache: bool
         :return: dictionary { syn_id: { attribute: value } }
         """
-        matches = lambda items: all(
-            map(lambda query_item: (query_item[0] is None) or (query_item[1] in query_item[0]), items))
-
         if cache:
-            cache_args = tuple([tuple(x) if isinstance(x, list) else x for x in
+            cache_args = tuple([tuple(x) if isinstance(x, (list, np.ndarray)) else
+                                frozenset(x) if isinstance(x, set) else x for x in
                                 [gid, syn_sections, syn_indexes, syn_types, layers, sources, swc_types]])
-            if cache_args in self.filter_cache:
-                return self.filter_cache[cache_args]
-
-        if sources is None:
-            source_indexes = None
+            positions = self.filter_cache.get(cache_args)
         else:
-            source_indexes = set(sources)
-
-        sec_dict = self.sec_dict[gid]
-        if syn_sections is not None:
-            # Fast path
-            it = itertools.chain.from_iterable([sec_dict[sec_index].items() for sec_index in syn_sections])
-            syn_dict = {k: v for (k, v) in it}
+            positions = None
+
+        filter_index = self.get_filter_index(gid)
+        if positions is None:
+            positions = filter_index.select(syn_sections=syn_sections, syn_indexes=syn_indexes,
+                                            syn_types=syn_types, layers=layers, sources=sources,
+                                            swc_types=swc_types, section_order=True)
+            if cache:
+                self.filter_cache.put(cache_args, positions)
+
+        if self.columnar:
+            syn_arrays = self.syn_id_attr_dict[gid]
+            return {int(syn_arrays.syn_ids[row]): syn_arrays.view(row) for row in positions}
         else:
             syn_dict = self.syn_id_attr_dict[gid]
+            return {syn_id: syn_dict[syn_id] for syn_id in filter_index.syn_ids[positions].tolist()}
 
-        result = {k: v for k, v in viewitems(syn_dict)
-                  if matches([(syn_indexes, k),
-                              (syn_types, v.syn_type),
-                              (layers, v.syn_layer),
-                              (source_indexes, v.source.population),
-                              (swc_types, v.swc_type)])}
-        if cache:
-            self.filter_cache[cache_args] = result
+    def get_filter_index(self, gid):
+        """
+        Returns the :class:'SynapseFilterIndex' of the given cell,
+        building it from the current synapse attributes if necessary.
 
-        return result
+        :param gid: int
+        :return: :class:'SynapseFilterIndex'
+        """
+        filter_index = self.filter_index.get(gid, None)
+        if filter_index is not None:
+            return filter_index
+        if self.columnar:
+            syn_arrays = self.syn_id_attr_dict[gid]
+            filter_index = SynapseFilterIndex(syn_arrays.syn_ids, syn_arrays.syn_secs, syn_arrays.syn_types,
+                                              syn_arrays.syn_layers, syn_arrays.swc_types,
+                                              syn_arrays.source_populations, sec_order=syn_arrays.sec_seq)
+        else:
+            syns = [(syn_id, syn) for syn_id, syn in viewitems(self.syn_id_attr_dict[gid]) if syn is not None]
+            sec_rank = {syn_id: k for k, syn_id in
+                        enumerate(itertools.chain.from_iterable(viewvalues(self.sec_dict[gid])))}
+            filter_index = SynapseFilterIndex(
+                [syn_id for syn_id, _ in syns],
+                np.asarray([syn.syn_section for _, syn in syns], dtype=np.int64),
+                np.asarray([syn.syn_type for _, syn in syns], dtype=np.int64),
+                np.asarray([syn.syn_layer for _, syn in syns], dtype=np.int64),
+                np.asarray([syn.swc_type for _, syn in syns], dtype=np.int64),
+                np.asarray([syn.source.population if syn.source.population is not None else -1
+                            for _, syn in syns], dtype=np.int64),
+                sec_order=np.asarray([sec_rank.get(syn_id, -1) for syn_id, _ in syns], dtype=np.int64))
+        self.filter_index[gid] = filter_index
+        return filter_index
+
+    def invalidate_filter_index(self, gid):
+        """
+        Removes the filter index, cached filter results and compiled
+        parameter bindings of the given cell; called whenever its
+        synapse locations or edge attributes change.
+
+        :param gid: int
+        """
+        self.filter_index.pop(gid, None)
+        self.filter_cache.invalidate(gid)
+        self.param_bindings.pop(gid, None)
 
     def partition_synapses_by_source(self, gid, syn_ids=None):
         """
@@ -835,6 +1339,12 @@ class SynapseAttributes(object):
         source_names = {id: name for name, id in viewitems(self.env.Populations)}
         source_names[-1] = None
 
+        if self.columnar:
+            syn_arrays = self.syn_id_attr_dict[gid]
+            return {source_names[source_index]:
+                        generator_ifempty((int(syn_arrays.syn_ids[row]), syn_arrays.view(row)) for row in rows)
+                    for source_index, rows in viewitems(self.partition_rows_by_source(gid, syn_ids))}
+
         if syn_ids is None:
             syn_id_attr_dict = self.syn_id_attr_dict[gid]
         else:
@@ -877,6 +1387,13 @@ class SynapseAttributes(object):
         start_time = time.time()
         source_names = {id: name for name, id in viewitems(self.env.Populations)}
         source_names[-1] = None
+
+        if self.columnar:
+            syn_arrays = self.syn_id_attr_dict[gid]
+            return {source_names[source_index]:
+                        generator_ifempty(int(syn_id) for syn_id in syn_arrays.syn_ids[rows])
+                    for source_index, rows in viewitems(self.partition_rows_by_source(gid, syn_ids))}
+
         syn_id_attr_dict = self.syn_id_attr_dict[gid]
         if syn_ids is None:
             syn_ids = list(syn_id_attr_dict.keys())
@@ -890,18 +1407,43 @@ class SynapseAttributes(object):
         return dict([(source_names[source_id_x[0]-1], generator_ifempty(source_id_x[1])) for source_id_x in
                      enumerate(source_iter)])
 
+    def partition_rows_by_source(self, gid, syn_ids=None):
+        """
+        Partitions the rows of the columnar synapse store of the given
+        cell based on the presynaptic (source) population index. Rows
+        of synapses without a source are assigned to index -1.
+
+        :param gid: int
+        :param syn_ids: array of int
+        :return: dict { source population index: array of int }
+        """
+        syn_arrays = self.syn_id_attr_dict[gid]
+        if syn_ids is None:
+            rows = np.arange(len(syn_arrays))
+        else:
+            rows, found = syn_arrays.rows(syn_ids)
+            if not np.all(found):
+                raise RuntimeError(f'partition_rows_by_source: gid {gid}: synapse ids '
+                                   f'{np.asarray(syn_ids)[~found]} have not been initialized')
+        source_populations = syn_arrays.source_populations[rows]
+        source_indexes = [-1] + sorted(viewkeys(self.presyn_names))
+        return {source_index: rows[source_populations == source_index] for source_index in source_indexes}
+
     def del_syn_id_attr_dict(self, gid):
         """
         Removes the synapse attributes associated with the given cell gid.
         """
         del self.syn_id_attr_dict[gid]
-        del self.sec_dict[gid]
+        self.sec_dict.pop(gid, None)
+        self.invalidate_filter_index(gid)
 
     def clear(self):
         self.syn_id_attr_dict = defaultdict(lambda: defaultdict(lambda: None))
         self.sec_dict = defaultdict(lambda: defaultdict(lambda: dict()))
         self.pps_dict = defaultdict(lambda: defaultdict(lambda: SynapsePointProcess(mech={}, netcon={}, vecstim={})))
-        self.filter_cache = {}
+        self.filter_index = {}
+        self.filter_cache.clear()
+        self.param_bindings = {}
 
     def clear_filter_cache(self):
         self.filter_cache.clear()
@@ -1682,6 +2224,112 @@ def modify_syn_param(cell, env, sec_type, syn_name, param_name=None, value=None,
         raise e
 
 
+def compile_syn_param(cell, env, sec_type, syn_name, param_name, filters=None, origin=None):
+    """Resolves the synapses of the given sec_type that match the
+    provided filters into a :class:'SynParamBinding' that sets a
+    scalar value of the given parameter. Applying the binding has the
+    same effect as calling modify_syn_param with value, origin and
+    filters, and update_targets=True.
+
+    Returns None if the parameter cannot be set by direct assignment,
+    i.e. if the connection configuration of any of the filtered
+    synapses specifies the parameter as an expression of the netcon
+    delay. In that case modify_syn_param must be used.
+
+    :param cell: :class:'BiophysCell'
+    :param env: :class:'Env'
+    :param sec_type: str
+    :param syn_name: str
+    :param param_name: str
+    :param filters: dict
+    :param origin: str (sec_type)
+    :return: :class:'SynParamBinding' or None
+    """
+    if sec_type not in cell.nodes:
+        raise ValueError(f'compile_syn_param: sec_type: {sec_type} not in cell')
+    if not validate_syn_mech_param(env, syn_name, param_name):
+        raise ValueError('compile_syn_param: synaptic mechanism: '
+                         f'{syn_name} or parameter: {param_name} not recognized by network configuration')
+    rules = get_mech_rules_dict(cell, origin=origin)
+    if filters is not None:
+        rules['filters'] = get_syn_filter_dict(env, filters)
+        synapse_filters = get_syn_filter_dict(env, filters, convert=True)
+    else:
+        synapse_filters = {}
+
+    gid = cell.gid
+    syn_attrs = env.synapse_attributes
+    syn_index = syn_attrs.syn_name_index_dict[syn_name]
+    mech_rules = syn_attrs.syn_param_rules[syn_attrs.syn_mech_names[syn_name]]
+    is_mech_param = param_name in mech_rules.get('mech_params', ())
+    nc_index = mech_rules.get('netcon_params', {}).get(param_name, None)
+
+    is_reduced = False
+    if hasattr(cell, 'is_reduced'):
+        is_reduced = cell.is_reduced
+    if is_reduced:
+        synapse_filters['swc_types'] = [env.SWC_Types[sec_type]]
+        filtered_syns = syn_attrs.filter_synapses(gid, cache=env.cache_queries, **synapse_filters)
+    else:
+        node_indexes = [node.index for node in cell.nodes[sec_type]]
+        if len(node_indexes) > 0:
+            filtered_syns = syn_attrs.filter_synapses(gid, syn_sections=node_indexes,
+                                                      cache=env.cache_queries, **synapse_filters)
+        else:
+            filtered_syns = {}
+
+    connection_config = env.connection_config[cell.pop_name]
+    attr_dicts = []
+    mech_targets = []
+    netcon_targets = []
+    for syn_id, syn in viewitems(filtered_syns):
+        presyn_name = syn_attrs.presyn_names.get(syn.source.population, None)
+        if presyn_name:
+            connection_syn_params = connection_config[presyn_name].mechanisms
+            if 'default' in connection_syn_params:
+                section_syn_params = connection_syn_params['default']
+            else:
+                section_syn_params = connection_syn_params[syn.swc_type]
+            if isinstance(section_syn_params.get(syn_name, {}).get(param_name, None), ExprClosure):
+                return None
+        attr_dicts.append(syn.attr_dict[syn_index])
+        if is_mech_param:
+            pps = syn_attrs.get_pps(gid, syn_id, syn_name, throw_error=False)
+            if pps is not None:
+                mech_targets.append(pps)
+        elif nc_index is not None:
+            nc = syn_attrs.get_netcon(gid, syn_id, syn_name, throw_error=False)
+            if nc is not None and int(nc.wcnt()) > nc_index:
+                netcon_targets.append((nc, nc_index))
+
+    return SynParamBinding(cell, sec_type, syn_name, param_name, rules, attr_dicts, mech_targets, netcon_targets)
+
+
+def get_syn_param_binding(cell, env, sec_type, syn_name, param_name, filters=None, origin=None):
+    """Returns the :class:'SynParamBinding' of the given parameter,
+    compiling it with compile_syn_param if it has not been compiled
+    since the synapses of the cell were last modified. Returns None
+    if the parameter cannot be bound.
+
+    :param cell: :class:'BiophysCell'
+    :param env: :class:'Env'
+    :param sec_type: str
+    :param syn_name: str
+    :param param_name: str
+    :param filters: dict
+    :param origin: str (sec_type)
+    :return: :class:'SynParamBinding' or None
+    """
+    gid_bindings = env.synapse_attributes.param_bindings.setdefault(cell.gid, {})
+    key = (sec_type, syn_name, param_name, origin,
+           None if filters is None else tuple(sorted((k, tuple(v)) for k, v in viewitems(filters))))
+    if key in gid_bindings:
+        return gid_bindings[key]
+    binding = compile_syn_param(cell, env, sec_type, syn_name, param_name, filters=filters, origin=origin)
+    gid_bindings[key] = binding
+    return binding
+
+
 def update_syn_mech_by_sec_type(cell, env, sec_type, syn_name, mech_content, update_targets=False, verbose=False):
     """For the provided sec_type and synaptic mechanism, this method
     loops through the parameters specified in the mechanism
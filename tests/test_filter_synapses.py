@@ -15,7 +15,8 @@ from dentate.utils import *
 @click.option("--template-paths", type=str, required=True)
 @click.option("--dataset-prefix", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True))
 @click.option("--config-prefix", required=True, type=click.Path(exists=True, file_okay=False, dir_okay=True), default='config')
-def main(config_file, population, gid, template_paths, dataset_prefix, config_prefix):
+@click.option("--columnar-synapses", is_flag=True)
+def main(config_file, population, gid, template_paths, dataset_prefix, config_prefix, columnar_synapses):
     """
     Runs network clamp simulation for the specified cell gid.
 
@@ -26,6 +27,7 @@ def main(config_file, population, gid, template_paths, dataset_prefix, config_pr
     :param template_paths: str; colon-separated list of paths to directories containing hoc cell templates
     :param dataset_prefix: str; path to directory containing required neuroh5 data files
     :param config_prefix: str; path to directory containing network and cell mechanism config files
+    :param columnar_synapses: bool; whether to store synapse attributes in per-cell columnar arrays
     :param verbose: bool
     """
 
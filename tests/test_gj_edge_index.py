@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+## Test of the gap junction id computation in connect_gjs. Splits a
+## random gap junction edge list over a number of emulated ranks, runs
+## network.gj_edge_index on each rank with a communicator that
+## emulates allgather and Allgatherv with threads, and compares the
+## resulting edge positions with the sequential ordering by source gid
+## and edge position used when the whole graph is read on one rank.
+
+import threading
+import click
+import numpy as np
+from dentate.network import gj_edge_index
+
+
+class ThreadComm(object):
+    """Communicator of one of several ranks emulated by threads,
+    providing the collective operations used by gj_edge_index."""
+
+    def __init__(self, rank, size, shared, barrier):
+        self.rank = rank
+        self.size = size
+        self.shared = shared
+        self.barrier = barrier
+
+    def allgather(self, obj):
+        self.shared[self.rank] = obj
+        self.barrier.wait()
+        result = list(self.shared)
+        self.barrier.wait()
+        return result
+
+    def Allgatherv(self, sendbuf, recvspec):
+        recvbuf, counts = recvspec
+        self.shared[self.rank] = np.asarray(sendbuf)
+        self.barrier.wait()
+        assert [len(x) for x in self.shared] == list(counts)
+        recvbuf[:] = np.concatenate(self.shared)
+        self.barrier.wait()
+
+
+def run_ranks(rank_srcs):
+    n_ranks = len(rank_srcs)
+    shared = [None] * n_ranks
+    barrier = threading.Barrier(n_ranks)
+    results = [None] * n_ranks
+    def run(rank):
+        results[rank] = gj_edge_index(ThreadComm(rank, n_ranks, shared, barrier), rank_srcs[rank])
+    threads = [threading.Thread(target=run, args=(rank,)) for rank in range(n_ranks)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def check_split(label, srcs, edge_rank, n_ranks):
+    """
+    Splits the edges in graph order over the ranks given by edge_rank,
+    and checks that the positions computed on each rank are the
+    positions of the edges in the sequential ordering.
+    """
+    sequential_index = np.empty((len(srcs),), dtype=np.int64)
+    sequential_index[np.argsort(srcs, kind='stable')] = np.arange(len(srcs))
+    rank_edges = [np.flatnonzero(edge_rank == rank) for rank in range(n_ranks)]
+    results = run_ranks([srcs[edges] for edges in rank_edges])
+    for rank, (edge_index, n_edges) in enumerate(results):
+        assert n_edges == len(srcs), f'{label}: rank {rank}: number of edges {n_edges} != {len(srcs)}'
+        assert np.array_equal(edge_index, sequential_index[rank_edges[rank]]), \
+            f'{label}: rank {rank}: edge positions differ from sequential ordering'
+    print(f'{label}: {len(srcs)} edges on {n_ranks} ranks: edge positions match sequential ordering')
+
+
+@click.command()
+@click.option("--n-ranks", type=int, default=4)
+@click.option("--n-gids", type=int, default=300)
+@click.option("--n-edges", type=int, default=5000)
+@click.option("--seed", type=int, default=0)
+def main(n_ranks, n_gids, n_edges, seed):
+
+    rng = np.random.default_rng(seed)
+    ## Edges are grouped by source gid in the graph, but source gids are not sorted
+    src_gids = rng.permutation(np.arange(100000, 100000 + n_gids * 3, 3)).astype(np.uint32)
+    srcs = np.repeat(src_gids, rng.multinomial(n_edges, np.ones(n_gids) / n_gids))
+
+    ## Each source gid is on one rank, as with node allocation
+    gid_rank = dict(zip(src_gids.tolist(), rng.integers(0, n_ranks, n_gids).tolist()))
+    check_split('source gids on one rank', srcs, np.asarray([gid_rank[src] for src in srcs.tolist()]), n_ranks)
+
+    ## Some ranks have no edges
+    check_split('empty ranks', srcs, np.zeros((len(srcs),), dtype=np.int64), n_ranks)
+
+    ## The edges of a source gid are split over several ranks in rank order
+    edge_rank = np.zeros((len(srcs),), dtype=np.int64)
+    for src in src_gids:
+        edges = np.flatnonzero(srcs == src)
+        edge_rank[edges] = np.sort(rng.integers(0, n_ranks, len(edges)))
+    check_split('source gids on several ranks', srcs, edge_rank, n_ranks)
+
+    ## Single rank
+    check_split('single rank', srcs, np.zeros((len(srcs),), dtype=np.int64), 1)
+
+
+if __name__ == '__main__':
+    main()
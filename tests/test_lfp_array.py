@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+## Test of vectorized LFP sampling. Creates a few cells with the
+## extracellular mechanism, records the LFP with the vectorized LFP
+## and LFPArray classes, and compares each sample with the LFP
+## computed directly from the membrane currents of the segments. The
+## LFP objects are created before stdinit and cache_efficient, as in
+## network.init. Assumes the presence of the lfp mechanism.
+
+import click
+import numpy as np
+from neuron import h
+from dentate import lfp
+
+
+class Cell(object):
+    def __init__(self, pc, gid, x0):
+        self.soma = h.Section(name='soma', cell=self)
+        self.dend = h.Section(name='dend', cell=self)
+        self.dend.connect(self.soma(1))
+        self.soma.pt3dadd(x0, 0, 0, 10)
+        self.soma.pt3dadd(x0 + 10, 0, 0, 10)
+        self.dend.pt3dadd(x0 + 10, 0, 0, 2)
+        self.dend.pt3dadd(x0 + 200, 50, 0, 2)
+        self.dend.nseg = 7
+        self.all = h.SectionList()
+        self.all.wholetree(sec=self.soma)
+        for sec in self.all:
+            sec.insert('hh')
+            sec.insert('extracellular')
+        self.stim = h.IClamp(self.soma(0.5))
+        self.stim.delay = 1
+        self.stim.dur = 2
+        self.stim.amp = 1.
+        self.nc = h.NetCon(self.soma(0.5)._ref_v, None, sec=self.soma)
+        pc.set_gid2node(gid, int(pc.id()))
+        pc.cell(gid, self.nc)
+
+
+@click.command()
+@click.option("--mechanisms-path", type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option("--n-cells", type=int, default=8)
+@click.option("--dt-lfp", type=float, default=0.1)
+@click.option("--tstop", type=float, default=5.)
+def main(mechanisms_path, n_cells, dt_lfp, tstop):
+
+    if mechanisms_path is not None:
+        h.nrn_load_dll(mechanisms_path)
+    h.load_file('stdrun.hoc')
+    pc = h.ParallelContext()
+
+    cells = [Cell(pc, gid, 30. * gid) for gid in range(n_cells)]
+    pop_gid_dict = {'A': set(range(n_cells))}
+    positions = [(0., 20., 0.), (100., 20., 0.)]
+    lfp_single = lfp.LFP('single', pc, pop_gid_dict, positions[0], maxEDist=500., dt_lfp=dt_lfp, vectorized=True)
+    lfp_array = lfp.LFPArray('array', pc, pop_gid_dict, positions, maxEDist=500., dt_lfp=dt_lfp)
+
+    segs = [seg for cell in cells for sec in cell.all for seg in sec]
+    expected_single = []
+    expected_array = []
+    def sample():
+        i_membrane = np.asarray([seg.i_membrane for seg in segs])
+        expected_single.append(np.dot(lfp_single.lfp_coeff_array, i_membrane))
+        expected_array.append(np.dot(lfp_array.lfp_coeff_array, i_membrane))
+        h.cvode.event(h.t + dt_lfp, sample)
+    fih = h.FInitializeHandler(1, sample)
+
+    h.stdinit()
+    h.cvode.cache_efficient(1)
+    h.finitialize(-65.)
+    h.continuerun(tstop)
+
+    for label, lfp_obj, expected in [('LFP', lfp_single, expected_single),
+                                     ('LFPArray', lfp_array, expected_array)]:
+        actual = np.asarray(lfp_obj.meanlfp).reshape((len(lfp_obj.meanlfp), -1))
+        expected = np.asarray(expected).reshape(actual.shape)
+        max_error = np.max(np.abs(actual - expected))
+        print(f'{label}: {actual.shape[0]} samples, {actual.shape[1]} channels, maximum error {max_error}')
+        assert np.allclose(actual, expected, rtol=1e-9, atol=1e-12)
+
+
+if __name__ == '__main__':
+    main()
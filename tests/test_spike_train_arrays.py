@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+## Equivalence test of the columnar spike trains built by
+## get_env_spike_arrays with the per-gid dictionaries built by the
+## previous implementation of get_env_spike_dict, which is reproduced
+## below. Generates random spike output vectors for several
+## populations and trials, with spike onset delays and artificial
+## cells, and compares the spike trains, spike counts and gid
+## selections of SpikeTrainArrays with the dictionaries.
+
+import click
+import numpy as np
+from neuron import h
+from dentate.spikedata import get_env_spike_arrays, get_env_spike_dict
+from dentate.utils import Struct, get_trial_time_ranges
+
+
+def get_env_spike_dict_reference(env, include_artificial=True):
+    """
+    Per-gid per-trial dictionary of spike times, as constructed by
+    get_env_spike_dict before the introduction of SpikeTrainArrays.
+    """
+    equilibration_duration = float(env.stimulus_config['Equilibration Duration'])
+    n_trials = env.n_trials
+
+    t_vec = env.t_vec.as_numpy()
+    id_vec = np.asarray(env.id_vec.as_numpy(), dtype=np.uint32)
+
+    trial_time_ranges = get_trial_time_ranges(env.t_rec.to_python(), env.n_trials)
+    trial_time_bins = [ t_trial_start for t_trial_start, t_trial_end in trial_time_ranges ]
+    trial_dur = np.asarray([env.tstop + equilibration_duration] * n_trials, dtype=np.float32)
+
+    typelst = sorted(env.celltypes.keys())
+    binvect = np.asarray([env.celltypes[k]['start'] for k in typelst ])
+    sort_idx = np.argsort(binvect, axis=0)
+    pop_names = [typelst[i] for i in sort_idx]
+    bins = binvect[sort_idx][1:]
+    inds = np.digitize(id_vec, bins)
+
+    pop_spkdict = {}
+    for i, pop_name in enumerate(pop_names):
+        spkdict = {}
+        sinds = np.where(inds == i)
+        if len(sinds) > 0:
+            ids = id_vec[sinds]
+            ts = t_vec[sinds]
+            for j in range(0, len(ids)):
+                gid = ids[j]
+                t = ts[j]
+                if (not include_artificial) and (gid in env.artificial_cells[pop_name]):
+                    continue
+                if gid in spkdict:
+                   spkdict[gid].append(t)
+                else:
+                   spkdict[gid] = [t]
+            for gid in spkdict:
+                spiketrain = np.array(spkdict[gid], dtype=np.float32)
+                if gid in env.spike_onset_delay:
+                    spiketrain -= env.spike_onset_delay[gid]
+                trial_bins = np.digitize(spiketrain, trial_time_bins) - 1
+                trial_spikes = [np.copy(spiketrain[np.where(trial_bins == trial_i)[0]])
+                                for trial_i in range(env.n_trials)]
+                for trial_i, trial_spiketrain in enumerate(trial_spikes):
+                    trial_spiketrain -= np.sum(trial_dur[:(trial_i)]) + equilibration_duration
+                spkdict[gid] = trial_spikes
+        pop_spkdict[pop_name] = spkdict
+
+    return pop_spkdict
+
+
+def make_env(rng, n_spikes, n_trials, tstop, equilibration_duration):
+    env = Struct()
+    env.stimulus_config = {'Equilibration Duration': equilibration_duration}
+    env.n_trials = n_trials
+    env.tstop = tstop
+    env.celltypes = {'GC': {'start': 0}, 'MC': {'start': 1000}, 'MPP': {'start': 1500}}
+    n_gids = 2000
+    env.artificial_cells = {'GC': {}, 'MC': {}, 'MPP': {gid: None for gid in range(1500, n_gids, 3)}}
+    env.spike_onset_delay = {int(gid): float(rng.uniform(0., 5.)) for gid in range(0, n_gids, 7)}
+    t_total = n_trials * (tstop + equilibration_duration)
+    t_vec = np.sort(rng.uniform(0., t_total, n_spikes))
+    ## Some cells do not spike at all
+    id_vec = rng.choice(np.arange(0, n_gids, 2), n_spikes)
+    env.t_vec = h.Vector(t_vec)
+    env.id_vec = h.Vector(id_vec)
+    env.t_rec = h.Vector(np.arange(0., t_total + 0.025, 0.025))
+    return env
+
+
+def compare_spike_trains(label, spike_dict, spike_arrays, n_trials):
+    gids = sorted(spike_dict.keys())
+    assert np.array_equal(np.asarray(gids, dtype=spike_arrays.gids.dtype), spike_arrays.gids), \
+        f'{label}: gids differ'
+    for gid in gids:
+        for trial in range(n_trials):
+            expected = spike_dict[gid][trial]
+            actual = spike_arrays.spike_train(gid, trial)
+            assert np.array_equal(expected, actual), f'{label}: spike train of gid {gid} trial {trial} differs'
+    counts = spike_arrays.spike_counts()
+    expected_counts = np.asarray([[len(spike_dict[gid][trial]) for trial in range(n_trials)] for gid in gids],
+                                 dtype=counts.dtype).reshape(counts.shape)
+    assert np.array_equal(counts, expected_counts), f'{label}: spike counts differ'
+
+
+@click.command()
+@click.option("--n-spikes", type=int, default=20000)
+@click.option("--n-trials", type=int, default=3)
+@click.option("--tstop", type=float, default=1000.)
+@click.option("--equilibration-duration", type=float, default=250.)
+@click.option("--seed", type=int, default=0)
+def main(n_spikes, n_trials, tstop, equilibration_duration, seed):
+
+    rng = np.random.default_rng(seed)
+    env = make_env(rng, n_spikes, n_trials, tstop, equilibration_duration)
+
+    for include_artificial in (True, False):
+        expected = get_env_spike_dict_reference(env, include_artificial=include_artificial)
+        spike_arrays = get_env_spike_arrays(env, include_artificial=include_artificial)
+        spike_dict = get_env_spike_dict(env, include_artificial=include_artificial)
+        assert expected.keys() == spike_arrays.keys() == spike_dict.keys()
+        for pop_name in expected:
+            label = f'{pop_name} include_artificial={include_artificial}'
+            compare_spike_trains(label, expected[pop_name], spike_arrays[pop_name], n_trials)
+            assert sorted(spike_dict[pop_name].keys()) == sorted(expected[pop_name].keys())
+            for gid, trial_spikes in spike_dict[pop_name].items():
+                for trial in range(n_trials):
+                    assert np.array_equal(trial_spikes[trial], expected[pop_name][gid][trial]), \
+                        f'{label}: get_env_spike_dict spike train of gid {gid} trial {trial} differs'
+
+            ## Selection of gids, including gids without spikes
+            start = env.celltypes[pop_name]['start']
+            select_gids = rng.choice(np.arange(start, start + 500), 100, replace=False)
+            selected = spike_arrays[pop_name].select(select_gids)
+            assert np.array_equal(selected.gids, np.unique(select_gids))
+            select_counts = spike_arrays[pop_name].spike_counts(selected.gids)
+            assert np.array_equal(selected.spike_counts(), select_counts), f'{label}: selected spike counts differ'
+            for gid in selected.gids:
+                for trial in range(n_trials):
+                    expected_train = expected[pop_name][gid][trial] if gid in expected[pop_name] else []
+                    assert np.array_equal(selected.spike_train(gid, trial), expected_train), \
+                        f'{label}: selected spike train of gid {gid} trial {trial} differs'
+
+        n_gids = {pop_name: len(spike_arrays[pop_name]) for pop_name in spike_arrays}
+        print(f'include_artificial={include_artificial}: spike trains of {n_gids} gids are equal')
+
+
+if __name__ == '__main__':
+    main()
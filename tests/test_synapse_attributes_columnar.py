@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+## Equivalence test of the dictionary and columnar backends of
+## SynapseAttributes. Creates the same random synapses, edges and
+## mechanism attributes in both backends and compares the results of
+## filter_synapses queries (including the order of synapses), the
+## partitions by source, the mechanism attributes after additions,
+## modifications and writes through several views of one synapse, and
+## the synapse attributes after stash and restore.
+
+import click
+import numpy as np
+from dentate.synapses import SynapseAttributes
+from dentate.utils import Struct
+
+
+syn_mech_names = {'AMPA': 'LinExp2Syn', 'NMDA': 'FacilNMDA'}
+syn_param_rules = {'LinExp2Syn': {'mech_params': ['tau_rise', 'tau_decay', 'e'],
+                                  'netcon_params': {'weight': 0}},
+                   'FacilNMDA': {'mech_params': ['tau_rise', 'tau_decay', 'e'],
+                                 'netcon_params': {'weight': 0}}}
+
+
+def make_env():
+    env = Struct()
+    env.celltypes = {}
+    env.Populations = {'GC': 0, 'MC': 1, 'MPP': 2}
+    env.connection_velocity = {'MC': 250., 'MPP': 250.}
+    env.connection_config = {'GC': {'MC': Struct(mechanisms={'default': {}}),
+                                    'MPP': Struct(mechanisms={'default': {}})}}
+    return env
+
+
+def synapse_tuple(syn):
+    ## The columnar backend stores locations and delays in single precision
+    delay = None if syn.source.delay is None else float(np.float32(syn.source.delay))
+    return (syn.syn_type, syn.swc_type, syn.syn_layer, float(np.float32(syn.syn_loc)), syn.syn_section,
+            syn.source.gid, syn.source.population, delay,
+            {syn_index: dict(attrs) for syn_index, attrs in syn.attr_dict.items()})
+
+
+def compare_synapses(label, syns_dict, syns_columnar):
+    ids_dict = list(syns_dict.keys())
+    ids_columnar = list(syns_columnar.keys())
+    assert ids_dict == ids_columnar, f'{label}: synapse ids differ'
+    for syn_id in ids_dict:
+        syn_dict = synapse_tuple(syns_dict[syn_id])
+        syn_columnar = synapse_tuple(syns_columnar[syn_id])
+        assert syn_dict == syn_columnar, \
+            f'{label}: attributes of synapse {syn_id} differ: {syn_dict} {syn_columnar}'
+
+
+def compare_queries(syn_attrs_list, gid, queries, label):
+    for query in queries:
+        for cache in (False, True):
+            results = [syn_attrs.filter_synapses(gid, cache=cache, **query) for syn_attrs in syn_attrs_list]
+            compare_synapses(f'{label}: filter_synapses({query}, cache={cache})', *results)
+    partitions = [syn_attrs.partition_synapses_by_source(gid) for syn_attrs in syn_attrs_list]
+    assert partitions[0].keys() == partitions[1].keys()
+    for presyn_name in partitions[0]:
+        if partitions[0][presyn_name] is None:
+            assert partitions[1][presyn_name] is None, f'{label}: partition {presyn_name} differs'
+        else:
+            compare_synapses(f'{label}: partition {presyn_name}',
+                             dict(partitions[0][presyn_name]), dict(partitions[1][presyn_name]))
+
+
+@click.command()
+@click.option("--n-syns", type=int, default=2000)
+@click.option("--n-sections", type=int, default=30)
+@click.option("--seed", type=int, default=0)
+def main(n_syns, n_sections, seed):
+
+    rng = np.random.default_rng(seed)
+    env = make_env()
+    gid = 7
+
+    syn_ids = rng.permutation(n_syns).astype(np.uint32)
+    syn_layers = rng.integers(0, 4, n_syns)
+    syn_types = rng.integers(0, 2, n_syns)
+    swc_types = rng.integers(0, 5, n_syns)
+    syn_secs = rng.integers(0, n_sections, n_syns)
+    syn_locs = rng.uniform(0., 1., n_syns)
+
+    n_mc = n_syns // 4
+    n_mpp = n_syns // 10
+    mc_syn_ids = syn_ids[:n_mc]
+    mpp_syn_ids = syn_ids[n_syns - n_mpp:]
+    mc_delays = rng.uniform(1., 3., n_mc)
+
+    syn_attrs_list = []
+    for columnar in (False, True):
+        syn_attrs = SynapseAttributes(env, syn_mech_names, syn_param_rules, columnar=columnar)
+        syn_attrs.init_syn_id_attrs(gid, syn_ids, syn_layers, syn_types, swc_types, syn_secs, syn_locs)
+        syn_attrs.init_edge_attrs(gid, 'MC', np.arange(n_mc) + 1000, mc_syn_ids, delays=mc_delays)
+        syn_attrs.init_edge_attrs(gid, 'MPP', np.arange(n_mpp) + 5000, mpp_syn_ids)
+        syn_attrs_list.append(syn_attrs)
+
+    queries = [dict(),
+               dict(syn_types=[1]),
+               dict(layers=[1, 2], swc_types=[3]),
+               dict(sources=[1]),
+               dict(sources=[2], syn_types=[0]),
+               dict(syn_sections=[5, 0, 7]),
+               dict(syn_sections=[n_sections - 1, 3, 3, 1], syn_types=[1]),
+               dict(syn_sections=[2, 4], sources=[1], layers=[0, 3]),
+               dict(syn_indexes=syn_ids[:50].tolist(), sources=[1])]
+
+    compare_queries(syn_attrs_list, gid, queries, 'initial')
+
+    ## Moving synapses changes their order within sections
+    for step in range(3):
+        moved = rng.choice(n_syns, n_syns // 20, replace=False)
+        new_secs = rng.integers(0, 8, len(moved))
+        new_locs = rng.uniform(0., 1., len(moved))
+        for syn_attrs in syn_attrs_list:
+            syn_attrs.modify_syn_locs(gid, syn_ids[moved], new_secs, new_locs)
+        compare_queries(syn_attrs_list, gid, queries, f'modify_syn_locs step {step}')
+
+    ## Mechanism attributes
+    ampa_syn_ids = syn_ids[:n_syns // 2]
+    nmda_syn_ids = syn_ids[n_syns // 4:n_syns // 3]
+    for syn_attrs in syn_attrs_list:
+        syn_attrs.add_mech_attrs_from_iter(gid, 'AMPA', ((syn_id, {'weight': float(syn_id), 'tau_decay': 5.})
+                                                         for syn_id in ampa_syn_ids))
+        syn_attrs.add_mech_attrs_from_iter(gid, 'NMDA', ((syn_id, {'weight': 0.5}) for syn_id in nmda_syn_ids))
+        syn_attrs.add_mech_attrs_from_iter(gid, 'NMDA', ((syn_id, {'weight': 2.}) for syn_id in nmda_syn_ids[:10]),
+                                           multiple='overwrite')
+        syn_attrs.add_mech_attrs_from_iter(gid, 'NMDA', ((syn_id, {'weight': 3.}) for syn_id in nmda_syn_ids[:20]),
+                                           multiple='skip')
+        for syn_id in mc_syn_ids[:20]:
+            syn_attrs.modify_mech_attrs('GC', gid, syn_id, 'AMPA', {'weight': 4., 'e': 0.})
+    compare_queries(syn_attrs_list, gid, queries, 'mechanism attributes')
+
+    for syn_id in syn_ids.tolist():
+        for syn_name in syn_mech_names:
+            has_attrs = [syn_attrs.has_mech_attrs(gid, syn_id, syn_name) for syn_attrs in syn_attrs_list]
+            assert has_attrs[0] == has_attrs[1], f'has_mech_attrs {syn_id} {syn_name} differs'
+            mech_attrs = [syn_attrs.get_mech_attrs(gid, syn_id, syn_name, throw_error=False)
+                          for syn_attrs in syn_attrs_list]
+            assert mech_attrs[0] == mech_attrs[1], f'get_mech_attrs {syn_id} {syn_name} differs'
+
+    ## Writes through several views of the same synapse
+    view_syn_id = int(syn_ids[-2])
+    for syn_attrs in syn_attrs_list:
+        syn_view_a = syn_attrs[gid][view_syn_id]
+        syn_view_b = syn_attrs[gid][view_syn_id]
+        syn_view_a.attr_dict[0]['tau_rise'] = 1.
+        syn_view_b.attr_dict[1]['tau_rise'] = 2.
+        syn_views = list(syn_attrs.filter_synapses(gid, syn_indexes=[view_syn_id]).values()) + \
+                    [syn_attrs[gid][view_syn_id]]
+        syn_views[0].attr_dict[0]['e'] = 0.
+        syn_views[1].attr_dict[1]['e'] = -10.
+    compare_queries(syn_attrs_list, gid, queries, 'views')
+    for syn_attrs in syn_attrs_list:
+        assert syn_attrs.get_mech_attrs(gid, view_syn_id, 'AMPA') == {'tau_rise': 1., 'e': 0.}
+        assert syn_attrs.get_mech_attrs(gid, view_syn_id, 'NMDA') == {'tau_rise': 2., 'e': -10.}
+
+    ## Stash and restore
+    for syn_attrs in syn_attrs_list:
+        stash_id = syn_attrs.stash_syn_attrs('GC', gid)
+        syn_attrs.add_mech_attrs_from_iter(gid, 'NMDA', ((syn_id, {'weight': 1.}) for syn_id in syn_ids[-50:]),
+                                           multiple='overwrite')
+        for syn_id in ampa_syn_ids[:20]:
+            syn_attrs.modify_mech_attrs('GC', gid, syn_id, 'AMPA', {'tau_decay': 10.})
+        syn_attrs.restore_syn_attrs('GC', gid, stash_id)
+    compare_queries(syn_attrs_list, gid, queries, 'restore')
+    for syn_attrs in syn_attrs_list:
+        assert syn_attrs.get_mech_attrs(gid, syn_ids[-1], 'NMDA', throw_error=False) is None
+        assert syn_attrs.get_mech_attrs(gid, ampa_syn_ids[0], 'AMPA')['tau_decay'] == 5.
+
+    print(f'{n_syns} synapses: dictionary and columnar backends are equivalent')
+
+
+if __name__ == '__main__':
+    main()